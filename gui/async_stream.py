@@ -0,0 +1,253 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   asyncio implementation of grbl's character-counting streaming protocol.
+
+   The blocking stream.stream_gcode only reads when the RX buffer is full
+   and sends nothing while it waits for an 'ok'. Here a reader coroutine
+   drains grbl's responses as they arrive and a writer coroutine tops the
+   128 byte RX buffer back up the moment space frees, so grbl always has
+   the next blocks in its serial buffer.
+"""
+import asyncio
+import collections
+import serials
+import status
+import stream
+from gcode import compaction
+
+# Serial read timeout so the reader can notice the end of the stream
+READ_TIMEOUT = 0.1
+
+
+def run_stream(s, gcode_file, emit, control=None, settings=False, precision=None, laser=True,
+               status_interval=None, journaled=False, resume=False):
+    """ Streams the gcode file using the asyncio streamer, blocking until done
+
+    Same interface as stream.stream_gcode so it can be given to StreamWorker.
+    Settings are still sent call-response by stream.stream_gcode since the
+    EEPROM writes shut off grbl's serial interrupt.
+    """
+    if settings:
+        return stream.stream_gcode(s, gcode_file, emit, control, settings=True, laser=laser)
+
+    return asyncio.run(stream_gcode(s, gcode_file, emit, control, precision, laser, status_interval,
+                                    journaled, resume))
+
+
+async def stream_gcode(s, gcode_file, emit, control=None, precision=None, laser=True, status_interval=None,
+                       journaled=False, resume=False):
+    """
+    Streams the gcode file over an already opened serial port
+
+    :param s: The open serial port of grbl
+    :param gcode_file: The Gcode File
+    :param emit: Callable receiving the progress event dicts
+    :param control: Optional StreamControl to cancel or pause the stream
+    :param precision: Compacts the blocks to this many decimals when given, see stream.read_blocks
+    :param laser: Boolean to indicate whether or not to switch the laser (Default is true)
+    :param status_interval: Seconds between '?' status reports while streaming, None to not poll
+    :param journaled: Records the progress in the journal of the gcode file, see journal.Journal
+    :param resume: Continues from the checkpoint in the journal of the gcode file
+
+    :return: True or False depending on the outcome
+    """
+    if control is None:
+        control = stream.StreamControl()
+
+    record = stream.start_journal(gcode_file, precision, journaled, resume)
+    if record is False:
+        emit(stream.no_journal_event(gcode_file))
+        return False
+
+    loop = asyncio.get_running_loop()
+    state = _StreamState()
+    state.journal = record
+    timeout = s.timeout
+    s.timeout = READ_TIMEOUT
+
+    with open(gcode_file, 'r') as f:
+        stats = compaction.new_stats()
+        total = sum(1 for _ in stream.read_blocks(f, precision, stats))
+        f.seek(0)
+        if record is not None:
+            total += len(record.preamble) - record.start
+
+        # Wake up grbl and wait for it to answer
+        emit({'type': 'message', 'text': 'Initializing grbl...'})
+        if not await loop.run_in_executor(None, stream.wake_grbl, s):
+            s.timeout = timeout
+            emit({'type': 'finished', 'result': False, 'cancelled': False, 'metrics': None,
+                  'reason': 'grbl did not respond'})
+            return False
+        emit({'type': 'started', 'file': gcode_file, 'total': total, 'settings': False,
+              'compaction': stats if precision is not None else None,
+              'resumed': record.start if record is not None else 0})
+
+        state.monitor, poller = stream.start_status(s, status_interval)
+        reader = loop.create_task(_reader(s, state, emit, total))
+        finished = False
+        try:
+            try:
+                l_blocks = stream.read_blocks(f, precision)
+                if record is not None:
+                    l_blocks = record.blocks(l_blocks)
+                await _writer(s, l_blocks, state, emit, control, loop, laser)
+            finally:
+                # Raises what stopped the reader once the writer is done
+                state.done = True
+                await reader
+                s.timeout = timeout
+                metrics = stream.stop_status(state.monitor, poller)
+
+            if state.flag and not state.cancelled:
+                emit({'type': 'message', 'text': 'G-code streaming finished, waiting for grbl to go idle'})
+                if not await loop.run_in_executor(None, stream.wait_until_idle, s, control):
+                    state.cancelled = control.cancelled
+                    state.flag = False
+            finished = True
+        except Exception:
+            # Stop motion and flush grbl's planner, the caller reports the error
+            try:
+                s.write(b'!')
+                s.write(b'\x18')
+            except Exception as e:
+                print(e)
+            raise
+        finally:
+            if record is not None:
+                if finished and state.flag and not state.cancelled:
+                    record.clear()
+                else:
+                    record.save()
+
+    if state.cancelled:
+        # Stop motion and flush grbl's planner
+        s.write(b'!')
+        s.write(b'\x18')
+
+    if laser:
+        emit({'type': 'laser', 'on': False, 'result': serials.stop_laser()})
+
+    flag = state.flag and not state.cancelled
+    emit({'type': 'finished', 'result': flag, 'cancelled': state.cancelled, 'metrics': metrics,
+          'reason': 'Cancelled' if state.cancelled else '' if flag else 'CRITICAL ERROR STREAMING GCODE'})
+    return flag
+
+
+class _StreamState:
+    """ Character-counting state shared by the reader and writer coroutines """
+
+    def __init__(self):
+        self.c_line = collections.deque() # Characters of every unacknowledged block
+        self.c_block = collections.deque() # Line numbers of every unacknowledged block
+        self.buffered = 0
+        self.sent = 0
+        self.acked = 0
+        self.flag = True
+        self.done = False
+        self.cancelled = False
+        self.monitor = None
+        self.journal = None
+        self.space = asyncio.Condition()
+
+
+async def _writer(s, l_blocks, state, emit, control, loop, laser):
+    """ Sends blocks as soon as they fit into grbl's RX buffer """
+    laser_started = not laser
+    laser_block = state.journal.laser_block(stream.LASER_START_BLOCK) if state.journal is not None \
+        else stream.LASER_START_BLOCK
+    for l_block in l_blocks:
+        if not state.flag:
+            return # grbl is in alarm and rejects every block from here on
+        if control.paused and not control.cancelled:
+            s.write(b'!') # Feed hold
+            emit({'type': 'paused'})
+            await loop.run_in_executor(None, control.wait)
+            if not control.cancelled:
+                s.write(b'~') # Cycle start
+                emit({'type': 'resumed'})
+        if control.cancelled:
+            state.cancelled = True
+            return
+
+        if state.acked > laser_block and laser_started is False:
+            laser_started = True
+            result = await loop.run_in_executor(None, serials.start_laser)
+            emit({'type': 'laser', 'on': True, 'result': result})
+
+        length = len(l_block) + 1
+        async with state.space:
+            # A block longer than the buffer can only be sent into an empty buffer
+            await state.space.wait_for(
+                lambda: state.buffered + length < stream.RX_BUFFER_SIZE - 1 or not state.c_line or not state.flag)
+            if not state.flag:
+                return
+            state.sent += 1
+            state.c_line.append(length)
+            state.c_block.append((state.sent, l_block))
+            state.buffered += length
+        s.write((l_block + '\n').encode()) # Send g-code block to grbl
+
+    # Wait for grbl to acknowledge every block still in its buffer
+    async with state.space:
+        await state.space.wait_for(lambda: not state.c_line or not state.flag)
+
+
+async def _reader(s, state, emit, total):
+    """ Drains grbl's responses and frees buffer space on every 'ok' or 'error' """
+    loop = asyncio.get_running_loop()
+    try:
+        await _read_responses(s, state, emit, total, loop)
+    except Exception:
+        async with state.space:
+            state.flag = False
+            state.space.notify_all() # Stops the writer, stream_gcode raises the error once it is done
+        raise
+
+
+async def _read_responses(s, state, emit, total, loop):
+    """ Handles grbl's responses until the stream is done, see _reader """
+    while not state.done:
+        out_temp = await loop.run_in_executor(None, s.readline)
+        out_temp = out_temp.strip().decode(errors='replace')
+        if not out_temp:
+            continue
+
+        if out_temp.find('ALARM') > -1:
+            async with state.space:
+                state.flag = False
+                state.space.notify_all() # Stops the writer
+            if state.journal is not None:
+                state.journal.stop()
+            emit({'type': 'alarm', 'line': state.c_block[0][0] if state.c_block else state.sent,
+                  'response': out_temp})
+        elif state.monitor is not None and status.is_status(out_temp):
+            emit(stream.status_event(state.monitor, out_temp, state.acked))
+        elif out_temp.find('ok') < 0 and out_temp.find('error') < 0:
+            emit({'type': 'message', 'text': out_temp}) # Debug response
+        elif state.c_line:
+            async with state.space:
+                line, l_block = state.c_block.popleft()
+                state.buffered -= state.c_line.popleft()
+                state.acked += 1
+                state.space.notify_all()
+            if state.journal is not None:
+                state.journal.ack(l_block)
+            if out_temp.find('error') > -1:
+                emit({'type': 'error', 'line': line, 'response': out_temp})
+            emit({'type': 'progress', 'sent': state.sent, 'acked': state.acked, 'total': total,
+                  'buffer': state.buffered, 'block': l_block, 'response': out_temp + str(state.acked)})
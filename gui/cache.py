@@ -0,0 +1,339 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Content addressed cache of the files every pipeline stage makes, so a
+   job run again with the same image and options does not pay for the
+   conversion, tracing, STL conversion and slicing again.
+
+   The key of an artifact is the SHA-256 of the stage name, its options,
+   the version of the tool or code that makes it and the content of its
+   input files. Artifacts are stored under objects/cache by key, so
+   different inputs never share an output file, and a stage fed with the
+   artifact of an earlier one only runs again when that artifact or its
+   own options changed.
+
+   A 'manifest.json' lists every artifact with its stage, inputs, options,
+   statistics and last use. The inputs of an artifact made from another
+   one refer to it by key, which gives the lineage of every file back to
+   the source image. The least recently used artifacts are removed once
+   the cache grows past its size limit.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+import types
+
+import numpy
+
+from utils import parsers
+
+CACHE_DIRECTORY = os.path.join('objects', 'cache')
+MANIFEST = 'manifest.json'
+MANIFEST_VERSION = 1
+
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+
+HASH_CHUNK = 1 << 20
+
+
+def file_hash(filename):
+    """ Returns the hex SHA-256 of the content of a file """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tool_version(*paths):
+    """ Returns the version of the tools or source files that make an artifact
+
+    A file is known by its content when it is small like a Python module, by its size and
+    modification time when it is a large executable. Missing files count as empty.
+    """
+    parts = []
+    for path in paths:
+        try:
+            info = os.stat(path)
+        except (OSError, TypeError):
+            parts.append('{}:missing'.format(path))
+            continue
+        if info.st_size <= HASH_CHUNK:
+            parts.append('{}:{}'.format(os.path.basename(path), file_hash(path)))
+        else:
+            parts.append('{}:{}:{}'.format(os.path.basename(path), info.st_size, int(info.st_mtime)))
+    return '|'.join(parts)
+
+
+def source_version(*modules):
+    """ Returns the version of in process stages, the content of the modules they run and of
+    the modules of this program they import, directly or not
+    """
+    root = os.path.dirname(os.path.realpath(__file__))
+    found, pending = set(), list(modules)
+    while pending:
+        module = pending.pop()
+        filename = getattr(module, '__file__', None)
+        if not filename or filename in found or not os.path.realpath(filename).startswith(root + os.sep):
+            continue
+        found.add(filename)
+        pending.extend(value for value in vars(module).values() if isinstance(value, types.ModuleType))
+    return tool_version(*sorted(found))
+
+
+class ArtifactCache:
+    """ Stage outputs stored by the hash of everything they are made from """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        """
+        :param directory: Directory of the artifacts and the manifest, made if needed
+        :param max_size: Size in bytes the artifacts are kept under, None for no limit
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.manifest_path = os.path.join(directory, MANIFEST)
+        self.manifest = self._read_manifest()
+
+    def key(self, stage, inputs, options=None, version=''):
+        """ Returns the key of the artifact a stage makes from its input files, options and version """
+        description = {'stage': stage, 'version': version, 'options': options,
+                       'inputs': [self.input_id(filename) for filename in inputs]}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=_plain).encode('utf-8')).hexdigest()
+
+    def input_id(self, filename):
+        """ Returns what an input file is known by, its key if it is an artifact, else the hash of its content
+
+        The hash of a source file is kept in the manifest with its size and modification time,
+        so unchanged files are not read again.
+        """
+        key = self.key_of(filename)
+        if key is not None:
+            return {'artifact': key}
+
+        filename = os.path.abspath(filename)
+        info = os.stat(filename)
+        known = self.manifest['files'].get(filename)
+        if known is None or known['size'] != info.st_size or known['mtime'] != info.st_mtime:
+            known = {'size': info.st_size, 'mtime': info.st_mtime, 'sha256': file_hash(filename)}
+            self.manifest['files'][filename] = known
+        return {'file': os.path.basename(filename), 'sha256': known['sha256']}
+
+    def path(self, key, extension=''):
+        """ Returns the file of an artifact, in a sub directory named after the first characters of the key """
+        return os.path.join(self.directory, key[:2], key + extension)
+
+    def key_of(self, filename):
+        """ Returns the key of an artifact file of this cache, None for any other file """
+        filename = os.path.abspath(filename)
+        if os.path.dirname(os.path.dirname(filename)) != os.path.abspath(self.directory):
+            return None
+        key = os.path.splitext(os.path.basename(filename))[0]
+        return key if key in self.manifest['artifacts'] else None
+
+    def lookup(self, key):
+        """ Returns the file and the statistics of an artifact, marking it used, or None if it is not cached """
+        entry = self.manifest['artifacts'].get(key)
+        if entry is None:
+            return None
+        filename = self.path(key, entry['extension'])
+        if not os.path.isfile(filename):
+            self._forget(key)
+            return None
+        entry['used'] = time.time()
+        self._write_manifest()
+        return filename, entry['stats']
+
+    def store(self, key, filename, stage, inputs, options=None, version='', stats=None):
+        """ Moves a stage output into the cache and records it
+
+        :param filename: The file the stage wrote
+        :param inputs: The input files, recorded as the lineage of the artifact
+        :returns The file of the artifact
+        """
+        extension = os.path.splitext(filename)[1]
+        file_out = self.path(key, extension)
+        os.makedirs(os.path.dirname(file_out), exist_ok=True)
+        if os.path.abspath(filename) != os.path.abspath(file_out):
+            shutil.move(filename, file_out)
+
+        now = time.time()
+        self.manifest['artifacts'][key] = {
+            'stage': stage, 'extension': extension, 'size': os.path.getsize(file_out), 'version': version,
+            'options': json.loads(json.dumps(options, default=_plain)),
+            'inputs': [self.input_id(name) for name in inputs],
+            'stats': json.loads(json.dumps(stats, default=_plain)), 'created': now, 'used': now}
+        self.evict(keep=key)
+        self._write_manifest()
+        return file_out
+
+    def staging_path(self, key, extension=''):
+        """ Returns the file a stage writes its output to before it is stored """
+        path = self.path(key, '.tmp{}'.format(extension))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def lineage(self, key):
+        """ Returns the entries of an artifact and of the artifacts it was made from, the artifact first """
+        chain, pending = [], [key]
+        while pending:
+            key = pending.pop(0)
+            entry = self.manifest['artifacts'].get(key)
+            if entry is None:
+                continue
+            chain.append(dict(entry, key=key))
+            pending.extend(item['artifact'] for item in entry['inputs'] if 'artifact' in item)
+        return chain
+
+    def size(self):
+        """ Returns the size in bytes of the artifacts """
+        return sum(entry['size'] for entry in self.manifest['artifacts'].values())
+
+    def evict(self, keep=None):
+        """ Removes the least recently used artifacts until the cache is under its size limit
+
+        :param keep: Key of an artifact that stays, the one just stored
+        :returns The keys of the removed artifacts
+        """
+        if self.max_size is None:
+            return []
+        removed = []
+        total = self.size()
+        by_use = sorted(self.manifest['artifacts'].items(), key=lambda item: item[1]['used'])
+        for key, entry in by_use:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            total -= entry['size']
+            self._forget(key)
+            removed.append(key)
+        if removed:
+            self._write_manifest()
+        return removed
+
+    def clear(self):
+        """ Removes every artifact """
+        for key in list(self.manifest['artifacts']):
+            self._forget(key)
+        self._write_manifest()
+
+    def _forget(self, key):
+        """ Removes an artifact and the files kept next to it, like its program cache """
+        entry = self.manifest['artifacts'].pop(key)
+        filename = self.path(key, entry['extension'])
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            if name.startswith(key):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError as e:
+                    print(e)
+        if not os.listdir(directory):
+            os.rmdir(directory)
+
+    def _read_manifest(self):
+        """ Returns the manifest on disk, an empty one if there is none or it is from another version """
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            manifest = {'version': MANIFEST_VERSION, 'artifacts': {}, 'files': {}}
+        return manifest
+
+    def _write_manifest(self):
+        """ Writes the manifest through a temporary file so it is never left half written """
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.manifest_path)
+
+
+def open_cache(path):
+    """ Returns the ArtifactCache of the artifact_cache key of config.json, None when it is disabled
+
+    :param path: The directory of config.json, the cache is in its objects directory
+    """
+    try:
+        options = parsers.get_from_config('artifact_cache', path)
+    except KeyError:
+        return None
+    if not options or not options.get('enabled'):
+        return None
+    max_size = options.get('max_size_mb')
+    return ArtifactCache(os.path.join(path, CACHE_DIRECTORY), None if max_size is None else max_size * 1024 ** 2)
+
+
+class UncachedOutput(Exception):
+    """ Raised by the build of a stage whose output can be used but is not trusted enough to be cached """
+
+
+def run_stage(cache, stage, file_out, inputs, build, options=None, version=''):
+    """ Returns the output of a stage from the cache, running the stage only when it is not there
+
+    :param cache: ArtifactCache or None to always run the stage
+    :param file_out: The file the stage writes without the cache, it gives the extension
+    :param inputs: The input files of the stage
+    :param build: Function writing the output to the file it is given and returning the
+    statistics dict, or None. It raises when the stage fails, what it wrote is then removed,
+    or UncachedOutput to use what it wrote without storing it.
+    :returns The output file, the statistics dict and whether the cache was hit
+    """
+    if cache is None:
+        try:
+            return file_out, build(file_out), False
+        except UncachedOutput as e:
+            print(e)
+            return file_out, None, False
+
+    key = cache.key(stage, inputs, options, version)
+    found = cache.lookup(key)
+    if found is not None:
+        return found[0], found[1], True
+
+    staging = cache.staging_path(key, os.path.splitext(file_out)[1])
+    if os.path.isfile(staging):
+        os.remove(staging)
+    try:
+        stats = build(staging)
+    except UncachedOutput as e:
+        print(e)
+        if not os.path.isfile(staging):
+            raise OSError('{} did not write {}'.format(stage, staging))
+        shutil.move(staging, file_out)
+        return file_out, None, False
+    except Exception:
+        if os.path.isfile(staging):
+            os.remove(staging)
+        raise
+    if not os.path.isfile(staging):
+        raise OSError('{} did not write {}'.format(stage, staging))
+    return cache.store(key, staging, stage, inputs, options, version, stats), stats, False
+
+
+def _plain(value):
+    """ Turns the NumPy values of statistics and options into JSON types """
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    if isinstance(value, numpy.generic):
+        return value.item()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
@@ -16,8 +16,21 @@
 """ Contains all the functions for subprocess calls """
 import subprocess
 import os
+import numpy
+import cache
 from utils import parsers
-from tkinter import messagebox
+from gcode import arcs
+from gcode import estimator
+from gcode import reorder
+from gcode import simplify
+from gcode import validation
+from geometry import pointcloud
+from geometry import toolpaths
+from geometry import transform
+from imaging import bitmap
+from imaging import contours
+from imaging import depthmap
+from imaging import raster
 
 
 def exec_imagemagick(filepath, negate, line='', filetype=None, filename=None):
@@ -37,16 +50,129 @@ def exec_imagemagick(filepath, negate, line='', filetype=None, filename=None):
     if not convert_path:
         return '', False
 
-    if os.path.isfile(file_out):
-        os.remove(file_out)
+    def build(file_out):
+        if os.path.isfile(file_out):
+            os.remove(file_out)
 
-    if negate:
-        command = '"{}" "{}" -monochrome -negate "{}" {}'.format(convert_path, filename, file_out, line)
-    else:
-        command = '"{}" "{}" -monochrome "{}" {}'.format(convert_path, filename, file_out, line)
-    print(command)
-    result = subprocess.run(command, universal_newlines=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        if negate:
+            command = '"{}" "{}" -monochrome -negate "{}" {}'.format(convert_path, filename, file_out, line)
+        else:
+            command = '"{}" "{}" -monochrome "{}" {}'.format(convert_path, filename, file_out, line)
+        print(command)
+        result = subprocess.run(command, universal_newlines=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        _check_tool('convert', result)
 
+    try:
+        file_out, stats = _run_stage('imagemagick', file_out, [filename], build,
+                                     {'negate': negate, 'line': line}, cache.tool_version(convert_path))
+    except Exception as e:
+        print(e)
+        return file_out, False
+
+    return file_out, os.path.isfile(file_out)
+
+
+def execute_bitmap(filepath, negate, filetype=None, filename=None):
+    """ Converts the image to a monochrome bitmap in process, replaces exec_imagemagick
+
+    The method ('threshold', 'otsu', 'floyd-steinberg' or 'ordered') and the threshold come
+    from the bitmap key of config.json.
+
+    :returns The bitmap file and the result
+    """
+    if filename is None:
+        return '', False
+
+    name = filename.split('\\')
+    name = name[len(name)-1].split('.')[0]
+    file_out = os.path.join(filepath, '{}{}'.format(name, filetype))
+
+    try:
+        options = parsers.get_from_config('bitmap', os.path.dirname(os.path.realpath(__file__)))
+        file_out, stats = _run_stage('bitmap', file_out, [filename], lambda file_out: bitmap.convert_file(
+            filename, file_out, options['method'], options['threshold'], negate)[1], dict(options, negate=negate),
+            cache.source_version(bitmap))
+    except Exception as e:
+        print(e)
+        return file_out, False
+
+    print('Bitmap: {} x {} {}, {} black pixels'.format(stats['width'], stats['height'], stats['method'],
+                                                        stats['black']))
+    return file_out, os.path.isfile(file_out)
+
+
+def execute_raster(filepath, filename=None):
+    """ Etches the bitmap row by row at one depth, skipping tracing, STL conversion and slicing
+
+    The image is fitted into the bed_shape of the Slic3r config.ini and centered on it. The
+    dpi, the Z depth in mm and the feed in mm/min come from the raster key of config.json.
+
+    :returns The gcode file and the result
+    """
+    if filename is None:
+        return '', False
+
+    name = filename.split('\\')
+    name = name[len(name)-1].split('.')[0]
+    file_out = os.path.join(filepath, '{}.gcode'.format(name))
+
+    path = os.path.dirname(os.path.realpath(__file__))
+    try:
+        options = parsers.get_from_config('raster', path)
+        bed = validation.parse_bed_shape(parsers.get_from_ini('bed_shape', path))
+        low, high = bed.min(axis=0), bed.max(axis=0)
+        start_gcode = _start_gcode(path)
+        file_out, stats = _run_stage('raster', file_out, [filename], lambda file_out: raster.raster_file(
+            filename, file_out, dpi=options['dpi'], depth=options['depth'], size=tuple(high - low),
+            center=tuple((low + high) / 2), feed=options['feed'], start_gcode=start_gcode)[1],
+            dict(options, bed=bed, start_gcode=start_gcode), cache.source_version(raster))
+    except Exception as e:
+        print(e)
+        return file_out, False
+
+    print('Raster: {} x {} pixels, {} runs over {} rows, {} lines'.format(
+        stats['width'], stats['height'], stats['runs'], stats['rows'], stats['lines_out']))
+    return file_out, os.path.isfile(file_out)
+
+
+def execute_depthmap(filename, filepath, x, y, z):
+    """ Etches the grayscale image as a 3D point cloud, skipping conversion, tracing, STL conversion and slicing
+
+    The image is fitted in the x by y inches of the object, centered on the bed like the
+    other engines, and the relief is centered in its z inches. The mode, the pitch, the
+    relief height, the smoothing, the gray levels and the etch feed come from the depthmap
+    key of config.json, the start blocks from the start_gcode of the Slic3r config.ini.
+
+    :returns The gcode file and the result
+    """
+    if filename is None:
+        return '', False
+
+    name = filename.split('\\')
+    name = name[len(name) - 1].split('.')[0]
+    file_out = os.path.join(filepath, '{}.gcode'.format(name))
+
+    path = os.path.dirname(os.path.realpath(__file__))
+    try:
+        options = parsers.get_from_config('depthmap', path)
+        start_gcode = _start_gcode(path)
+
+        def build(file_out):
+            return depthmap.depthmap_file(filename, file_out, size=(25.4 * x, 25.4 * y), height=25.4 * z,
+                                          relief=options['relief'], pitch=options['pitch'], mode=options['mode'],
+                                          smoothing=options['smoothing'], levels=options['levels'],
+                                          negate=options['negate'], center=(25.4 * x / 2, 25.4 * y / 2),
+                                          etch_feed=options['etch_feed'], start_gcode=start_gcode)[1]
+
+        file_out, stats = _run_stage('depthmap', file_out, [filename], build,
+                                     dict(options, volume=(x, y, z), start_gcode=start_gcode),
+                                     cache.source_version(depthmap))
+    except Exception as e:
+        print(e)
+        return file_out, False
+
+    print('Depth map: {} x {} points, {} points in {} runs over {} layers, {} lines'.format(
+        stats['width'], stats['height'], stats['points'], stats['runs'], stats['layers'], stats['lines_out']))
     return file_out, os.path.isfile(file_out)
 
 
@@ -67,14 +193,110 @@ def exec_potrace(filepath, line='', filename=None):
     if not potrace_path:
         return '', False
 
-    if os.path.isfile(file_out):
-        os.remove(file_out)
+    def build(file_out):
+        if os.path.isfile(file_out):
+            os.remove(file_out)
+
+        command = '"{}" -s "{}" -o "{}" --flat {}'.format(potrace_path, filename, file_out, line)
+        result = subprocess.run(command, universal_newlines=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        _check_tool('potrace', result)
+
+    try:
+        file_out, stats = _run_stage('potrace', file_out, [filename], build, {'line': line},
+                                     cache.tool_version(potrace_path))
+    except Exception as e:
+        print(e)
+        return file_out, False
+
+    return file_out, os.path.isfile(file_out)
+
+def execute_trace(filepath, filename=None):
+    """ Traces the black regions of the bitmap into an SVG file in process, replaces exec_potrace
+
+    The smoothing iterations and the simplification tolerance in pixels come from the
+    tracing key of config.json.
+
+    :returns The SVG file and the result
+    """
+    if filename is None:
+        return '', False
+
+    name = filename.split('\\')
+    name = name[len(name)-1].split('.')[0]
+    file_out = os.path.join(filepath, '{}{}'.format(name, '.svg'))
+
+    try:
+        options = parsers.get_from_config('tracing', os.path.dirname(os.path.realpath(__file__)))
+
+        def build(file_out):
+            black = bitmap.threshold(bitmap.gray(filename))
+            return contours.trace_file(black, file_out, smoothing=options['smoothing'],
+                                       tolerance=options['tolerance'])[2]
 
-    command = '"{}" -s "{}" -o "{}" --flat {}'.format(potrace_path, filename, file_out, line)
-    result = subprocess.run(command, universal_newlines=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        file_out, stats = _run_stage('trace', file_out, [filename], build, options,
+                                     cache.source_version(bitmap, contours))
+    except Exception as e:
+        print(e)
+        return file_out, False
 
+    print('Trace: {} shapes with {} holes, {} vertices'.format(stats['shapes'], stats['holes'], stats['vertices']))
     return file_out, os.path.isfile(file_out)
 
+
+def execute_extrusion(filename, filepath, x, y, z, extrusion):
+    """ Traces the bitmap and etches its shapes extruded to the extrusion depth, replaces the SVG,
+    the STL conversion, the scaling and the slicing
+
+    The traced shapes, in pixels, and the extrusion depth are scaled like execute_scale_stl
+    scales the STL of the extruded SVG into the x, y, z inches, with the scale and grow of the
+    stl_fit key of config.json, and centered on the bed. The layers are cut and filled like
+    execute_native_slicer does with the settings of the Slic3r config.ini. The SVG of the shapes
+    is only written, next to the gcode, when the svg of the tracing key of config.json is true.
+
+    :returns The gcode file and the result
+    """
+    name = filename.split('\\')
+    name = name[len(name) - 1].split('.')[0]
+    file_out = os.path.join(filepath, '{}.gcode'.format(name))
+    svg_out = os.path.join(filepath, '{}.svg'.format(name))
+
+    path = os.path.dirname(os.path.realpath(__file__))
+    try:
+        tracing = parsers.get_from_config('tracing', path)
+        fit = parsers.get_from_config('stl_fit', path)
+        options = _slicer_options(path, x, y)
+
+        def build(file_out):
+            black = bitmap.threshold(bitmap.gray(filename))
+            shapes = contours.trace(black, smoothing=tracing['smoothing'], tolerance=tracing['tolerance'])
+            if tracing.get('svg'):
+                contours.write_svg(svg_out, shapes, black.shape[1], black.shape[0])
+
+            polygons = contours.polygons(shapes)
+            if not polygons:
+                raise ValueError('There are no black shapes to etch in {}'.format(filename))
+            points = numpy.concatenate(polygons)
+            size = numpy.append(points.max(axis=0) - points.min(axis=0), extrusion)
+            factors = transform.scale_factors(size, (25.4 * x, 25.4 * y, 25.4 * z), fit['scale'], fit['grow'])
+            stats = toolpaths.extrude_file([polygon * factors[:2] for polygon in polygons], file_out,
+                                           extrusion * factors[2], **options)[1]
+            stats['shapes'] = len(shapes)
+            stats['holes'] = sum(len(holes) for outer, holes in shapes)
+            return stats
+
+        file_out, stats = _run_stage('extrusion', file_out, [filename], build,
+                                     dict(options, tracing=tracing, fit=fit, volume=(x, y, z), extrusion=extrusion),
+                                     cache.source_version(bitmap, contours, toolpaths, transform))
+    except Exception as e:
+        print(e)
+        return file_out, False
+
+    print('Extrusion: {} shapes with {} holes, {} contours and {} fill lines over {} layers, {} lines'.format(
+        stats['shapes'], stats['holes'], stats['contours'], stats['fill_lines'], stats['layers'],
+        stats['lines_out']))
+    return file_out, os.path.isfile(file_out)
+
+
 def stl_conversion(root, filename, filepath, extrusion):
     """ Converts the SVG file to a STL file by using the FreeCad script
 
@@ -84,23 +306,32 @@ def stl_conversion(root, filename, filepath, extrusion):
     name = name[len(name)-1].split('.')[0]
     file_out = os.path.join(filepath, '{}.stl'.format(name))
 
-    if os.path.isfile(file_out):
-        os.remove(file_out)
-
     path = os.path.dirname(os.path.realpath(__file__))
     script = '{}\\stl.py'.format(path)
 
-    command = 'python2 "{}" -i "{}" -o "{}" -e {}'.format(script, filename, file_out, extrusion)
-    messagebox.showinfo('Caution', 'This process may take a few minutes to run.\nPress OK to continue')
+    def build(file_out):
+        if os.path.isfile(file_out):
+            os.remove(file_out)
+
+        command = 'python2 "{}" -i "{}" -o "{}" -e {}'.format(script, filename, file_out, extrusion)
+
+        # Terrible exception handling but there is a bug that occasionally occurs
+        # This bug has nothing to do with STL creation process and only with the
+        # STDOUT/STDERR handling so the STL written is used, only not cached
+        try:
+            result = subprocess.run(command, universal_newlines=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE, shell=True)
+        except Exception as e:
+            if os.path.isfile(file_out):
+                raise cache.UncachedOutput(e)
+            raise OSError('FreeCAD did not write {}: {}'.format(file_out, e))
+        _check_tool('FreeCAD', result)
 
-    # Terrible exception handling but there is a bug that occasionally occurs
-    # This bug has nothing to do with STL creation process and only with the
-    # STDOUT/STDERR handling so it can be safely ignored
     try:
-        result = subprocess.run(command, universal_newlines=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE, shell=True)
+        file_out, stats = _run_stage('stl', file_out, [filename], build, {'extrusion': extrusion},
+                                     cache.tool_version(os.path.join(path, 'stl.py')))
     except Exception as e:
         print(e)
-        pass
+        return file_out, False
 
     return file_out, os.path.isfile(file_out)
 
@@ -117,41 +348,279 @@ def execute_slic3r(filename, filepath, x ,y):
     x = 25.4 * x / 2
     y = 25.4 * y / 2
 
-    if os.path.isfile(file_out):
-        os.remove(file_out)
-
     slicer = parsers.get_from_config('slic3r_path', os.path.dirname(os.path.realpath(__file__)))
     config = os.path.dirname(os.path.realpath(__file__)) + '\\config.ini'
 
-    command = '"{}" --load "{}" "{}" --print-center {},{}'.format(slicer, config, filename, x, y)
-    print(command)
-    result = subprocess.run(command, universal_newlines=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE,
-                            shell=True)
+    def build(file_out):
+        if os.path.isfile(file_out):
+            os.remove(file_out)
 
+        command = '"{}" --load "{}" "{}" --print-center {},{} --output "{}"'.format(slicer, config, filename, x, y,
+                                                                                    file_out)
+        print(command)
+        result = subprocess.run(command, universal_newlines=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE,
+                                shell=True)
+        _check_tool('Slic3r', result)
+
+    try:
+        file_out, stats = _run_stage('slic3r', file_out, [filename, config], build, {'center': (x, y)},
+                                     cache.tool_version(slicer))
+    except Exception as e:
+        print(e)
+        return file_out, False
+
+    return file_out, os.path.isfile(file_out)
+
+
+def execute_pointcloud(filename, filepath, x, y):
+    """ Generates the etch points of the STL object in process, replaces Slic3r
+
+    The grid pitch, the fill and the etch feed come from the pointcloud key of config.json,
+    the start blocks from the start_gcode of the Slic3r config.ini. The object is centered
+    on the bed like Slic3r's --print-center. Layers are cut by slicer_workers processes,
+    all the cores when null.
+
+    :returns The gcode file and the result
+    """
+    name = filename.split('\\')
+    name = name[len(name) - 1].split('.')[0]
+    file_out = os.path.join(filepath, '{}.gcode'.format(name))
+
+    path = os.path.dirname(os.path.realpath(__file__))
+    try:
+        options = parsers.get_from_config('pointcloud', path)
+        start_gcode = _start_gcode(path)
+
+        def build(file_out):
+            return pointcloud.pointcloud_file(filename, file_out, pitch=options['pitch'], fill=options['fill'],
+                                              center=(25.4 * x / 2, 25.4 * y / 2), etch_feed=options['etch_feed'],
+                                              start_gcode=start_gcode,
+                                              workers=parsers.get_from_config('slicer_workers', path))[1]
+
+        # The output is the same for any number of workers, they are not part of the key
+        file_out, stats = _run_stage('pointcloud', file_out, [filename], build,
+                                     dict(options, center=(x, y), start_gcode=start_gcode),
+                                     cache.source_version(pointcloud))
+    except Exception as e:
+        print(e)
+        return file_out, False
+
+    print('Point cloud: {} points in {} runs over {} layers, {} lines'.format(
+        stats['points'], stats['runs'], stats['layers'], stats['lines_out']))
+    return file_out, os.path.isfile(file_out)
+
+
+def execute_native_slicer(filename, filepath, x, y):
+    """ Slices the STL object into outline and fill gcode in process, replaces Slic3r
+
+    Layer height, fill density and angle, nozzle diameter, speeds and start blocks are read
+    from the Slic3r config.ini so both slicers follow the same settings, see _slicer_options.
+    The object is centered like Slic3r's --print-center. Layers are sliced by the
+    slicer_workers processes of config.json, all the cores when null.
+
+    :returns The gcode file and the result
+    """
+    name = filename.split('\\')
+    name = name[len(name) - 1].split('.')[0]
+    file_out = os.path.join(filepath, '{}.gcode'.format(name))
+
+    path = os.path.dirname(os.path.realpath(__file__))
+    try:
+        options = _slicer_options(path, x, y)
+        file_out, stats = _run_stage('slicer', file_out, [filename], lambda file_out: toolpaths.slice_file(
+            filename, file_out, workers=parsers.get_from_config('slicer_workers', path), **options)[1], options,
+            cache.source_version(toolpaths))
+    except Exception as e:
+        print(e)
+        return file_out, False
+
+    print('Slicer: {} contours ({} open) and {} fill lines over {} layers, {} lines'.format(
+        stats['contours'], stats['open_contours'], stats['fill_lines'], stats['layers'], stats['lines_out']))
     return file_out, os.path.isfile(file_out)
 
 
 def execute_scale_stl(filename, filepath, x, y, z):
-    """ Executes the scaling of an STL file via Freecad """
+    """ Fits the STL object into the etching volume
+
+    The limits are in inches. The scale ('uniform' or 'axis'), whether small objects grow
+    and whether the best orientation is searched come from the stl_fit key of config.json.
+    The STL file is overwritten, unless the artifact cache is enabled, which keeps the
+    fitted object apart from the one it was made from.
+
+    :returns The fitted STL file and the result
+    """
+    limits = (x * 25.4, y * 25.4, z * 25.4)
+    try:
+        options = parsers.get_from_config('stl_fit', os.path.dirname(os.path.realpath(__file__)))
+        file_out, stats = _run_stage('fit', filename, [filename], lambda file_out: transform.fit_file(
+            filename, limits, file_out, scale=options['scale'], grow=options['grow'], orient=options['orient'])[1],
+            dict(options, limits=limits), cache.source_version(transform))
+    except Exception as e:
+        print(e)
+        return filename, False
+
+    print('Fit: {:.2f} x {:.2f} x {:.2f} mm to {:.2f} x {:.2f} x {:.2f} mm'.format(
+        *(stats['size_before'] + stats['size_after'])))
+    return file_out, True
+
+
+def execute_arc_fitting(filename, tolerance=None):
+    """ Replaces runs of G1 segments in the sliced gcode by G2/G3 arcs
+
+    The tolerance in mm is read from the arc_tolerance key of config.json when not given,
+    null in the config disables the stage.
+
+    :returns The gcode file to use, the statistics dict (None if the stage is disabled) and the result
+    """
+    if tolerance is None:
+        tolerance = parsers.get_from_config('arc_tolerance', os.path.dirname(os.path.realpath(__file__)))
+    if tolerance is None:
+        return filename, None, True
+
+    try:
+        name, ext = os.path.splitext(filename)
+        file_out, stats = _run_stage('arcs', '{}.arcs{}'.format(name, ext), [filename], lambda file_out: arcs.fit_file(
+            filename, file_out, tolerance=tolerance)[1], {'tolerance': tolerance}, cache.source_version(arcs))
+    except Exception as e:
+        print(e)
+        return filename, None, False
+
+    print('Arc fitting: {} lines in, {} lines out, {} arcs replaced {} segments'.format(
+        stats['lines_in'], stats['lines_out'], stats['arcs'], stats['segments_replaced']))
+    return file_out, stats, os.path.isfile(file_out)
+
+
+def execute_simplify(filename, tolerance=None):
+    """ Simplifies the G1 polylines of the sliced gcode with the Douglas-Peucker algorithm
+
+    The tolerance in mm is read from the simplify_tolerance key of config.json when not given,
+    null in the config disables the stage.
+
+    :returns The gcode file to use, the statistics dict (None if the stage is disabled) and the result
+    """
+    if tolerance is None:
+        tolerance = parsers.get_from_config('simplify_tolerance', os.path.dirname(os.path.realpath(__file__)))
+    if tolerance is None:
+        return filename, None, True
+
+    try:
+        name, ext = os.path.splitext(filename)
+        file_out, stats = _run_stage('simplify', '{}.simple{}'.format(name, ext), [filename], lambda file_out: (
+            simplify.simplify_file(filename, file_out, tolerance=tolerance)[1]), {'tolerance': tolerance},
+            cache.source_version(simplify))
+    except Exception as e:
+        print(e)
+        return filename, None, False
+
+    print('Simplify: {} vertices in, {} vertices out, max deviation {:.4f} mm'.format(
+        stats['vertices_in'], stats['vertices_out'], stats['max_deviation']))
+    return file_out, stats, os.path.isfile(file_out)
+
+
+def execute_reorder(filename):
+    """ Reorders the etch segments of every layer of the sliced gcode to shorten the travel moves
+
+    Enabled by the reorder_toolpaths key of config.json. Travel moves are recognized by the
+    travel_speed of the Slic3r config.ini.
+
+    :returns The gcode file to use, the statistics dict (None if the stage is disabled) and the result
+    """
     path = os.path.dirname(os.path.realpath(__file__))
-    script = '{}\\stl.py'.format(path)
+    if not parsers.get_from_config('reorder_toolpaths', path):
+        return filename, None, True
+
+    try:
+        travel_feed = float(parsers.get_from_ini('travel_speed', path)) * 60
+        name, ext = os.path.splitext(filename)
+        file_out, stats = _run_stage('reorder', '{}.reorder{}'.format(name, ext), [filename],
+                                     lambda file_out: reorder.reorder_file(filename, travel_feed, file_out)[1],
+                                     {'travel_feed': travel_feed}, cache.source_version(reorder))
+    except Exception as e:
+        print(e)
+        return filename, None, False
+
+    print('Reorder: travel {:.1f} mm ({:.1f} s) before, {:.1f} mm ({:.1f} s) after'.format(
+        stats['travel_before'], stats['time_before'], stats['travel_after'], stats['time_after']))
+    return file_out, stats, os.path.isfile(file_out)
+
+
+def execute_estimate(filename):
+    """ Estimates how long etching the gcode takes with grbl's acceleration planner
 
-    x = x * 25.4
-    y = y * 25.4
-    z = z * 25.4
-    print(x, y, z)
+    The machine is described by the machine_profile key of config.json. G1 moves at the
+    travel_speed of the Slic3r config.ini count as travel.
+
+    :returns The estimate dict and the result
+    """
+    path = os.path.dirname(os.path.realpath(__file__))
+    try:
+        travel_speed = parsers.get_from_ini('travel_speed', path)
+        travel_feed = float(travel_speed) * 60 if travel_speed is not None else None
+        result = estimator.estimate_file(filename, parsers.get_from_config('machine_profile', path), travel_feed)
+    except Exception as e:
+        print(e)
+        return None, False
+
+    print('Estimate: {:.0f} s total, {:.0f} s etching, {:.0f} s travel over {} layers'.format(
+        result['total_time'], result['etch_time'], result['travel_time'], len(result['layers'])))
+    return result, True
 
-    command = 'python2 "{}" -i "{}" -o "None" -s 1 -x {} -y {} -z {}'.format(script, filename, x, y, z)
-    print(command)
 
-    # Terrible exception handling but there is a bug that occasionally occurs
-    # This bug has nothing to do with STL creation process and only with the
-    # STDOUT/STDERR handling so it can be safely ignored
+def execute_validation(filename):
+    """ Checks every move of the gcode against the bed_shape of the Slic3r config.ini and the
+    z_limits of the machine_profile in config.json
+
+    :returns The report dict (None if the check could not run) and the result
+    """
+    path = os.path.dirname(os.path.realpath(__file__))
     try:
-        result = subprocess.run(command, universal_newlines=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE,
-                                shell=True)
+        bed = validation.parse_bed_shape(parsers.get_from_ini('bed_shape', path))
+        z_limits = parsers.get_from_config('machine_profile', path).get('z_limits')
+        report = validation.validate_file(filename, bed, z_limits)
     except Exception as e:
         print(e)
-        pass
+        return None, False
+
+    print('Validation: {} moves, {} outside the bed, {} rejected and {} unsupported lines'.format(
+        report['moves'], report['outside_count'], report['invalid_count'], report['unsupported_count']))
+    return report, report['result']
 
-    return True
+
+def _slicer_options(path, x, y):
+    """ Returns the toolpaths options of the Slic3r config.ini, centered on the bed of the x by y inches
+
+    The fill lines are nozzle_diameter / fill_density apart.
+    """
+    density = float(parsers.get_from_ini('fill_density', path).rstrip('%')) / 100
+    spacing = float(parsers.get_from_ini('nozzle_diameter', path)) / density if density > 0 else None
+    return {'center': (25.4 * x / 2, 25.4 * y / 2),
+            'layer_height': float(parsers.get_from_ini('layer_height', path)),
+            'fill_spacing': spacing,
+            'fill_angle': float(parsers.get_from_ini('fill_angle', path)),
+            'outline_feed': float(parsers.get_from_ini('perimeter_speed', path)) * 60,
+            'fill_feed': float(parsers.get_from_ini('infill_speed', path)) * 60,
+            'start_gcode': _start_gcode(path)}
+
+
+def _start_gcode(path):
+    """ Returns the start_gcode blocks of the Slic3r config.ini, one per line, None if it has none """
+    start_gcode = parsers.get_from_ini('start_gcode', path)
+    return start_gcode.replace('\\n', '\n') if start_gcode is not None else None
+
+
+def _check_tool(tool, result):
+    """ Raises when an external tool exited with an error, so a partial output is never used or cached """
+    if result.returncode != 0:
+        raise OSError('{} exited with code {}: {}'.format(tool, result.returncode, (result.stdout or '').strip()))
+
+
+def _run_stage(stage, file_out, inputs, build, options=None, version=''):
+    """ Runs a stage through the artifact cache of config.json, see cache.run_stage
+
+    :returns The output file and the statistics dict
+    """
+    path = os.path.dirname(os.path.realpath(__file__))
+    file_out, stats, hit = cache.run_stage(cache.open_cache(path), stage, file_out, inputs, build, options, version)
+    if hit:
+        print('Cache: {} from {}'.format(stage, file_out))
+    return file_out, stats
@@ -0,0 +1,201 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Arc fitting post-processor. Curves traced by potrace reach the g-code
+   as hundreds of short 'G1 X.. Y..' segments. Runs of segments whose
+   points lie on a circle within a tolerance are replaced by a single
+   G2/G3 block, so grbl gets fewer and longer blocks through its 128 byte
+   RX buffer and its planner is less likely to run dry on curved artwork.
+
+   Only XY moves in absolute millimeter or inch mode with the XY plane
+   selected are fitted, every other block is passed through unchanged.
+"""
+import math
+import os
+from gcode import blocks
+from gcode import polylines
+
+# Maximum distance in program units between a fitted arc and the original points and segments
+DEFAULT_TOLERANCE = 0.01
+
+# Minimum number of segments replaced by one arc
+MIN_SEGMENTS = 3
+
+# Larger radii are left as line segments, grbl's arc math loses precision on them
+MAX_RADIUS = 1000.0
+
+# Decimals of the I and J center offsets
+CENTER_PRECISION = 4
+
+
+def new_stats():
+    """ Returns an empty statistics dict for fit_arcs """
+    return {'lines_in': 0, 'lines_out': 0, 'arcs': 0, 'segments_replaced': 0, 'lines_saved': 0}
+
+
+def fit_arcs(lines, tolerance=DEFAULT_TOLERANCE, stats=None):
+    """ Generator yielding the lines with runs of G1 segments replaced by arcs
+
+    Lines are yielded without their newline.
+
+    :param lines: Iterable of g-code lines, for example an open file
+    :param tolerance: Maximum deviation of an arc from the points and segments it replaces
+    :param stats: Optional dict from new_stats() updated while fitting
+    """
+    if stats is None:
+        stats = new_stats()
+
+    # The motion mode of the state follows the source blocks, emitted the one grbl is left in
+    state = polylines.new_state()
+    state['emitted'] = None
+
+    for kind, line, words in polylines.runs(lines, state, stats):
+        if kind == 'run':
+            for out in _fit_run(line, words, state, tolerance, stats):
+                yield out
+        else:
+            stats['lines_out'] += 1
+            yield _restore_motion(line, words, state)
+            if words:
+                codes = [blocks.format_code(value) for letter, value in words if letter == 'G']
+                if any(code in blocks.MOTION_MODES for code in codes) and \
+                        not any(code in blocks.NON_MODAL for code in codes):
+                    state['emitted'] = None
+
+    stats['lines_saved'] = stats['lines_in'] - stats['lines_out']
+
+
+def fit_file(filename, file_out=None, tolerance=DEFAULT_TOLERANCE):
+    """ Writes the arc fitted version of a g-code file
+
+    :returns The output file and the statistics dict
+    """
+    if file_out is None:
+        name, ext = os.path.splitext(filename)
+        file_out = '{}.arcs{}'.format(name, ext)
+
+    stats = new_stats()
+    with open(filename, 'r') as f, open(file_out, 'w') as out:
+        for line in fit_arcs(f, tolerance, stats):
+            out.write(line + '\n')
+
+    return file_out, stats
+
+
+def _restore_motion(line, words, state):
+    """ Puts the motion mode back in front of a block relying on it after an arc changed it """
+    if not words or state['emitted'] is None or state['emitted'] == state['motion'] or state['motion'] is None:
+        return line
+    codes = [blocks.format_code(value) for letter, value in words if letter == 'G']
+    if any(code in blocks.MOTION_MODES + blocks.NON_MODAL for code in codes):
+        return line
+    if not any(letter in blocks.AXES for letter, value in words):
+        return line
+    state['emitted'] = None
+    return 'G{} {}'.format(state['motion'], line)
+
+
+def _fit_run(start, run, state, tolerance, stats):
+    """ Generator yielding the blocks of a run of segments, fitted to arcs where possible """
+    points = [start] + [segment['point'] for segment in run]
+    i = 0
+    while i < len(run):
+        arc = None
+        j = i + MIN_SEGMENTS
+        while j <= len(run):
+            fitted = _fit(points[i:j + 1], tolerance)
+            if fitted is None:
+                break
+            arc = (j, fitted)
+            j += 1
+
+        stats['lines_out'] += 1
+        if arc is None:
+            line = run[i]['line']
+            if state['emitted'] not in (None, '1') and not any(letter == 'G' for letter, value in run[i]['words']):
+                line = 'G1 ' + line
+            state['emitted'] = '1'
+            yield line
+            i += 1
+            continue
+
+        j, (center, clockwise) = arc
+        code = '2' if clockwise else '3'
+        words = ['G' + code]
+        words += polylines.end_words(run[:j], points[j])
+        words.append('I' + blocks.format_number(center[0] - points[i][0], CENTER_PRECISION))
+        words.append('J' + blocks.format_number(center[1] - points[i][1], CENTER_PRECISION))
+        if run[i]['feed'] is not None:
+            words.append('F' + run[i]['feed'])
+
+        stats['arcs'] += 1
+        stats['segments_replaced'] += j - i
+        state['emitted'] = code
+        yield ' '.join(words)
+        i = j
+
+
+def _fit(points, tolerance):
+    """ Fits a circle through the first, middle and last point and checks all others
+
+    :returns (center, clockwise) or None if the points are not on an arc within the tolerance
+    """
+    center = _circle(points[0], points[len(points) // 2], points[-1])
+    if center is None:
+        return None
+
+    radius = math.hypot(points[0][0] - center[0], points[0][1] - center[1])
+    if radius > MAX_RADIUS:
+        return None
+
+    sweep = 0.0
+    direction = 0
+    for p, q in zip(points, points[1:]):
+        if abs(math.hypot(q[0] - center[0], q[1] - center[1]) - radius) > tolerance:
+            return None
+
+        chord = math.hypot(q[0] - p[0], q[1] - p[1])
+        if chord == 0.0 or chord > 2 * radius:
+            return None
+        # The segment bulges inwards from the arc by its sagitta
+        if radius - math.sqrt(max(radius * radius - chord * chord / 4, 0.0)) > tolerance:
+            return None
+
+        a = (p[0] - center[0], p[1] - center[1])
+        b = (q[0] - center[0], q[1] - center[1])
+        cross = a[0] * b[1] - a[1] * b[0]
+        turn = 1 if cross > 0 else -1
+        if direction and turn != direction:
+            return None
+        direction = turn
+        sweep += abs(math.atan2(cross, a[0] * b[0] + a[1] * b[1]))
+
+    if sweep >= 2 * math.pi - 1e-6:
+        return None
+    return center, direction < 0
+
+
+def _circle(a, b, c):
+    """ Returns the center of the circle through three points, None if they are collinear """
+    d = 2 * (a[0] * (b[1] - c[1]) + b[0] * (c[1] - a[1]) + c[0] * (a[1] - b[1]))
+    if abs(d) < 1e-12:
+        return None
+    a2 = a[0] * a[0] + a[1] * a[1]
+    b2 = b[0] * b[0] + b[1] * b[1]
+    c2 = c[0] * c[0] + c[1] * c[1]
+    x = (a2 * (b[1] - c[1]) + b2 * (c[1] - a[1]) + c2 * (a[1] - b[1])) / d
+    y = (a2 * (c[0] - b[0]) + b2 * (a[0] - c[0]) + c2 * (b[0] - a[0])) / d
+    return x, y
@@ -0,0 +1,98 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+""" Tokenizing and formatting of single g-code blocks """
+import re
+
+COMMENT = re.compile(r'\(.*?\)|;.*')
+WORD = re.compile(r'\s*([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))\s*')
+
+# Motion modes kept by grbl between blocks
+MOTION_MODES = ('0', '1', '2', '3', '38.2', '38.3', '38.4', '38.5', '80')
+
+# G commands that use the axis words of their block themselves
+NON_MODAL = ('4', '10', '28', '28.1', '30', '30.1', '53', '92', '92.1')
+
+# Fixed point texts of format_numbers, one number per line
+TRAILING_ZEROS = re.compile(r'\.?0+$', re.MULTILINE)
+LEADING_ZERO = re.compile(r'^(-?)0\.', re.MULTILINE)
+NEGATIVE_ZERO = re.compile(r'^-0$', re.MULTILINE)
+
+AXES = 'XYZ'
+COORDINATES = 'XYZIJKR'
+
+
+def strip_comments(line):
+    """ Removes parenthesis and semicolon comments along with surrounding whitespace """
+    return COMMENT.sub('', line).strip()
+
+
+def parse_block(line):
+    """ Splits a block into a list of (letter, value) string pairs
+
+    :returns None if the block is a '$' system command or contains anything that
+    is not a word, otherwise the list of words (empty for a blank block)
+    """
+    block = strip_comments(line).upper()
+    if block.startswith('$'):
+        return None
+
+    words = []
+    position = 0
+    while position < len(block):
+        match = WORD.match(block, position)
+        if match is None:
+            return None
+        words.append((match.group(1), match.group(2)))
+        position = match.end()
+
+    return words
+
+
+def format_number(value, precision):
+    """ Formats a number with at most precision decimals and no redundant characters
+
+    Trailing zeros and the leading zero of fractions are dropped, grbl reads '.5' and '-.5'
+    """
+    text = '{:.{}f}'.format(float(value), precision)
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    if text in ('', '-0', '-'):
+        return '0'
+    if text.startswith('0.'):
+        return text[1:]
+    if text.startswith('-0.'):
+        return '-' + text[2:]
+    return text
+
+
+def format_numbers(values, precision):
+    """ Formats a list of numbers like format_number, all at once """
+    if not len(values):
+        return []
+    text = '\n'.join(map('{{:.{}f}}'.format(precision).format, values))
+    if precision > 0:
+        text = TRAILING_ZEROS.sub('', text)
+    text = LEADING_ZERO.sub(r'\1.', text)
+    return NEGATIVE_ZERO.sub('0', text).split('\n')
+
+
+def format_code(value):
+    """ Formats a G or M code number, 'G01' becomes 'G1' and 'G38.2' is kept """
+    text = value.lstrip('+')
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    text = text.lstrip('0')
+    return text if text and not text.startswith('.') else '0' + text
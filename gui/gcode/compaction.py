@@ -0,0 +1,130 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Compacts g-code before it goes over the serial line. Comments and
+   whitespace are stripped, motion modes and feeds that are still in
+   effect are dropped and coordinates are trimmed to a fixed precision.
+   Every byte saved is one less byte competing for grbl's 128 byte RX
+   buffer at 115200 baud.
+"""
+import os
+from gcode import blocks
+
+DEFAULT_PRECISION = 3
+
+
+def new_stats():
+    """ Returns an empty statistics dict for compact """
+    return {'lines_in': 0, 'lines_out': 0, 'bytes_in': 0, 'bytes_out': 0, 'bytes_saved': 0}
+
+
+def compact(lines, precision=DEFAULT_PRECISION, stats=None):
+    """ Generator yielding the compacted blocks of the given lines
+
+    Blocks are yielded without their newline and blocks left empty are skipped.
+    System commands and blocks that are not made of words are passed through
+    with only their comments removed, grbl rejects the latter without changing state.
+
+    :param lines: Iterable of g-code lines, for example an open file
+    :param precision: Number of decimals kept for coordinates and feeds
+    :param stats: Optional dict from new_stats() updated while compacting
+    """
+    if stats is None:
+        stats = new_stats()
+
+    motion = None
+    feed = None
+    inverse_time = False
+
+    for line in lines:
+        stats['lines_in'] += 1
+        stats['bytes_in'] += len(line.rstrip('\r\n')) + 1
+
+        words = blocks.parse_block(line)
+        if words is None:
+            block = blocks.strip_comments(line)
+        else:
+            block, motion, feed, inverse_time = _compact_words(words, precision, motion, feed, inverse_time)
+
+        if not block:
+            continue
+
+        stats['lines_out'] += 1
+        stats['bytes_out'] += len(block) + 1
+        stats['bytes_saved'] = stats['bytes_in'] - stats['bytes_out']
+        yield block
+
+    stats['bytes_saved'] = stats['bytes_in'] - stats['bytes_out']
+
+
+def compact_file(filename, file_out=None, precision=DEFAULT_PRECISION):
+    """ Writes the compacted version of a g-code file
+
+    :returns The output file and the statistics dict
+    """
+    if file_out is None:
+        name, ext = os.path.splitext(filename)
+        file_out = '{}.compact{}'.format(name, ext)
+
+    stats = new_stats()
+    with open(filename, 'r') as f, open(file_out, 'w') as out:
+        for block in compact(f, precision, stats):
+            out.write(block + '\n')
+
+    return file_out, stats
+
+
+def _compact_words(words, precision, motion, feed, inverse_time):
+    """ Compacts the words of one block against the modal state
+
+    :returns The block text and the updated motion, feed and inverse time state
+    """
+    codes = [blocks.format_code(value) for letter, value in words if letter == 'G']
+    has_axes = any(letter in blocks.AXES for letter, value in words)
+    non_modal = any(code in blocks.NON_MODAL for code in codes)
+
+    for code in codes:
+        if code in ('20', '21'):
+            feed = None # Same feed number means another speed in other units
+        elif code == '93':
+            inverse_time = True
+        elif code == '94':
+            inverse_time = False
+
+    out = []
+    for letter, value in words:
+        if letter == 'G':
+            code = blocks.format_code(value)
+            if code in blocks.MOTION_MODES:
+                if code == motion and not non_modal:
+                    continue
+                if not (non_modal and has_axes):
+                    motion = code
+            out.append('G' + code)
+        elif letter == 'M':
+            out.append('M' + blocks.format_code(value))
+        elif letter == 'F':
+            number = blocks.format_number(value, precision)
+            if number == feed and not inverse_time:
+                continue
+            feed = number
+            out.append('F' + number)
+        elif letter in blocks.COORDINATES:
+            out.append(letter + blocks.format_number(value, precision))
+        else:
+            out.append(letter + value)
+
+    return ''.join(out), motion, feed, inverse_time
@@ -0,0 +1,239 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Predicts how long grbl takes to run a g-code program. Dividing the
+   path length by the feed badly underestimates etches made of thousands
+   of short segments, where the machine never reaches its feed.
+
+   The estimate follows grbl's planner: every move accelerates and
+   decelerates on a trapezoidal profile limited by the per axis maximum
+   rates and accelerations, and the speed through the corner between two
+   moves is limited by the junction deviation. The planner only looks a
+   few blocks ahead, so the machine must always be able to stop within
+   the blocks it holds. The forward and backward passes of the planner
+   are done on the whole program at once with running minimums.
+"""
+import numpy
+
+from gcode import program
+
+DEFAULT_PROFILE = {
+    'max_rate': [5000.0, 5000.0, 500.0],     # $110-$112, mm/min
+    'acceleration': [10.0, 10.0, 10.0],      # $120-$122, mm/s^2
+    'junction_deviation': 0.01,              # $11, mm
+    'planner_blocks': 15
+}
+
+# Directions closer than this to straight or reversed are treated as such, as grbl does
+COSINE_LIMIT = 0.999999
+
+
+def new_estimate():
+    """ Returns an empty estimate dict, times are in seconds and distances in mm """
+    return {'total_time': 0.0, 'etch_time': 0.0, 'travel_time': 0.0, 'dwell_time': 0.0,
+            'etch_distance': 0.0, 'travel_distance': 0.0, 'lines': 0, 'moves': 0, 'layers': []}
+
+
+def load_profile(profile=None):
+    """ Returns the machine profile with the missing keys taken from DEFAULT_PROFILE """
+    out = dict(DEFAULT_PROFILE)
+    if profile:
+        out.update(profile)
+    return out
+
+
+def estimate(prog, profile=None, travel_feed=None):
+    """ Estimates the run time of a Program
+
+    :param prog: The program.Program to estimate
+    :param profile: Machine profile dict, see DEFAULT_PROFILE
+    :param travel_feed: Feed in mm/min of the G1 travel moves, G0 moves are always travel
+    :returns The estimate dict, its layers are dicts of the z height and time of every layer
+    """
+    profile = load_profile(profile)
+    result = new_estimate()
+    result['lines'] = len(prog)
+    if not len(prog):
+        return result
+
+    moves = _moves(prog, profile, travel_feed)
+    result['dwell_time'] = float(numpy.nansum(prog.p[prog.command == program.DWELL]))
+    result['moves'] = len(moves['length'])
+    if not result['moves']:
+        result['total_time'] = result['dwell_time']
+        return result
+
+    times = _trapezoids(moves, _entry_speeds(moves, profile))
+    travel = moves['travel']
+    result['etch_time'] = float(times[~travel].sum())
+    result['travel_time'] = float(times[travel].sum())
+    result['etch_distance'] = float(moves['length'][~travel].sum())
+    result['travel_distance'] = float(moves['length'][travel].sum())
+    result['total_time'] = result['etch_time'] + result['travel_time'] + result['dwell_time']
+
+    z = moves['end'][:, 2]
+    layer = numpy.concatenate([[0], numpy.cumsum(z[1:] != z[:-1])])
+    layer_times = numpy.bincount(layer, weights=times)
+    first = numpy.flatnonzero(numpy.concatenate([[True], layer[1:] != layer[:-1]]))
+    result['layers'] = [{'z': float(z[index]), 'time': float(time)} for index, time in zip(first, layer_times)]
+    return result
+
+
+def estimate_file(filename, profile=None, travel_feed=None):
+    """ Estimates the run time of a g-code file, see estimate """
+    return estimate(program.load(filename), profile, travel_feed)
+
+
+def _moves(prog, profile, travel_feed):
+    """ Returns the arrays describing the moves of the program, one row per move
+
+    Blocks that do not move the machine are dropped, the ones between two moves that make
+    grbl stop (dwells, system commands and moves to unknown positions) are kept as stops.
+    """
+    position = prog.positions()
+    start = numpy.vstack([[0.0, 0.0, 0.0], position[:-1]])
+    motion = prog.motions()
+    feed = prog.feeds()
+
+    # An axis that is unknown before and after a move does not take part in it
+    known = (numpy.isnan(start) == numpy.isnan(position)).all(axis=1)
+    start = numpy.where(numpy.isnan(start), 0.0, start)
+    position = numpy.where(numpy.isnan(position), 0.0, position)
+    moving = prog.valid & ~prog.system & prog.supported & (prog.command == 0) & \
+        (motion >= program.RAPID) & (motion <= program.CCW_ARC)
+    arc = (motion == program.CW_ARC) | (motion == program.CCW_ARC)
+    # An arc ending where it starts is a full circle
+    circle = arc & ~(numpy.isnan(prog.i) & numpy.isnan(prog.j))
+    moving &= known & ((numpy.abs(position - start).max(axis=1) > 0.0) | circle)
+    blocking = prog.system | (prog.command == program.DWELL) | (prog.command == program.HOME) | \
+        (prog.command == program.MACHINE)
+
+    rows = numpy.flatnonzero(moving)
+    stops = numpy.cumsum(blocking)[rows]
+    stop = numpy.concatenate([[True], stops[1:] != stops[:-1]])
+
+    start, end, motion, feed, arc = start[rows], position[rows], motion[rows], feed[rows], arc[rows]
+    delta = end - start
+    length = numpy.linalg.norm(delta, axis=1)
+    unit = delta / numpy.where(length > 0.0, length, 1.0)[:, None]
+    unit_in, unit_out, radius = unit.copy(), unit.copy(), numpy.full(len(rows), numpy.inf)
+
+    max_rate = numpy.asarray(profile['max_rate'], dtype=float) / 60.0
+    acceleration = numpy.asarray(profile['acceleration'], dtype=float)
+    rate = _axis_limit(max_rate, unit)
+    accel = _axis_limit(acceleration, unit)
+
+    if arc.any():
+        index = numpy.flatnonzero(arc)
+        length[index], radius[index], unit_in[index], unit_out[index] = _arcs(
+            prog, rows[index], start[index], end[index], motion[index] == program.CW_ARC)
+        # The direction turns along an arc, the slowest XY axis limits it
+        rate[index] = max_rate[:2].min()
+        accel[index] = acceleration[:2].min()
+
+    rapid = motion == program.RAPID
+    feed = numpy.where(numpy.isnan(feed) | rapid, rate * 60.0, feed)
+    # Arcs are run as short chords, the corners between them keep the centripetal acceleration in limits
+    nominal = numpy.minimum(numpy.minimum(feed / 60.0, rate), numpy.sqrt(accel * radius))
+
+    travel = rapid | ((numpy.abs(delta[:, :2]).max(axis=1) == 0.0) & ~arc)
+    if travel_feed is not None:
+        travel |= (motion == program.LINEAR) & numpy.isclose(feed, float(travel_feed))
+
+    return {'start': start, 'end': end, 'length': length, 'unit_in': unit_in, 'unit_out': unit_out,
+            'nominal': nominal, 'acceleration': accel, 'travel': travel, 'stop': stop}
+
+
+def _arcs(prog, rows, start, end, clockwise):
+    """ Returns the length, radius and entry and exit tangents of XY arcs """
+    center = program.arc_centers(prog, rows, start, end, clockwise)
+    a = start[:, :2] - center
+    b = end[:, :2] - center
+    radius = numpy.linalg.norm(a, axis=1)
+    sweep = numpy.arctan2(a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0], (a * b).sum(axis=1))
+    sweep = numpy.where(clockwise, -sweep, sweep)
+    sweep = numpy.where(sweep <= 1e-9, sweep + 2 * numpy.pi, sweep)
+    length = numpy.hypot(radius * sweep, end[:, 2] - start[:, 2])
+
+    sign = numpy.where(clockwise, -1.0, 1.0)[:, None]
+    tangents = []
+    for vector in (a, b):
+        tangent = numpy.column_stack([-vector[:, 1], vector[:, 0], numpy.zeros(len(vector))]) * sign
+        norm = numpy.linalg.norm(tangent, axis=1)
+        tangents.append(tangent / numpy.where(norm > 0.0, norm, 1.0)[:, None])
+    return length, numpy.where(radius > 0.0, radius, numpy.inf), tangents[0], tangents[1]
+
+
+def _axis_limit(limits, unit):
+    """ Returns the largest rate along every unit vector that keeps each axis within its limit """
+    with numpy.errstate(divide='ignore'):
+        ratio = numpy.where(unit != 0.0, limits / numpy.abs(unit), numpy.inf)
+    return ratio.min(axis=1)
+
+
+def _entry_speeds(moves, profile):
+    """ Returns the squared speed at the start of every move and at the end of the last one
+
+    Every corner is limited by the junction deviation and the nominal speeds of the moves
+    around it. Speeds then only change as fast as the accelerations allow, which is the
+    minimum over all corners j of limit[j] + |S[i] - S[j]| where S is the running sum of
+    2 * acceleration * length. Splitting the minimum at i gives two running minimums.
+    """
+    count = len(moves['length'])
+    nominal = moves['nominal'] ** 2
+    accel_length = 2.0 * moves['acceleration'] * moves['length']
+
+    cos_theta = -(moves['unit_out'][:-1] * moves['unit_in'][1:]).sum(axis=1)
+    direction = moves['unit_in'][1:] - moves['unit_out'][:-1]
+    norm = numpy.linalg.norm(direction, axis=1)
+    direction = direction / numpy.where(norm > 0.0, norm, 1.0)[:, None]
+    junction_accel = _axis_limit(numpy.asarray(profile['acceleration'], dtype=float), direction)
+    sin_theta = numpy.sqrt(numpy.clip(0.5 * (1.0 - cos_theta), 0.0, 1.0))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        junction = junction_accel * float(profile['junction_deviation']) * sin_theta / (1.0 - sin_theta)
+    junction = numpy.where(cos_theta < -COSINE_LIMIT, numpy.inf, junction)
+    junction = numpy.where(cos_theta > COSINE_LIMIT, 0.0, junction)
+
+    limit = numpy.zeros(count + 1)
+    limit[1:count] = numpy.minimum(junction, numpy.minimum(nominal[:-1], nominal[1:]))
+    limit[:count][moves['stop']] = 0.0
+
+    # Every block must be able to stop within the blocks the planner holds after it
+    blocks = int(profile['planner_blocks'])
+    reach = numpy.concatenate([[0.0], numpy.cumsum(accel_length)])
+    ahead = numpy.minimum(numpy.arange(count + 1) + blocks, count)
+    limit = numpy.minimum(limit, reach[ahead] - reach)
+
+    backward = numpy.minimum.accumulate((limit + reach)[::-1])[::-1] - reach
+    forward = numpy.minimum.accumulate(limit - reach) + reach
+    return numpy.maximum(numpy.minimum(backward, forward), 0.0)
+
+
+def _trapezoids(moves, entry):
+    """ Returns the time of every move from its squared entry and exit speeds """
+    length = moves['length']
+    accel = moves['acceleration']
+    nominal = moves['nominal']
+    start = entry[:-1]
+    end = entry[1:]
+
+    # Speed reached if the move accelerates and decelerates without cruising
+    peak = numpy.sqrt(numpy.minimum((accel * length + (start + end) / 2.0), nominal ** 2))
+    v0 = numpy.sqrt(start)
+    v1 = numpy.sqrt(end)
+    ramp = (peak * peak - start) / (2.0 * accel) + (peak * peak - end) / (2.0 * accel)
+    cruise = numpy.maximum(length - ramp, 0.0) / peak
+    return (peak - v0) / accel + (peak - v1) / accel + cruise
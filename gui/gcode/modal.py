@@ -0,0 +1,121 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Follows the modal state grbl keeps between blocks: units, distance
+   mode, motion mode, feed and the last position. The state can be turned
+   back into the blocks that restore it on a freshly homed machine.
+"""
+from gcode import blocks
+
+MM_PER_INCH = 25.4
+
+
+class ModalState:
+    """ Modal state of grbl after the blocks given to update
+
+    Positions are work coordinates in millimeters and the feed is in millimeters
+    per minute whatever the units of the program are.
+    """
+
+    def __init__(self, units='21', distance='90', motion='0', feed=None, position=(0.0, 0.0, 0.0)):
+        self.units = units
+        self.distance = distance
+        self.motion = motion
+        self.feed = feed
+        self.position = list(position)
+
+    def update(self, line):
+        """ Applies one block to the state, blocks that are not made of words are ignored """
+        words = blocks.parse_block(line)
+        if not words:
+            return
+
+        codes = [blocks.format_code(value) for letter, value in words if letter == 'G']
+        non_modal = [code for code in codes if code in blocks.NON_MODAL]
+        for code in codes:
+            if code in ('20', '21'):
+                self.units = code
+            elif code in ('90', '91'):
+                self.distance = code
+            elif code in blocks.MOTION_MODES and not (non_modal and self._has_axes(words)):
+                self.motion = code
+
+        scale = MM_PER_INCH if self.units == '20' else 1.0
+        for letter, value in words:
+            if letter == 'F':
+                self.feed = float(value) * scale
+
+        # Non-modal commands use the axis words for themselves, G92 sets the current position
+        if non_modal and '92' not in non_modal:
+            return
+        for letter, value in words:
+            if letter in blocks.AXES:
+                axis = blocks.AXES.index(letter)
+                if self.distance == '91' and not non_modal:
+                    self.position[axis] += float(value) * scale
+                else:
+                    self.position[axis] = float(value) * scale
+
+    @staticmethod
+    def _has_axes(words):
+        return any(letter in blocks.AXES for letter, value in words)
+
+    def preamble(self, precision=3):
+        """ Returns the blocks restoring this state on an idle machine
+
+        The position is restored with a rapid move. Arc modes are left for restore_motion
+        since grbl rejects them without their words.
+        """
+        position = ''.join(axis + blocks.format_number(value, precision)
+                           for axis, value in zip(blocks.AXES, self.position))
+        lines = ['G21G90', 'G0' + position]
+        if self.units == '20':
+            lines.append('G20')
+        if self.distance == '91':
+            lines.append('G91')
+        if self.feed is not None:
+            scale = MM_PER_INCH if self.units == '20' else 1.0
+            lines.append('F' + blocks.format_number(self.feed / scale, precision))
+        if self.motion in ('1', '80'):
+            lines.append('G' + self.motion)
+        return lines
+
+    def restore_motion(self, line):
+        """ Puts an arc motion mode in front of a block that relies on it being modal
+
+        :returns The block and True once the motion mode is in effect, False if the block
+        has no axis words so the next one has to be restored as well
+        """
+        if self.motion not in ('2', '3'):
+            return line, True
+        words = blocks.parse_block(line)
+        if not words:
+            return line, False
+        codes = [blocks.format_code(value) for letter, value in words if letter == 'G']
+        if any(code in blocks.MOTION_MODES for code in codes):
+            return line, True
+        if not self._has_axes(words) or any(code in blocks.NON_MODAL for code in codes):
+            return line, False
+        return 'G' + self.motion + line, True
+
+    def to_dict(self):
+        """ Returns the state as a JSON friendly dict """
+        return {'units': self.units, 'distance': self.distance, 'motion': self.motion,
+                'feed': self.feed, 'position': list(self.position)}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state['units'], state['distance'], state['motion'], state['feed'], state['position'])
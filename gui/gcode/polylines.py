@@ -0,0 +1,154 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Splits g-code into runs of consecutive 'G1 X.. Y..' segments and the
+   blocks between them, for the post-processors that rewrite polylines.
+
+   A run only holds XY moves in absolute mode with the XY plane selected
+   that start from a known position. Only its first segment may set the
+   feed, so every segment of a run is cut at the same speed.
+"""
+from gcode import blocks
+
+
+def new_state():
+    """ Returns the modal state and position before the first block """
+    return {'motion': None, 'absolute': True, 'plane': '17', 'position': [None, None, None]}
+
+
+def runs(lines, state=None, stats=None):
+    """ Generator splitting the lines into runs of segments and other blocks
+
+    Yields ('line', line, words) for a block that is not part of a run and
+    ('run', start, segments) for a run, where start is the [x, y] point the run
+    starts from and every segment is a dict with the line, its end point, its feed
+    word (None if it has none) and words. Lines are yielded without their newline.
+    The state is updated for a 'line' once the consumer asks for the next item.
+
+    :param state: Optional dict from new_state(), followed through the blocks
+    :param stats: Optional statistics dict, its lines_in count is updated
+    """
+    if state is None:
+        state = new_state()
+
+    start = None
+    run = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if stats is not None:
+            stats['lines_in'] += 1
+        words = blocks.parse_block(line)
+
+        item = segment(line, words, state)
+        if item is not None and run and item['feed'] is None:
+            run.append(item)
+            move(state, item)
+            continue
+
+        if run:
+            yield 'run', start, run
+        run = []
+
+        if item is not None:
+            start = list(state['position'][:2])
+            run.append(item)
+            move(state, item)
+            continue
+
+        yield 'line', line, words
+        update(state, line, words)
+
+    if run:
+        yield 'run', start, run
+
+
+def segment(line, words, state):
+    """ Returns the segment of a block that can be part of a run, None if it can not """
+    if not words or not state['absolute'] or state['plane'] != '17':
+        return None
+    if None in state['position'][:2]:
+        return None
+
+    motion = state['motion']
+    point = list(state['position'][:2])
+    feed = None
+    for letter, value in words:
+        if letter == 'G':
+            if blocks.format_code(value) != '1':
+                return None
+            motion = '1'
+        elif letter in 'XY':
+            point['XY'.index(letter)] = float(value)
+        elif letter == 'F':
+            feed = value
+        else:
+            return None
+
+    if motion != '1' or not any(letter in 'XY' for letter, value in words):
+        return None
+    return {'line': line, 'point': point, 'feed': feed, 'words': words}
+
+
+def move(state, item):
+    """ Moves the position to the end of a segment """
+    state['position'][:2] = item['point']
+    state['motion'] = '1'
+
+
+def update(state, line, words):
+    """ Follows the modal state and position through a block that is not a segment """
+    if words is None:
+        # System commands like $H move the machine to an unknown position, grbl rejects other blocks
+        if blocks.strip_comments(line).startswith('$'):
+            state['position'] = [None, None, None]
+        return
+
+    codes = [blocks.format_code(value) for letter, value in words if letter == 'G']
+    non_modal = [code for code in codes if code in blocks.NON_MODAL]
+    for code in codes:
+        if code in blocks.MOTION_MODES and not non_modal:
+            state['motion'] = code
+        elif code in ('90', '91'):
+            state['absolute'] = code == '90'
+        elif code in ('17', '18', '19'):
+            state['plane'] = code
+
+    if non_modal and '92' not in non_modal:
+        if any(code in ('28', '30', '53') for code in non_modal):
+            state['position'] = [None, None, None]
+        return
+
+    for letter, value in words:
+        if letter in blocks.AXES:
+            axis = blocks.AXES.index(letter)
+            if state['absolute'] or non_modal:
+                state['position'][axis] = float(value)
+            elif state['position'][axis] is not None:
+                state['position'][axis] += float(value)
+
+
+def end_words(segments, end, precision=6):
+    """ Returns the X and Y words of the end point, as written in the last segments setting them """
+    out = []
+    for axis, letter in enumerate('XY'):
+        text = None
+        for item in reversed(segments):
+            values = [value for word, value in item['words'] if word == letter]
+            if values:
+                text = values[-1]
+                break
+        out.append(letter + (text if text is not None else blocks.format_number(end[axis], precision)))
+    return out
@@ -0,0 +1,414 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Loads a g-code file into NumPy columns, one row per line, so whole
+   programs can be analyzed with array operations instead of a Python
+   loop per block.
+
+   Words a block does not have are NaN. The modal state is resolved by
+   forward filling the columns, which gives the position every block ends
+   at in millimeters and absolute work coordinates.
+
+   load caches the columns next to the g-code in a '.program.npy' record
+   array with a '.program.json' sidecar holding the size, modification
+   time and SHA-1 of the file it was made from. Reopening an unchanged
+   file memory maps the cache instead of parsing it again, the byte
+   offset of every line still gives access to the original blocks.
+"""
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import re
+
+import numpy
+
+from gcode import blocks
+
+WORD = re.compile(r'[A-Z]\s*[-+]?(?:\d+\.?\d*|\.\d+)')
+
+# Values of the motion column, NONE for blocks without a motion code
+NONE, RAPID, LINEAR, CW_ARC, CCW_ARC, CANCEL = -1, 0, 1, 2, 3, 80
+MOTION_CODES = {'0': RAPID, '1': LINEAR, '2': CW_ARC, '3': CCW_ARC, '80': CANCEL}
+
+# Values of the command column for the non-modal commands. The axis words of a SET block
+# become the position without a move, STORE blocks keep them and the position is unknown
+# after HOME and MACHINE blocks
+SET, STORE, HOME, MACHINE, DWELL = 1, 2, 3, 4, 5
+COMMAND_CODES = {'4': DWELL, '10': STORE, '28.1': STORE, '30.1': STORE, '92': SET,
+                 '28': HOME, '30': HOME, '92.1': HOME, '53': MACHINE}
+
+WORD_COLUMNS = 'XYZIJRFP'
+
+# Words grbl 1.1 accepts, a block with any other is rejected with an error
+GRBL_LETTERS = 'FGIJKLMNPRSTXYZ'
+GRBL_G_CODES = ('0', '1', '2', '3', '4', '10', '17', '18', '19', '20', '21', '28', '28.1', '30', '30.1',
+                '38.2', '38.3', '38.4', '38.5', '40', '43.1', '49', '53', '54', '55', '56', '57', '58', '59',
+                '61', '80', '90', '91', '91.1', '92', '92.1', '93', '94')
+GRBL_M_CODES = ('0', '1', '2', '3', '4', '5', '7', '8', '9', '30', '56')
+MM_PER_INCH = 25.4
+
+CACHE_EXTENSION = '.program.npy'
+SIDECAR_EXTENSION = '.program.json'
+CACHE_VERSION = 2
+
+# Record layout of the cache, one record per line
+CACHE_DTYPE = numpy.dtype([(letter.lower(), numpy.float64) for letter in WORD_COLUMNS] +
+                          [('motion', numpy.int16), ('command', numpy.int8), ('units', numpy.int8),
+                           ('distance', numpy.int8), ('system', bool), ('valid', bool), ('supported', bool),
+                           ('offset', numpy.int64)])
+
+
+class Program:
+    """ Columns of the words of every line of a g-code file
+
+    Integer columns are 0 where a block does not set them, the system column marks '$'
+    commands and the valid column is False for lines grbl would reject as not made of words.
+    The supported column is False for blocks with a word or code grbl does not support,
+    grbl rejects them as well so they do not change the modal state.
+    """
+
+    def __init__(self, columns, filename=None, size=0):
+        """
+        :param columns: Dict of the columns, the offset column holds the byte offset every line starts at
+        :param filename: The g-code file the columns were parsed from, needed by block
+        :param size: Size in bytes of the g-code file
+        """
+        self.columns = columns
+        self.filename = filename
+        self.size = size
+        self._source = None
+        for name, column in columns.items():
+            setattr(self, name, column)
+
+    def __len__(self):
+        return len(self.motion)
+
+    def block(self, index):
+        """ Returns the original bytes of a line of the file without its EOL characters """
+        if self.filename is None or 'offset' not in self.columns:
+            raise ValueError('The program was not loaded from a file')
+        if self._source is None:
+            with open(self.filename, 'rb') as f:
+                self._source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+
+        start = int(self.offset[index])
+        end = int(self.offset[index + 1]) if index + 1 < len(self) else self.size
+        return self._source[start:end].rstrip(b'\r\n')
+
+    def close(self):
+        """ Releases the memory map of the g-code file opened by block """
+        if isinstance(self._source, mmap.mmap):
+            self._source.close()
+        self._source = None
+
+    def positions(self, start=(0.0, 0.0, 0.0)):
+        """ Returns the (N, 3) array of the XYZ position every line ends at
+
+        Positions are absolute work coordinates in millimeters. They become NaN after
+        $H, G28, G30 and G53 until the axis is set again.
+
+        :param start: Position before the first line
+        """
+        factor = self.scale()
+        axes = numpy.column_stack([self.x, self.y, self.z]) * factor[:, None]
+        axes[(self.command == STORE) | (self.command == DWELL) | ~self.supported] = numpy.nan
+        reset = (self.command == HOME) | (self.command == MACHINE)
+
+        relative = self.relative()
+        if relative.any():
+            return _follow(axes, relative, reset, self.command == SET, start)
+
+        out = numpy.empty_like(axes)
+        for axis in range(3):
+            out[:, axis] = forward_fill(axes[:, axis], reset, start[axis])
+        return out
+
+    def feeds(self):
+        """ Returns the feed in millimeters per minute in effect on every line, NaN before the first F word """
+        return forward_fill(numpy.where(self.supported, self.f, numpy.nan) * self.scale(), None, numpy.nan)
+
+    def motions(self):
+        """ Returns the motion mode in effect on every line """
+        codes = self.motion.astype(float)
+        codes[(self.motion == NONE) | (self.command != 0) | ~self.supported] = numpy.nan
+        return forward_fill(codes, None, RAPID).astype(numpy.int16)
+
+    def relative(self):
+        """ Returns a boolean column, True for the lines in G91 incremental distance mode """
+        distance = numpy.where((self.distance == 0) | ~self.supported, numpy.nan, self.distance.astype(float))
+        return forward_fill(distance, None, 90) == 91
+
+    def scale(self):
+        """ Returns the factor from program units to millimeters of every line """
+        units = numpy.where((self.units == 0) | ~self.supported, numpy.nan, self.units.astype(float))
+        return numpy.where(forward_fill(units, None, 21) == 20, MM_PER_INCH, 1.0)
+
+
+def arc_centers(prog, rows, start, end, clockwise):
+    """ Returns the (N, 2) array of the XY centers of arc blocks
+
+    :param rows: Indices of the arc blocks in the program
+    :param start: (N, 3) array of the positions the arcs start from, in millimeters
+    :param end: (N, 3) array of the positions the arcs end at, in millimeters
+    :param clockwise: Boolean array, True for the G2 arcs
+    """
+    scale = prog.scale()[rows]
+    i, j, r = prog.i[rows] * scale, prog.j[rows] * scale, prog.r[rows] * scale
+
+    center = start[:, :2] + numpy.column_stack([numpy.nan_to_num(i), numpy.nan_to_num(j)])
+    by_radius = ~numpy.isnan(r)
+    if by_radius.any():
+        # Same center as grbl, a negative R picks the arc longer than a half circle
+        chord = end[:, :2] - start[:, :2]
+        distance = numpy.linalg.norm(chord, axis=1)
+        h = -numpy.sqrt(numpy.maximum(4.0 * r * r - distance * distance, 0.0)) / numpy.maximum(distance, 1e-12)
+        h = numpy.where(clockwise, h, -h)
+        h = numpy.where(r < 0.0, -h, h)
+        normal = numpy.column_stack([-chord[:, 1], chord[:, 0]])
+        centers = start[:, :2] + 0.5 * (chord + h[:, None] * normal)
+        center = numpy.where(by_radius[:, None], centers, center)
+    return center
+
+
+def forward_fill(values, reset=None, initial=numpy.nan):
+    """ Carries every non NaN value forward over the NaN values after it
+
+    :param reset: Optional boolean column, a True line makes the value NaN until it is set again
+    :param initial: Value before the first one set
+    """
+    present = ~numpy.isnan(values)
+    if reset is not None:
+        values = numpy.where(reset, numpy.nan, values)
+        present |= reset
+    index = numpy.where(present, numpy.arange(len(values)), -1)
+    numpy.maximum.accumulate(index, out=index)
+    return numpy.where(index >= 0, values[numpy.maximum(index, 0)], initial)
+
+
+def parse(lines):
+    """ Parses g-code lines into a Program
+
+    :param lines: Iterable of g-code lines, for example an open file
+    """
+    rows, words = [], []
+    system, homes, invalid = [], [], []
+    count = 0
+
+    for index, line in enumerate(lines):
+        count += 1
+        if '(' in line or ';' in line:
+            block = blocks.strip_comments(line).upper()
+        else:
+            block = line.strip().upper()
+        if not block:
+            continue
+
+        if block[0] == '$':
+            system.append(index)
+            if block.startswith('$H'):
+                homes.append(index)
+        else:
+            if '\t' in block:
+                block = block.replace('\t', ' ')
+            found = WORD.findall(block)
+            joined = ''.join(found)
+            # Anything left besides the words and spaces makes grbl reject the whole block
+            if len(joined) - joined.count(' ') != len(block) - block.count(' '):
+                invalid.append(index)
+            else:
+                rows.append(index)
+                words.append(found)
+
+    # One row per word, the G and M words go to the integer columns
+    rows = numpy.repeat(numpy.array(rows, dtype=numpy.int64), [len(item) for item in words])
+    words = list(itertools.chain.from_iterable(words))
+    letters = numpy.array(words, dtype='U1')
+    values = [word[1:] for word in words]
+    is_code = (letters == 'G') | (letters == 'M')
+
+    columns = dict()
+    numbers = numpy.array(list(map(float, itertools.compress(values, (~is_code).tolist()))), dtype=numpy.float64)
+    numbers_rows, number_letters = rows[~is_code], letters[~is_code]
+    for letter in WORD_COLUMNS:
+        column = numpy.full(count, numpy.nan)
+        mask = number_letters == letter
+        column[numbers_rows[mask]] = numbers[mask]
+        columns[letter.lower()] = column
+
+    columns['motion'] = numpy.full(count, NONE, dtype=numpy.int16)
+    columns['command'] = numpy.zeros(count, dtype=numpy.int8)
+    columns['units'] = numpy.zeros(count, dtype=numpy.int8)
+    columns['distance'] = numpy.zeros(count, dtype=numpy.int8)
+    columns['supported'] = numpy.ones(count, dtype=bool)
+    columns['supported'][rows[~numpy.isin(letters, list(GRBL_LETTERS))]] = False
+
+    code_words = [letter + value.strip() for letter, value in
+                  zip(letters[is_code].tolist(), itertools.compress(values, is_code.tolist()))]
+    codes, inverse = numpy.unique(numpy.array(code_words, dtype='U'), return_inverse=True)
+    code_rows = rows[is_code]
+    for number, word in enumerate(codes.tolist()):
+        letter, code = word[0], blocks.format_code(word[1:])
+        target = code_rows[inverse == number]
+        if letter == 'M':
+            columns['supported'][target] &= code in GRBL_M_CODES
+            continue
+        columns['supported'][target] &= code in GRBL_G_CODES
+        if code in MOTION_CODES:
+            columns['motion'][target] = MOTION_CODES[code]
+        elif code in COMMAND_CODES:
+            columns['command'][target] = COMMAND_CODES[code]
+        elif code in ('20', '21'):
+            columns['units'][target] = int(code)
+        elif code in ('90', '91'):
+            columns['distance'][target] = int(code)
+    columns['command'][homes] = HOME
+
+    columns['system'] = numpy.zeros(count, dtype=bool)
+    columns['system'][system] = True
+    columns['valid'] = numpy.ones(count, dtype=bool)
+    columns['valid'][invalid] = False
+    return Program(columns)
+
+
+def load(filename, cache=True):
+    """ Loads a g-code file into a Program
+
+    :param cache: Uses the cache of the file when it is up to date and writes it when it is not
+    """
+    if cache:
+        prog = load_cache(filename)
+        if prog is not None:
+            return prog
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    info = os.stat(filename)
+
+    # Lines are split on LF only, as grbl does, so the byte offsets match the lines
+    ends = numpy.flatnonzero(numpy.frombuffer(data, dtype=numpy.uint8) == 10) + 1
+    lines = data.decode('utf-8', 'replace').split('\n')
+    if data.endswith(b'\n'):
+        lines.pop()
+    prog = parse(lines)
+    prog.columns['offset'] = prog.offset = numpy.concatenate([[0], ends])[:len(prog)].astype(numpy.int64)
+    prog.filename = filename
+    prog.size = len(data)
+
+    if cache:
+        try:
+            save_cache(prog, info, hashlib.sha1(data).hexdigest())
+        except OSError as e:
+            print(e)
+    return prog
+
+
+def cache_paths(filename):
+    """ Returns the paths of the cache and sidecar files of a g-code file """
+    return filename + CACHE_EXTENSION, filename + SIDECAR_EXTENSION
+
+
+def load_cache(filename):
+    """ Memory maps the cached Program of a g-code file
+
+    The cache is used if the size and modification time of the file match the sidecar,
+    or if only the modification time changed and the SHA-1 of the file still matches.
+
+    :returns The Program or None if there is no up to date cache
+    """
+    cache_path, sidecar_path = cache_paths(filename)
+    try:
+        with open(sidecar_path, 'r') as f:
+            sidecar = json.load(f)
+        info = os.stat(filename)
+    except (OSError, ValueError):
+        return None
+
+    if sidecar.get('version') != CACHE_VERSION or sidecar.get('size') != info.st_size:
+        return None
+    if sidecar.get('mtime') != info.st_mtime:
+        if sidecar.get('sha1') != _file_hash(filename):
+            return None
+        sidecar['mtime'] = info.st_mtime
+        _write_sidecar(sidecar_path, sidecar)
+
+    try:
+        records = numpy.load(cache_path, mmap_mode='r') if sidecar['lines'] else numpy.zeros(0, CACHE_DTYPE)
+    except (OSError, ValueError):
+        return None
+    if records.dtype != CACHE_DTYPE or len(records) != sidecar['lines']:
+        return None
+    return Program({name: records[name] for name in CACHE_DTYPE.names}, filename, info.st_size)
+
+
+def save_cache(prog, info, sha1):
+    """ Writes the cache and sidecar files of a Program loaded from a file
+
+    :param info: os.stat result of the file when it was read
+    :param sha1: Hex digest of the SHA-1 of the file
+    """
+    cache_path, sidecar_path = cache_paths(prog.filename)
+    records = numpy.empty(len(prog), dtype=CACHE_DTYPE)
+    for name in CACHE_DTYPE.names:
+        records[name] = prog.columns[name]
+
+    # numpy.save adds the extension to names without it
+    temp_path = cache_path + '.tmp.npy'
+    numpy.save(temp_path, records)
+    os.replace(temp_path, cache_path)
+    _write_sidecar(sidecar_path, {'version': CACHE_VERSION, 'size': info.st_size, 'mtime': info.st_mtime,
+                                  'sha1': sha1, 'lines': len(prog)})
+
+
+def remove_cache(filename):
+    """ Removes the cache and sidecar files of a g-code file if there are any """
+    for path in cache_paths(filename):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _write_sidecar(path, sidecar):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(sidecar, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def _file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _follow(axes, relative, reset, setting, start):
+    """ Follows the position block by block, for programs using incremental distance mode """
+    out = numpy.empty_like(axes)
+    position = numpy.array(start, dtype=float)
+    for index in range(len(axes)):
+        if reset[index]:
+            position[:] = numpy.nan
+        present = ~numpy.isnan(axes[index])
+        if relative[index] and not setting[index]:
+            position[present] += axes[index][present]
+        else:
+            position[present] = axes[index][present]
+        out[index] = position
+    return out
@@ -0,0 +1,450 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Travel minimizing reordering of the etch segments of every layer.
+
+   A layer is everything between two blocks that change Z or a machine
+   mode. It is split into pieces, each one a travel move followed by the
+   blocks etched from where the travel ends. The pieces are reordered with
+   a nearest neighbour tour improved by 2-opt, pieces made of plain G1
+   moves only may also be etched backwards. Travel moves are G0 moves and
+   G1 moves at the travel feed, multi-hop travels are merged into one
+   straight move since the laser does not need to avoid perimeters.
+"""
+import math
+import os
+
+import numpy
+
+from gcode import blocks
+
+# Maximum number of 2-opt passes over a layer
+DEFAULT_PASSES = 20
+
+# Decimals of the coordinates written for pieces etched backwards
+PRECISION = 6
+
+
+def new_stats():
+    """ Returns an empty statistics dict for reorder_gcode
+
+    Travel distances are in mm and times in seconds at the travel feed.
+    """
+    return {'layers': 0, 'pieces': 0, 'flipped': 0, 'travel_before': 0.0, 'travel_after': 0.0,
+            'time_before': 0.0, 'time_after': 0.0}
+
+
+def reorder_gcode(lines, travel_feed, stats=None, passes=DEFAULT_PASSES):
+    """ Generator yielding the lines with the pieces of every layer reordered
+
+    The lines are read completely before the first one is yielded.
+
+    :param lines: Iterable of g-code lines, for example an open file
+    :param travel_feed: Feed in units per minute of the G1 travel moves, for example travel_speed * 60
+    :param stats: Optional dict from new_stats() updated while reordering
+    :param passes: Maximum number of 2-opt passes per layer
+    """
+    if stats is None:
+        stats = new_stats()
+
+    items = _classify(lines, float(travel_feed))
+    for kind, layer in _layers(items):
+        if kind == 'line':
+            yield layer['line']
+            continue
+        for line in _reorder_layer(layer, float(travel_feed), passes, stats):
+            yield line
+
+    stats['time_before'] = stats['travel_before'] / float(travel_feed) * 60.0
+    stats['time_after'] = stats['travel_after'] / float(travel_feed) * 60.0
+
+
+def reorder_file(filename, travel_feed, file_out=None, passes=DEFAULT_PASSES):
+    """ Writes the reordered version of a g-code file
+
+    :returns The output file and the statistics dict
+    """
+    if file_out is None:
+        name, ext = os.path.splitext(filename)
+        file_out = '{}.reorder{}'.format(name, ext)
+
+    stats = new_stats()
+    with open(filename, 'r') as f:
+        lines = list(reorder_gcode(f, travel_feed, stats, passes))
+    with open(file_out, 'w') as out:
+        for line in lines:
+            out.write(line + '\n')
+
+    return file_out, stats
+
+
+# ----- parsing ----- #
+
+def _classify(lines, travel_feed):
+    """ Returns a dict for every line with its kind and the modal state after it
+
+    Kinds are 'boundary' for blocks that end a layer, 'travel', 'etch' for XY
+    moves that are not travel, 'inert' for blocks grbl rejects or ignores
+    and 'other' for blocks without XY moves such as feeds and M codes.
+    """
+    items = []
+    position = [None, None]
+    motion = None
+    feed = None
+    feed_text = None
+    absolute = True
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+        words = blocks.parse_block(line)
+        item = {'line': line, 'words': words, 'start': list(position), 'motion_in': motion, 'feed_in': feed_text}
+
+        if words is None or not words:
+            if words is None and blocks.strip_comments(line).startswith('$'):
+                item['kind'] = 'boundary'
+                position = [None, None]
+            else:
+                item['kind'] = 'inert'
+        else:
+            codes = [blocks.format_code(value) for letter, value in words if letter == 'G']
+            letters = [letter for letter, value in words]
+            boundary = 'Z' in letters or not absolute or any(code not in ('0', '1', '2', '3') for code in codes)
+
+            for code in codes:
+                if code in ('0', '1', '2', '3'):
+                    motion = code
+                elif code in ('90', '91'):
+                    absolute = code == '90'
+            for letter, value in words:
+                if letter == 'F':
+                    feed, feed_text = float(value), value
+
+            non_modal = any(code in blocks.NON_MODAL for code in codes)
+            has_xy = 'X' in letters or 'Y' in letters
+            if non_modal and not any(code == '92' for code in codes):
+                if any(code in ('28', '30', '53') for code in codes):
+                    position = [None, None]
+            elif has_xy:
+                for letter, value in words:
+                    if letter in 'XY':
+                        axis = 'XY'.index(letter)
+                        if absolute or non_modal:
+                            position[axis] = float(value)
+                        elif position[axis] is not None:
+                            position[axis] += float(value)
+
+            if boundary:
+                item['kind'] = 'boundary'
+            elif has_xy and (motion == '0' or (motion == '1' and feed == travel_feed)):
+                item['kind'] = 'travel'
+            elif has_xy:
+                item['kind'] = 'etch'
+            else:
+                item['kind'] = 'other'
+
+        item['end'] = list(position)
+        item['motion'] = motion
+        item['feed'] = feed_text
+        items.append(item)
+
+    return items
+
+
+def _layers(items):
+    """ Generator yielding ('line', item) for boundary blocks and ('layer', layer) for the layers between them """
+    layer = _new_layer()
+    for index, item in enumerate(items):
+        if item['kind'] == 'boundary':
+            if layer['prefix'] or layer['pieces']:
+                layer['fixed_end'] = _needs_end(items, index)
+                yield 'layer', layer
+            layer = _new_layer()
+            yield 'line', item
+            continue
+
+        pieces = layer['pieces']
+        if item['kind'] == 'travel':
+            if not pieces or pieces[-1]['lines']:
+                pieces.append({'travel': [], 'lines': []})
+            pieces[-1]['travel'].append(item)
+        elif pieces:
+            pieces[-1]['lines'].append(item)
+        else:
+            layer['prefix'].append(item)
+
+    if layer['prefix'] or layer['pieces']:
+        layer['fixed_end'] = False
+        yield 'layer', layer
+
+
+def _new_layer():
+    return {'prefix': [], 'pieces': [], 'fixed_end': False}
+
+
+def _needs_end(items, index):
+    """ True if the blocks after a layer depend on the position the layer ends at """
+    for item in items[index:]:
+        if item['kind'] == 'travel':
+            return False
+        if item['kind'] == 'etch':
+            return True
+        if item['kind'] == 'boundary' and item['words']:
+            letters = [letter for letter, value in item['words']]
+            codes = [blocks.format_code(value) for letter, value in item['words'] if letter == 'G']
+            if '91' in codes or any(code in ('2', '3') for code in codes):
+                return True
+            if ('X' in letters) != ('Y' in letters):
+                return True
+    return False
+
+
+# ----- reordering ----- #
+
+def _reorder_layer(layer, travel_feed, passes, stats):
+    """ Generator yielding the lines of a layer with its pieces reordered """
+    for item in layer['prefix']:
+        yield item['line']
+
+    pieces = layer['pieces']
+    if not pieces:
+        return
+
+    for piece in pieces:
+        _describe(piece, travel_feed)
+    if any(None in piece['start'] or None in piece['end'] for piece in pieces):
+        # Pieces starting from an unknown position keep their order
+        for piece in pieces:
+            for item in piece['travel'] + piece['lines']:
+                yield item['line']
+        return
+
+    p0 = layer['prefix'][-1]['end'] if layer['prefix'] else pieces[0]['travel'][0]['start']
+    if None in p0:
+        p0 = pieces[0]['start']
+    p0 = numpy.array(p0, dtype=float)
+
+    starts = numpy.array([piece['start'] for piece in pieces], dtype=float)
+    ends = numpy.array([piece['end'] for piece in pieces], dtype=float)
+    flippable = numpy.array([piece['flippable'] for piece in pieces], dtype=bool)
+
+    original = (list(range(len(pieces))), [False] * len(pieces))
+    order, flipped = optimize(p0, starts, ends, flippable, layer['fixed_end'], passes)
+    if _travel(p0, starts, ends, *original) <= _travel(p0, starts, ends, order, flipped):
+        order, flipped = original
+
+    lines = _emit(pieces, order, flipped, travel_feed)
+    if lines is None:
+        # The modal state at the end of the layer can not be restored, keep the layer as it is
+        order, flipped = original
+        lines = _emit(pieces, order, flipped, travel_feed)
+
+    stats['layers'] += 1
+    stats['pieces'] += len(pieces)
+    stats['flipped'] += sum(flipped)
+    stats['travel_before'] += sum(piece['travel_length'] for piece in pieces)
+    stats['travel_after'] += _travel(p0, starts, ends, order, flipped)
+    for line in lines:
+        yield line
+
+
+def _describe(piece, travel_feed):
+    """ Adds the start, end, feeds and whether the piece can be etched backwards """
+    travel = piece['travel']
+    piece['start'] = travel[-1]['end']
+    piece['end'] = piece['lines'][-1]['end'] if piece['lines'] else piece['start']
+    piece['feed_in'] = travel[-1]['feed']
+    piece['motion_out'] = piece['lines'][-1]['motion'] if piece['lines'] else travel[-1]['motion']
+    piece['feed_out'] = piece['lines'][-1]['feed'] if piece['lines'] else travel[-1]['feed']
+    piece['travel_length'] = sum(_distance(item['start'], item['end']) for item in travel
+                                 if None not in item['start'])
+
+    # Only plain G1 moves at one feed can be etched backwards, anything else keeps its direction
+    moves = [item for item in piece['lines'] if item['kind'] != 'inert']
+    flippable = bool(moves)
+    for index, item in enumerate(moves):
+        letters = [letter for letter, value in item['words']]
+        if item['kind'] != 'etch' or item['motion'] != '1' or set(letters) - set('GXYF'):
+            flippable = False
+        elif 'F' in letters and index > 0:
+            flippable = False
+    piece['flippable'] = flippable
+
+
+def optimize(p0, starts, ends, flippable, fixed_end=False, passes=DEFAULT_PASSES):
+    """ Orders pieces to minimize the travel between them
+
+    :param p0: The position before the first piece
+    :param starts: (N, 2) array of the points each piece starts at
+    :param ends: (N, 2) array of the points each piece ends at
+    :param flippable: (N,) boolean array of the pieces that may be etched from end to start
+    :param fixed_end: Keeps the last piece last and in its direction
+    :returns The order as a list of piece indexes and a list of the pieces etched backwards
+    """
+    n = len(starts)
+    if n < 2:
+        return list(range(n)), [False] * n
+
+    movable = n - 1 if fixed_end else n
+    order, flipped = _nearest_neighbour(p0, starts[:movable], ends[:movable], flippable[:movable])
+    if fixed_end:
+        order.append(n - 1)
+        flipped.append(False)
+    return _two_opt(p0, starts, ends, flippable, order, flipped, passes, fixed_end)
+
+
+def _nearest_neighbour(p0, starts, ends, flippable):
+    """ Greedy tour always going to the closest start, or end of a flippable piece """
+    remaining = numpy.ones(len(starts), dtype=bool)
+    position = p0
+    order = []
+    flipped = []
+    for _ in range(len(starts)):
+        to_start = numpy.where(remaining, numpy.linalg.norm(starts - position, axis=1), numpy.inf)
+        to_end = numpy.where(remaining & flippable, numpy.linalg.norm(ends - position, axis=1), numpy.inf)
+        best_start = int(numpy.argmin(to_start))
+        best_end = int(numpy.argmin(to_end))
+        if to_end[best_end] < to_start[best_start]:
+            order.append(best_end)
+            flipped.append(True)
+            position = starts[best_end]
+            remaining[best_end] = False
+        else:
+            order.append(best_start)
+            flipped.append(False)
+            position = ends[best_start]
+            remaining[best_start] = False
+    return order, flipped
+
+
+def _two_opt(p0, starts, ends, flippable, order, flipped, passes, fixed_end):
+    """ Reverses runs of flippable pieces in the tour as long as that shortens the travel
+
+    Reversing the run from i to j etches its pieces in the opposite order and direction,
+    so only the travel into piece i and out of piece j change.
+    """
+    n = len(order)
+    last = n - 1 if fixed_end else n
+    for _ in range(passes):
+        improved = False
+        for i in range(last):
+            entries, exits = _entries(starts, ends, order, flipped)
+            previous = p0 if i == 0 else exits[i - 1]
+
+            # The reversed run can not reach past a piece that has to keep its direction
+            blocked = [k for k in range(i, last) if not flippable[order[k]]]
+            j_max = (blocked[0] if blocked else last) - 1
+            if j_max < i:
+                continue
+
+            j = numpy.arange(i, j_max + 1)
+            following = numpy.minimum(j + 1, n - 1)
+            has_next = j + 1 < n
+            old = numpy.linalg.norm(previous - entries[i]) + \
+                numpy.where(has_next, numpy.linalg.norm(exits[j] - entries[following], axis=1), 0.0)
+            new = numpy.linalg.norm(exits[j] - previous, axis=1) + \
+                numpy.where(has_next, numpy.linalg.norm(entries[i] - entries[following], axis=1), 0.0)
+            gain = old - new
+            best = int(numpy.argmax(gain))
+            if gain[best] > 1e-9:
+                k = int(j[best])
+                order[i:k + 1] = order[i:k + 1][::-1]
+                flipped[i:k + 1] = [not flip for flip in flipped[i:k + 1][::-1]]
+                improved = True
+        if not improved:
+            break
+    return order, flipped
+
+
+def _entries(starts, ends, order, flipped):
+    """ Returns the points the pieces of the tour are entered and left at """
+    order = numpy.asarray(order)
+    flipped = numpy.asarray(flipped, dtype=bool)[:, None]
+    entries = numpy.where(flipped, ends[order], starts[order])
+    exits = numpy.where(flipped, starts[order], ends[order])
+    return entries, exits
+
+
+def _travel(p0, starts, ends, order, flipped):
+    """ Returns the total travel distance of the tour """
+    entries, exits = _entries(starts, ends, order, flipped)
+    previous = numpy.vstack([p0[None, :], exits[:-1]])
+    return float(numpy.linalg.norm(entries - previous, axis=1).sum())
+
+
+def _distance(a, b):
+    return math.hypot(b[0] - a[0], b[1] - a[1])
+
+
+# ----- writing ----- #
+
+def _emit(pieces, order, flipped, travel_feed):
+    """ Returns the lines of the pieces in the given order, None if the modal state at the
+    end of the layer differs from the original and can not be restored """
+    lines = []
+    feed = pieces[0]['travel'][0]['feed_in']
+    for index, flip in zip(order, flipped):
+        piece = pieces[index]
+        entry = piece['end'] if flip else piece['start']
+        travel = piece['travel'][-1]
+        position = ''.join(axis + blocks.format_number(value, PRECISION) for axis, value in zip('XY', entry))
+        if travel['motion'] == '0':
+            lines.append('G0 ' + position)
+        else:
+            lines.append('G1 {} F{}'.format(position, travel['feed']))
+            feed = travel['feed']
+
+        if not _same_feed(feed, piece['feed_in']) and piece['feed_in'] is not None:
+            lines.append('F' + piece['feed_in'])
+
+        if not flip:
+            lines.extend(item['line'] for item in piece['lines'])
+        else:
+            lines.extend(_backwards(piece))
+        feed = piece['feed_out']
+
+    last = pieces[-1]
+    motion = '1' if flipped[-1] else pieces[order[-1]]['motion_out']
+    if motion != last['motion_out']:
+        if last['motion_out'] not in ('0', '1'):
+            return None
+        lines.append('G' + last['motion_out'])
+    if not _same_feed(feed, last['feed_out']):
+        if last['feed_out'] is None:
+            return None
+        lines.append('F' + last['feed_out'])
+    return lines
+
+
+def _backwards(piece):
+    """ Returns the lines etching a piece of plain G1 moves from its end to its start """
+    inert = [item['line'] for item in piece['lines'] if item['kind'] == 'inert']
+    moves = [item for item in piece['lines'] if item['kind'] != 'inert']
+    points = [piece['start']] + [item['end'] for item in moves]
+    feeds = [value for letter, value in moves[0]['words'] if letter == 'F']
+
+    out = list(inert)
+    for number, point in enumerate(reversed(points[:-1])):
+        line = 'G1 ' + ''.join(axis + blocks.format_number(value, PRECISION) for axis, value in zip('XY', point))
+        if number == 0 and feeds:
+            line += ' F' + feeds[-1]
+        out.append(line)
+    return out
+
+
+def _same_feed(a, b):
+    if a is None or b is None:
+        return a is b
+    return float(a) == float(b)
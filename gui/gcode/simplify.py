@@ -0,0 +1,208 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Polyline simplification. Perimeters traced by potrace and sliced by
+   Slic3r carry far more vertices than the laser spot can resolve, the
+   Douglas-Peucker algorithm drops every vertex that lies within a
+   tolerance of the simplified path.
+"""
+import os
+
+import numpy
+
+from gcode import polylines
+
+# Maximum distance in mm between the simplified path and the dropped vertices
+DEFAULT_TOLERANCE = 0.02
+
+
+def new_stats():
+    """ Returns an empty statistics dict for simplify_gcode """
+    return {'lines_in': 0, 'lines_out': 0, 'vertices_in': 0, 'vertices_out': 0, 'max_deviation': 0.0}
+
+
+def douglas_peucker(points, tolerance=DEFAULT_TOLERANCE):
+    """ Simplifies a polyline with the Douglas-Peucker algorithm
+
+    :param points: Sequence or (N, D) array of the vertices
+    :param tolerance: Maximum distance of a dropped vertex from the simplified polyline
+    :returns Boolean array of the vertices kept, the first and last are always kept
+    """
+    points = numpy.asarray(points, dtype=float)
+    keep = numpy.zeros(len(points), dtype=bool)
+    if len(points) == 0:
+        return keep
+    keep[0] = keep[-1] = True
+
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = segment_distances(points[first + 1:last], points[first], points[last])
+        index = int(numpy.argmax(distances))
+        if distances[index] > tolerance:
+            index += first + 1
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return keep
+
+
+def douglas_peucker_many(points, spans, tolerance=DEFAULT_TOLERANCE):
+    """ Simplifies many polylines at once, splitting every segment of a level of all of them together
+
+    Keeps the vertices douglas_peucker keeps on every polyline alone, up to the rounding of
+    vertices equally far from a segment.
+
+    :param points: (N, D) array of the vertices of all the polylines
+    :param spans: (M, 2) array of the first and last vertex index of every polyline, polylines may
+    share their end vertices
+    :returns Boolean array of the vertices kept, the first and last of every polyline are always kept
+    """
+    points = numpy.asarray(points, dtype=float)
+    spans = numpy.asarray(spans, dtype=numpy.int64).reshape(-1, 2)
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[spans.ravel()] = True
+
+    first, last = spans[:, 0], spans[:, 1]
+    while True:
+        active = last - first >= 2
+        first, last = first[active], last[active]
+        if not len(first):
+            return keep
+
+        # The vertices between the ends of every segment, one after the other
+        counts = last - first - 1
+        offsets = numpy.cumsum(counts) - counts
+        owner = numpy.repeat(numpy.arange(len(first)), counts)
+        index = numpy.arange(len(owner)) - offsets[owner] + first[owner] + 1
+
+        # Distances to the segments, computed like segment_distances
+        start = points[first[owner]]
+        direction = points[last[owner]] - start
+        length = (direction * direction).sum(axis=1)
+        t = numpy.clip(((points[index] - start) * direction).sum(axis=1) / numpy.where(length > 0.0, length, 1.0),
+                       0.0, 1.0)
+        distances = numpy.linalg.norm(points[index] - (start + t[:, None] * direction), axis=1)
+
+        # The first vertex furthest from its segment, like numpy.argmax
+        furthest = distances == numpy.maximum.reduceat(distances, offsets)[owner]
+        candidates = numpy.flatnonzero(furthest)
+        groups = owner[candidates]
+        best = candidates[numpy.concatenate([[True], groups[1:] != groups[:-1]])]
+
+        split = distances[best] > tolerance
+        middle = index[best[split]]
+        keep[middle] = True
+        first = numpy.concatenate([first[split], middle])
+        last = numpy.concatenate([middle, last[split]])
+
+
+def segment_distances(points, start, end):
+    """ Returns the distances of the points to the segment from start to end """
+    direction = end - start
+    length = numpy.dot(direction, direction)
+    if length == 0.0:
+        return numpy.linalg.norm(points - start, axis=1)
+    t = numpy.clip((points - start) @ direction / length, 0.0, 1.0)
+    return numpy.linalg.norm(points - (start + t[:, None] * direction), axis=1)
+
+
+def max_deviation(points, keep):
+    """ Returns the largest distance of a dropped vertex from the simplified polyline """
+    points = numpy.asarray(points, dtype=float)
+    kept = numpy.flatnonzero(keep)
+    deviation = 0.0
+    for first, last in zip(kept, kept[1:]):
+        if last - first > 1:
+            deviation = max(deviation, float(segment_distances(points[first + 1:last], points[first],
+                                                               points[last]).max()))
+    return deviation
+
+
+def simplify(points, tolerance=DEFAULT_TOLERANCE):
+    """ Returns the simplified vertices and the maximum deviation from the original polyline """
+    points = numpy.asarray(points, dtype=float)
+    keep = douglas_peucker(points, tolerance)
+    return points[keep], max_deviation(points, keep)
+
+
+def simplify_gcode(lines, tolerance=DEFAULT_TOLERANCE, stats=None):
+    """ Generator yielding the lines with the vertices of G1 polylines simplified
+
+    Runs of consecutive XY G1 moves are simplified, every other block is passed
+    through unchanged. Kept vertices keep their original block.
+
+    :param lines: Iterable of g-code lines, for example an open file
+    :param tolerance: Maximum deviation in mm of the simplified path
+    :param stats: Optional dict from new_stats() updated while simplifying
+    """
+    if stats is None:
+        stats = new_stats()
+
+    for kind, line, words in polylines.runs(lines, stats=stats):
+        if kind == 'line':
+            stats['lines_out'] += 1
+            yield line
+            continue
+
+        start, run = line, words
+        points = [start] + [segment['point'] for segment in run]
+        keep = douglas_peucker(points, tolerance)
+        stats['vertices_in'] += len(run)
+        stats['vertices_out'] += int(keep[1:].sum())
+        stats['max_deviation'] = max(stats['max_deviation'], max_deviation(points, keep))
+
+        # The feed and motion mode of the run may be set by dropped segments, move them to the first one kept
+        feed = run[0]['feed']
+        motion = False
+        for index, (segment, kept) in enumerate(zip(run, keep[1:])):
+            has_motion = any(letter == 'G' for letter, value in segment['words'])
+            if not kept:
+                motion = motion or has_motion
+                continue
+
+            out = segment['line']
+            axes = [letter for letter, value in segment['words'] if letter in 'XY']
+            if len(axes) < 2 or (motion and not has_motion):
+                # A dropped segment may have set the axis this one leaves modal
+                out = ' '.join(['G1'] + polylines.end_words(run[:index + 1], segment['point']) +
+                               [letter + value for letter, value in segment['words'] if letter == 'F'])
+            if feed is not None and segment['feed'] is None:
+                out = '{} F{}'.format(out, feed)
+            feed = None
+            motion = False
+            stats['lines_out'] += 1
+            yield out
+
+
+def simplify_file(filename, file_out=None, tolerance=DEFAULT_TOLERANCE):
+    """ Writes the simplified version of a g-code file
+
+    :returns The output file and the statistics dict
+    """
+    if file_out is None:
+        name, ext = os.path.splitext(filename)
+        file_out = '{}.simple{}'.format(name, ext)
+
+    stats = new_stats()
+    with open(filename, 'r') as f, open(file_out, 'w') as out:
+        for line in simplify_gcode(f, tolerance, stats):
+            out.write(line + '\n')
+
+    return file_out, stats
@@ -0,0 +1,175 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Pre-flight checks of a g-code program before it is streamed. A move
+   outside the bed makes grbl raise a soft limit ALARM partway through
+   the job, ruining the glass etched so far.
+
+   Every move is checked in one vectorized pass against the bed_shape
+   polygon of the Slic3r config.ini and the Z limits of the machine.
+   Arcs are checked at their end points and at the points where they
+   cross the X and Y directions of their center. Blocks grbl rejects or
+   does not support are reported as well, grbl answers them with an
+   error and skips them.
+"""
+import numpy
+
+from gcode import program
+
+# Distance in mm a move may be outside the bed, the coordinates are rounded by the slicer
+TOLERANCE = 0.01
+
+# Number of line numbers listed in a report for each kind of problem
+MAX_REPORTED = 10
+
+
+def new_report():
+    """ Returns an empty validation report
+
+    result is False if a move leaves the bed or the Z limits, the outside, invalid and
+    unsupported entries list the numbers (from 1) of the first lines with each problem.
+    """
+    return {'result': True, 'moves': 0, 'bounds': None, 'outside': [], 'outside_count': 0,
+            'invalid': [], 'invalid_count': 0, 'unsupported': [], 'unsupported_count': 0}
+
+
+def parse_bed_shape(text):
+    """ Returns the (N, 2) array of the bed polygon from a Slic3r bed_shape value like '0x0,60x0,60x60,0x60' """
+    points = [[float(value) for value in point.split('x')] for point in text.split(',') if point.strip()]
+    if len(points) < 3 or any(len(point) != 2 for point in points):
+        raise ValueError('Bed shape needs at least three XxY points: {}'.format(text))
+    return numpy.array(points, dtype=float)
+
+
+def validate(prog, bed=None, z_limits=None, tolerance=TOLERANCE):
+    """ Checks every move of a Program against the bed and the Z limits
+
+    :param prog: The program.Program to check
+    :param bed: (N, 2) array of the bed polygon, None skips the XY check
+    :param z_limits: (minimum, maximum) Z in mm, None skips the Z check
+    :param tolerance: Distance in mm a move may be outside the limits
+    :returns The report dict, see new_report
+    """
+    report = new_report()
+    _report_lines(report, 'invalid', ~prog.valid)
+    _report_lines(report, 'unsupported', prog.valid & ~prog.system & ~prog.supported)
+
+    rows, points, report['moves'] = _move_points(prog)
+    if not len(points):
+        return report
+
+    finite = numpy.isfinite(points)
+    if finite.any(axis=0).all():
+        report['bounds'] = {'min': numpy.nanmin(points, axis=0).tolist(), 'max': numpy.nanmax(points, axis=0).tolist()}
+
+    outside = numpy.zeros(len(points), dtype=bool)
+    if bed is not None:
+        planar = finite[:, 0] & finite[:, 1]
+        outside[planar] |= ~inside_polygon(points[planar, :2], numpy.asarray(bed, dtype=float), tolerance)
+    if z_limits is not None:
+        z = points[:, 2]
+        with numpy.errstate(invalid='ignore'):
+            outside |= (z < z_limits[0] - tolerance) | (z > z_limits[1] + tolerance)
+
+    flagged = numpy.zeros(len(prog), dtype=bool)
+    flagged[rows[outside]] = True
+    _report_lines(report, 'outside', flagged)
+    report['result'] = not report['outside_count']
+    return report
+
+
+def validate_file(filename, bed=None, z_limits=None, tolerance=TOLERANCE):
+    """ Checks a g-code file, see validate """
+    return validate(program.load(filename), bed, z_limits, tolerance)
+
+
+def inside_polygon(points, polygon, tolerance=0.0):
+    """ Returns a boolean array, True for the points inside the polygon or within tolerance of its edges """
+    x, y = points[:, 0, None], points[:, 1, None]
+    xi, yi = polygon[:, 0], polygon[:, 1]
+    xj, yj = numpy.roll(xi, -1), numpy.roll(yi, -1)
+
+    # Even-odd rule, counting the edges a ray towards +X crosses
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        crossing = ((yi > y) != (yj > y)) & (x < (xj - xi) * (y - yi) / (yj - yi) + xi)
+    inside = crossing.sum(axis=1) % 2 == 1
+    if tolerance <= 0.0 or inside.all():
+        return inside
+
+    near = ~inside
+    inside[near] = _edge_distance(points[near], polygon) <= tolerance
+    return inside
+
+
+def _edge_distance(points, polygon):
+    """ Returns the distance of every point to the nearest edge of the polygon """
+    start = polygon[None, :, :]
+    edge = numpy.roll(polygon, -1, axis=0)[None, :, :] - start
+    offset = points[:, None, :] - start
+    length = (edge * edge).sum(axis=2)
+    t = numpy.clip((offset * edge).sum(axis=2) / numpy.where(length > 0.0, length, 1.0), 0.0, 1.0)
+    return numpy.linalg.norm(offset - t[:, :, None] * edge, axis=2).min(axis=1)
+
+
+def _move_points(prog):
+    """ Returns the line index and XYZ position of every point a move reaches and the number of moves
+
+    Axes at an unknown position are NaN. Arcs add the points where they cross the
+    X and Y directions of their center, the furthest points of the arc on each axis.
+    """
+    motion = prog.motions()
+    position = prog.positions()
+    moving = prog.valid & ~prog.system & prog.supported & (prog.command == 0) & \
+        (motion >= program.RAPID) & (motion <= program.CCW_ARC)
+    # Blocks without axis words keep the machine where it is
+    moving &= ~(numpy.isnan(prog.x) & numpy.isnan(prog.y) & numpy.isnan(prog.z) & numpy.isnan(prog.i) &
+                numpy.isnan(prog.j))
+    rows = numpy.flatnonzero(moving)
+    points = [position[rows]]
+    indices = [rows]
+
+    arc = (motion[rows] == program.CW_ARC) | (motion[rows] == program.CCW_ARC)
+    arc_rows = rows[arc]
+    arc_rows = arc_rows[arc_rows > 0]
+    if len(arc_rows):
+        start, end = position[arc_rows - 1], position[arc_rows]
+        known = numpy.isfinite(start[:, :2]).all(axis=1) & numpy.isfinite(end[:, :2]).all(axis=1)
+        arc_rows, start, end = arc_rows[known], start[known], end[known]
+        clockwise = motion[arc_rows] == program.CW_ARC
+        center = program.arc_centers(prog, arc_rows, start, end, clockwise)
+
+        a = start[:, :2] - center
+        b = end[:, :2] - center
+        radius = numpy.linalg.norm(a, axis=1)
+        direction = numpy.where(clockwise, -1.0, 1.0)
+        start_angle = numpy.arctan2(a[:, 1], a[:, 0])
+        sweep = (numpy.arctan2(b[:, 1], b[:, 0]) - start_angle) * direction % (2 * numpy.pi)
+        sweep = numpy.where(sweep <= 1e-9, 2 * numpy.pi, sweep)
+        for angle in (0.0, 0.5 * numpy.pi, numpy.pi, 1.5 * numpy.pi):
+            crossed = (angle - start_angle) * direction % (2 * numpy.pi) <= sweep
+            extreme = numpy.column_stack([center[:, 0] + radius * numpy.cos(angle),
+                                          center[:, 1] + radius * numpy.sin(angle), end[:, 2]])
+            points.append(extreme[crossed])
+            indices.append(arc_rows[crossed])
+
+    return numpy.concatenate(indices), numpy.concatenate(points), len(rows)
+
+
+def _report_lines(report, kind, flagged):
+    """ Stores the count and the first line numbers of the flagged lines in the report """
+    lines = numpy.flatnonzero(flagged)
+    report[kind] = (lines[:MAX_REPORTED] + 1).tolist()
+    report[kind + '_count'] = int(len(lines))
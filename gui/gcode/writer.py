@@ -0,0 +1,103 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Writes the g-code of the toolpaths generated in process. Motion modes,
+   feeds and coordinates still in effect are left out, so the output is
+   as compact as what gcode.compaction makes of Slic3r's files.
+"""
+from gcode import blocks
+
+DEFAULT_PRECISION = 3
+
+
+class GcodeWriter:
+    """ Writes moves in absolute millimeters to an open text file """
+
+    def __init__(self, f, precision=DEFAULT_PRECISION):
+        self.f = f
+        self.precision = precision
+        self.motion = None
+        self.feed = None
+        self.position = [None, None, None]
+        self.lines = 0
+
+    def write(self, line):
+        """ Writes a block as it is """
+        self.f.write(line + '\n')
+        self.lines += 1
+
+    def comment(self, text):
+        """ Writes a comment line """
+        self.write('; ' + text)
+
+    def preamble(self, start_gcode=None):
+        """ Writes the start blocks followed by the millimeter and absolute mode blocks
+
+        :param start_gcode: Blocks run first, a string with one block per line like the
+        start_gcode of the Slic3r config.ini. The position is unknown after them.
+        """
+        if start_gcode:
+            for line in start_gcode.splitlines():
+                if line.strip():
+                    self.write(line.strip())
+        self.write('G21')
+        self.write('G90')
+        self.motion = None
+        self.position = [None, None, None]
+
+    def rapid(self, x=None, y=None, z=None):
+        """ Writes a G0 move, axes left at None do not move """
+        self.move('0', x, y, z)
+
+    def linear(self, x=None, y=None, z=None, feed=None):
+        """ Writes a G1 move at the feed in mm/min, the last feed is kept when it is None """
+        self.move('1', x, y, z, feed)
+
+    def move(self, motion, x=None, y=None, z=None, feed=None):
+        """ Writes a move with only the words that change, nothing if it does not move """
+        texts = [None if value is None else blocks.format_number(value, self.precision) for value in (x, y, z)]
+        self._write_move(motion, texts, None if feed is None else blocks.format_number(feed, self.precision))
+
+    def moves(self, motions, points, feed=None):
+        """ Writes a sequence of moves, formatting all the coordinates at once
+
+        :param motions: The motion ('0' or '1') of the move to each point
+        :param points: (M, 2) XY or (M, 3) XYZ array of the points the moves go to
+        :param feed: Feed in mm/min of the G1 moves
+        """
+        width = len(points[0]) if len(points) else 0
+        texts = blocks.format_numbers([value for point in points for value in point], self.precision)
+        feed = None if feed is None else blocks.format_number(feed, self.precision)
+        for index, motion in enumerate(motions):
+            self._write_move(motion, texts[index * width:(index + 1) * width], feed if motion == '1' else None)
+
+    def _write_move(self, motion, texts, feed):
+        """ Writes a move from the formatted axis values, None for the axes that do not move """
+        words = []
+        for axis, text in enumerate(texts):
+            if text is not None and text != self.position[axis]:
+                words.append(blocks.AXES[axis] + text)
+                self.position[axis] = text
+        if not words:
+            return
+
+        if motion != self.motion:
+            words.insert(0, 'G' + motion)
+            self.motion = motion
+        if feed is not None and feed != self.feed:
+            words.append('F' + feed)
+            self.feed = feed
+        self.write(' '.join(words))
@@ -0,0 +1,128 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Spreads the layers of a mesh over a pool of processes.
+
+   Layers are independent until their toolpaths are written, so chunks
+   of layers are handed to the workers and the results come back in
+   layer order, whatever the number of workers. The mesh arrays are put
+   in shared memory once, the workers map them instead of receiving a
+   pickled copy with every chunk.
+"""
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy
+
+# Chunks of layers handed to every worker, more chunks balance uneven layers better
+CHUNKS_PER_WORKER = 4
+
+# Shared blocks and context of the worker process
+_worker = {}
+
+
+def worker_count(workers=None):
+    """ Returns the number of processes to use, all the cores when workers is None """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return max(int(workers), 1)
+
+
+def share(arrays):
+    """ Copies arrays into new shared memory blocks
+
+    :param arrays: Dict of the arrays by name
+    :returns The list of the blocks, to close and unlink once done, and the dict of the
+    (block name, shape, dtype) of every array to attach them
+    """
+    blocks, specs = [], {}
+    try:
+        for name, array in arrays.items():
+            array = numpy.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(block)
+            numpy.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            specs[name] = (block.name, array.shape, array.dtype.str)
+    except Exception:
+        release(blocks)
+        raise
+    return blocks, specs
+
+
+def attach(specs):
+    """ Maps the shared arrays described by share
+
+    :returns The list of the blocks, to close once done, and the dict of the arrays
+    """
+    blocks, arrays = [], {}
+    for name, (block_name, shape, dtype) in specs.items():
+        # Workers share the resource tracker of the process that created the block,
+        # registering it again there does not free it when a worker exits
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=block.buf)
+    return blocks, arrays
+
+
+def release(blocks):
+    """ Closes and frees shared memory blocks created by share """
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+def map_layers(setup, function, arrays, heights, options=None, workers=None):
+    """ Generator yielding function(context, index, z, **options) for every layer, in layer order
+
+    :param setup: Function building the context of a worker from the dict of the shared arrays
+    :param function: Function computing one layer, both must be defined at module level
+    :param arrays: Dict of the arrays shared with the workers
+    :param heights: Z of every layer
+    :param workers: Number of processes, all the cores when None. With a single one the
+    layers are computed in this process and nothing is shared.
+    """
+    options = options or {}
+    workers = min(worker_count(workers), max(len(heights), 1))
+    layers = list(enumerate(float(z) for z in heights))
+    if workers == 1:
+        context = setup(arrays)
+        for index, z in layers:
+            yield function(context, index, z, **options)
+        return
+
+    size = max(-(-len(layers) // (workers * CHUNKS_PER_WORKER)), 1)
+    tasks = [(function, layers[start:start + size], options) for start in range(0, len(layers), size)]
+    blocks, specs = share(arrays)
+    try:
+        with multiprocessing.Pool(workers, initializer=_initialize, initargs=(setup, specs)) as pool:
+            for results in pool.imap(_run, tasks):
+                for result in results:
+                    yield result
+    finally:
+        release(blocks)
+
+
+def _initialize(setup, specs):
+    """ Attaches the shared arrays in a worker process and builds its context """
+    _worker['blocks'], arrays = attach(specs)
+    _worker['context'] = setup(arrays)
+
+
+def _run(task):
+    """ Computes a chunk of layers in a worker process """
+    function, layers, options = task
+    return [function(_worker['context'], index, z, **options) for index, z in layers]
@@ -0,0 +1,231 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Turns an STL mesh straight into the points etched inside the glass,
+   without slicing it as a 3D print through Slic3r.
+
+   The mesh is sampled on a grid with a configurable pitch per axis. Every
+   layer is cut from the mesh and filled row by row with the even-odd
+   rule, which gives the cells inside the object. A solid fill etches all
+   of them, a shell fill only the ones on the surface of the object. The
+   etched cells of a row are joined into runs, one G1 move each, and the
+   rows of a layer are visited in alternating directions.
+"""
+import os
+
+import numpy
+
+from gcode import writer
+from geometry import parallel
+from geometry import slicing
+from geometry import stlio
+from geometry import transform
+
+# Distance in mm between etched points along X, Y and Z
+DEFAULT_PITCH = (0.1, 0.1, 0.2)
+
+FILLS = ('shell', 'solid')
+
+DEFAULT_ETCH_FEED = 600.0
+
+
+def new_stats():
+    """ Returns an empty statistics dict for etch_layers """
+    return {'layers': 0, 'points': 0, 'runs': 0, 'lines_out': 0}
+
+
+def grid(bounds, pitch=DEFAULT_PITCH):
+    """ Returns the X, Y and Z coordinates of the cell centers of a grid centered in the bounds
+
+    The cells fit within the bounds, so runs etched from the edge of their first cell to the
+    edge of their last one never leave the object, see runs. An axis shorter than the pitch
+    gets a single cell in its middle.
+
+    :param bounds: (2, 3) array of the minimum and maximum corner
+    """
+    axes = []
+    for axis in range(3):
+        low, high = float(bounds[0][axis]), float(bounds[1][axis])
+        count = max(int(numpy.floor((high - low) / pitch[axis] + 1e-9)), 1)
+        offset = (high - low - (count - 1) * pitch[axis]) / 2.0
+        axes.append(low + offset + pitch[axis] * numpy.arange(count))
+    return axes
+
+
+def etch_layers(triangles, pitch=DEFAULT_PITCH, fill='shell', descending=False, workers=1, stats=None):
+    """ Generator yielding the etched cells of every layer of a mesh
+
+    Yields (z, mask, xs, ys) where mask is the (len(ys), len(xs)) boolean array of the
+    cells etched in the layer at height z.
+
+    :param triangles: (N, 3, 3) array of the triangle vertices of a closed mesh
+    :param pitch: Distance between points along X, Y and Z
+    :param fill: 'shell' for the surface only or 'solid' for the whole volume
+    :param descending: Yields the top layer first when True
+    :param workers: Number of processes cutting layers, all the cores when None
+    """
+    if fill not in FILLS:
+        raise ValueError('Unknown fill {}, expected one of {}'.format(fill, ', '.join(FILLS)))
+    if stats is None:
+        stats = new_stats()
+
+    triangles = numpy.asarray(triangles, dtype=numpy.float64)
+    if not len(triangles):
+        return
+    xs, ys, zs = grid(stlio.bounds(triangles), pitch)
+    if descending:
+        zs = zs[::-1]
+
+    layers = slicing.Layers(triangles)
+    solids = parallel.map_layers(_setup, _solid, {'triangles': layers.triangles[layers.order]}, zs,
+                                 {'xs': xs, 'ys': ys}, workers)
+    empty = numpy.zeros((len(ys), len(xs)), dtype=bool)
+    below, solid = empty, next(solids)
+    for z in zs:
+        above = next(solids, empty)
+        mask = solid if fill == 'solid' else shell_mask(below, solid, above)
+        below, solid = solid, above
+
+        stats['layers'] += 1
+        stats['points'] += int(mask.sum())
+        yield float(z), mask, xs, ys
+
+
+def solid_mask(segments, xs, ys):
+    """ Returns the boolean array of the grid cells inside a closed section, see slicing.scanlines """
+    row, start, end = slicing.scanlines(segments, ys)
+    column_start = numpy.searchsorted(xs, start, side='left')
+    column_end = numpy.searchsorted(xs, end, side='right')
+    delta = numpy.zeros((len(ys), len(xs) + 1), dtype=numpy.int32)
+    numpy.add.at(delta, (row, column_start), 1)
+    numpy.add.at(delta, (row, column_end), -1)
+    return numpy.cumsum(delta, axis=1)[:, :-1] > 0
+
+
+def _setup(arrays):
+    """ Returns the Layers of the shared mesh arrays """
+    return slicing.Layers(arrays['triangles'])
+
+
+def _solid(layers, index, z, xs, ys):
+    """ Returns the cells inside the mesh in the layer at height z """
+    return solid_mask(layers.section(z), xs, ys)
+
+
+def shell_mask(below, solid, above):
+    """ Returns the cells of a layer that have a neighbour outside the object, in the layer or the ones around it """
+    inner = solid & below & above
+    inner[1:, :] &= solid[:-1, :]
+    inner[:-1, :] &= solid[1:, :]
+    inner[:, 1:] &= solid[:, :-1]
+    inner[:, :-1] &= solid[:, 1:]
+    inner[0, :] = inner[-1, :] = False
+    inner[:, 0] = inner[:, -1] = False
+    return solid & ~inner
+
+
+def runs(mask, xs, ys, pitch=DEFAULT_PITCH):
+    """ Returns the (R, 2, 2) array of the runs of etched cells of a layer in etching order
+
+    Every run goes from the edge of its first cell to the edge of its last one, so a run of
+    n cells is n pitches long. Rows are visited from low to high Y, every other one backwards.
+    """
+    padded = numpy.zeros((mask.shape[0], mask.shape[1] + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = mask
+    change = numpy.diff(padded, axis=1)
+    rows, starts = numpy.nonzero(change == 1)
+    ends = numpy.nonzero(change == -1)[1] - 1
+    if not len(rows):
+        return numpy.zeros((0, 2, 2))
+
+    # Alternate the direction of the rows that have runs
+    backwards = numpy.searchsorted(numpy.unique(rows), rows) % 2 == 1
+    order = numpy.lexsort((numpy.where(backwards, -starts, starts), rows))
+    rows, starts, ends, backwards = rows[order], starts[order], ends[order], backwards[order]
+
+    half = pitch[0] / 2.0
+    left = xs[starts] - half
+    right = xs[ends] + half
+    out = numpy.empty((len(rows), 2, 2))
+    out[:, 0, 0] = numpy.where(backwards, right, left)
+    out[:, 1, 0] = numpy.where(backwards, left, right)
+    out[:, :, 1] = ys[rows][:, None]
+    return out
+
+
+def write_gcode(f, triangles, pitch=DEFAULT_PITCH, fill='shell', descending=False, etch_feed=DEFAULT_ETCH_FEED,
+                start_gcode=None, workers=1, precision=writer.DEFAULT_PRECISION, stats=None):
+    """ Writes the g-code etching the points of a mesh to an open text file
+
+    Runs are etched with G1 moves at the etch feed, the moves between them are G0.
+    """
+    if stats is None:
+        stats = new_stats()
+
+    out = writer.GcodeWriter(f, precision)
+    out.comment('generated by pointcloud, pitch {} {} {} mm, {} fill'.format(pitch[0], pitch[1], pitch[2], fill))
+    out.preamble(start_gcode)
+    for z, mask, xs, ys in etch_layers(triangles, pitch, fill, descending, workers, stats):
+        layer_runs = runs(mask, xs, ys, pitch)
+        if not len(layer_runs):
+            continue
+        out.rapid(z=z)
+        out.moves(['0', '1'] * len(layer_runs), layer_runs.reshape(-1, 2).tolist(), etch_feed)
+        stats['runs'] += len(layer_runs)
+    stats['lines_out'] = out.lines
+    return stats
+
+
+def write_points(f, triangles, pitch=DEFAULT_PITCH, fill='shell', descending=False, workers=1,
+                 precision=writer.DEFAULT_PRECISION, stats=None):
+    """ Writes the etched points of a mesh to an open text file, one 'x y z' line per point in etching order """
+    if stats is None:
+        stats = new_stats()
+
+    for z, mask, xs, ys in etch_layers(triangles, pitch, fill, descending, workers, stats):
+        rows, columns = numpy.nonzero(mask)
+        if not len(rows):
+            continue
+        backwards = numpy.searchsorted(numpy.unique(rows), rows) % 2 == 1
+        order = numpy.lexsort((numpy.where(backwards, -columns, columns), rows))
+        points = numpy.column_stack([xs[columns[order]], ys[rows[order]], numpy.full(len(rows), z)])
+        numpy.savetxt(f, points, fmt='%.{}f'.format(precision))
+        stats['lines_out'] += len(points)
+    return stats
+
+
+def pointcloud_file(filename, file_out=None, pitch=DEFAULT_PITCH, fill='shell', center=None, descending=False,
+                    etch_feed=DEFAULT_ETCH_FEED, start_gcode=None, points=False, workers=1):
+    """ Generates the etch points of an STL file
+
+    :param center: (x, y) the mesh is centered on, it is left where it is when None. The
+    bottom of the mesh is always moved to Z 0.
+    :param points: Writes a '.xyz' point file instead of g-code
+    :returns The output file and the statistics dict
+    """
+    if file_out is None:
+        name, ext = os.path.splitext(filename)
+        file_out = name + ('.xyz' if points else '.gcode')
+
+    triangles = transform.place(stlio.read(filename), center)
+
+    stats = new_stats()
+    with open(file_out, 'w') as f:
+        if points:
+            write_points(f, triangles, pitch, fill, descending, workers, stats=stats)
+        else:
+            write_gcode(f, triangles, pitch, fill, descending, etch_feed, start_gcode, workers, stats=stats)
+    return file_out, stats
@@ -0,0 +1,193 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Cuts triangle meshes with horizontal planes. Every triangle crossing
+   a plane gives one segment of the section, all triangles of a layer
+   are cut at once with array operations.
+"""
+import numpy
+
+# Pairs of vertices of the three edges of a triangle
+EDGES = numpy.array([[0, 1], [1, 2], [2, 0]])
+
+
+class Layers:
+    """ Finds the triangles crossing a plane without testing the whole mesh for every layer """
+
+    def __init__(self, triangles, ids=None):
+        """
+        :param triangles: (N, 3, 3) array of the triangle vertices
+        :param ids: (N, 3) array of the vertex ids from weld, computed when first needed if None
+        """
+        self.triangles = numpy.asarray(triangles, dtype=numpy.float64)
+        z = self.triangles[:, :, 2]
+        self.order = numpy.argsort(z.min(axis=1), kind='stable')
+        self.bottom = z.min(axis=1)[self.order]
+        self.top = z.max(axis=1)[self.order]
+        self.ids = ids
+
+    def crossing(self, z):
+        """ Returns the indices of the triangles that may cross the plane at height z """
+        candidates = self.order[:numpy.searchsorted(self.bottom, z, side='right')]
+        return candidates[self.top[:len(candidates)] > z]
+
+    def section(self, z):
+        """ Returns the (S, 2, 2) array of the XY segments of the section at height z """
+        return section(self.triangles[self.crossing(z)], z)
+
+    def contours(self, z):
+        """ Returns the closed contours and the open chains of the section at height z, see link """
+        if self.ids is None:
+            self.ids = weld(self.triangles)
+        candidates = self.crossing(z)
+        return link(*cut(self.triangles[candidates], z, self.ids[candidates]))
+
+
+def weld(triangles):
+    """ Returns the (N, 3) array of ids of the triangle vertices, equal for vertices at the same position """
+    vertices = numpy.ascontiguousarray(numpy.asarray(triangles).reshape(-1, 3))
+    if not len(vertices):
+        return numpy.zeros((0, 3), dtype=numpy.int64)
+    order = numpy.lexsort(vertices.T)
+    ordered = vertices[order]
+    new = numpy.ones(len(ordered), dtype=bool)
+    new[1:] = (ordered[1:] != ordered[:-1]).any(axis=1)
+    ids = numpy.empty(len(ordered), dtype=numpy.int64)
+    ids[order] = numpy.cumsum(new) - 1
+    return ids.reshape(-1, 3)
+
+
+def section(triangles, z):
+    """ Returns the (S, 2, 2) array of the XY segments where a plane at height z cuts the triangles
+
+    A vertex exactly on the plane counts as below it, so every crossing triangle has
+    exactly two edges crossing the plane and gives one segment.
+    """
+    return cut(triangles, z)[0]
+
+
+def cut(triangles, z, ids=None):
+    """ Cuts the triangles with the plane at height z
+
+    Every segment runs from the edge going down through the plane to the edge going up,
+    for triangles wound counter clockwise seen from outside that leaves the inside of
+    the section on its left.
+
+    :param ids: (N, 3) array of the vertex ids from weld
+    :returns The (S, 2, 2) array of the segments and, with ids, the (S, 2) keys of the
+    edges the segments start and end on, equal for the same edge in both its triangles
+    """
+    triangles = numpy.asarray(triangles, dtype=numpy.float64)
+    above = triangles[:, :, 2] > z
+    count = above.sum(axis=1)
+    crossing = (count == 1) | (count == 2)
+    triangles, above = triangles[crossing], above[crossing]
+    if not len(triangles):
+        return numpy.zeros((0, 2, 2)), None if ids is None else numpy.zeros((0, 2), dtype=numpy.int64)
+
+    start = triangles[:, EDGES[:, 0]]
+    end = triangles[:, EDGES[:, 1]]
+    down = above[:, EDGES[:, 0]] & ~above[:, EDGES[:, 1]]
+    up = ~above[:, EDGES[:, 0]] & above[:, EDGES[:, 1]]
+    dz = end[:, :, 2] - start[:, :, 2]
+    t = (z - start[:, :, 2]) / numpy.where(down | up, dz, 1.0)
+    points = start[:, :, :2] + t[:, :, None] * (end[:, :, :2] - start[:, :, :2])
+
+    first = numpy.argmax(down, axis=1)
+    second = numpy.argmax(up, axis=1)
+    index = numpy.arange(len(triangles))
+    segments = numpy.stack([points[index, first], points[index, second]], axis=1)
+    if ids is None:
+        return segments, None
+
+    ids = numpy.asarray(ids)[crossing]
+    a, b = ids[:, EDGES[:, 0]], ids[:, EDGES[:, 1]]
+    low, high = numpy.minimum(a, b), numpy.maximum(a, b)
+    keys = low * (int(ids.max()) + 1) + high
+    return segments, numpy.stack([keys[index, first], keys[index, second]], axis=1)
+
+
+def link(segments, keys):
+    """ Links the segments of a section into contours
+
+    The segment ending on an edge is followed by the one starting on it. Contours are
+    counter clockwise around the inside of the mesh and clockwise around holes.
+
+    :returns The list of the (M, 2) arrays of the closed contours, the first point not
+    repeated at the end, and the list of the chains that do not close
+    """
+    loops, chains = [], []
+    if not len(segments):
+        return loops, chains
+
+    order = numpy.argsort(keys[:, 0], kind='stable')
+    position = numpy.minimum(numpy.searchsorted(keys[order, 0], keys[:, 1]), len(order) - 1)
+    following = numpy.where(keys[order[position], 0] == keys[:, 1], order[position], -1).tolist()
+    previous = [-1] * len(segments)
+    for segment, after in enumerate(following):
+        if after >= 0:
+            previous[after] = segment
+
+    visited = [False] * len(segments)
+    # Chains first, from the segments nothing leads to
+    starts = [segment for segment in range(len(segments)) if previous[segment] < 0] + list(range(len(segments)))
+    for first in starts:
+        if visited[first]:
+            continue
+        path = []
+        segment = first
+        while segment >= 0 and not visited[segment]:
+            visited[segment] = True
+            path.append(segment)
+            segment = following[segment]
+        if segment == first:
+            loops.append(segments[path, 0])
+        else:
+            chains.append(numpy.concatenate([segments[path, 0], segments[path[-1:], 1]]))
+    return loops, chains
+
+
+def scanlines(segments, ys):
+    """ Returns the intervals inside a closed section along the rows at the given Y
+
+    Every row is inside between pairs of the points where it crosses the section, sorted
+    along X (even-odd rule). Segment ends exactly on a row count as above it.
+
+    :param ys: Sorted array of the Y of the rows
+    :returns The row index, start X and end X arrays of the intervals, sorted by row then X
+    """
+    empty = numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0), numpy.zeros(0)
+    if not len(segments) or not len(ys):
+        return empty
+
+    y0, y1 = segments[:, 0, 1], segments[:, 1, 1]
+    first = numpy.searchsorted(ys, numpy.minimum(y0, y1), side='left')
+    last = numpy.searchsorted(ys, numpy.maximum(y0, y1), side='left')
+    counts = last - first
+    if not counts.sum():
+        return empty
+
+    # One crossing per segment and row it spans
+    segment = numpy.repeat(numpy.arange(len(segments)), counts)
+    row = numpy.repeat(first - numpy.cumsum(counts) + counts, counts) + numpy.arange(counts.sum())
+    a, b = segments[segment, 0], segments[segment, 1]
+    x = a[:, 0] + (ys[row] - a[:, 1]) * (b[:, 0] - a[:, 0]) / (b[:, 1] - a[:, 1])
+
+    order = numpy.lexsort((x, row))
+    row, x = row[order], x[order]
+    rank = numpy.arange(len(row)) - numpy.searchsorted(row, row, side='left')
+    start = numpy.flatnonzero((rank % 2 == 0)[:-1] & (row[1:] == row[:-1]))
+    return row[start], x[start], x[start + 1]
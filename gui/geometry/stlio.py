@@ -0,0 +1,163 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Reads and writes STL meshes as (N, 3, 3) NumPy arrays of triangle
+   vertices, without going through FreeCAD.
+
+   Binary files are memory mapped, the vertices array is a view of the
+   file and nothing is read until it is used, so every mesh step starts
+   without copying. ASCII files are parsed a chunk at a time.
+"""
+import os
+import re
+
+import numpy
+
+HEADER_SIZE = 80
+COUNT_SIZE = 4
+RECORD_DTYPE = numpy.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+
+# Bytes of an ASCII file parsed at once and triangles of a file written at once
+CHUNK_SIZE = 1 << 24
+CHUNK_TRIANGLES = 1 << 20
+
+VERTEX = re.compile(rb'vertex\s+(\S+\s+\S+\s+\S+)')
+
+FACET = ' facet normal {:e} {:e} {:e}\n  outer loop\n   vertex {:e} {:e} {:e}\n   vertex {:e} {:e} {:e}\n' \
+        '   vertex {:e} {:e} {:e}\n  endloop\n endfacet\n'
+
+
+def read(filename, mmap=True):
+    """ Returns the (N, 3, 3) float32 array of the triangle vertices of a binary or ASCII STL file
+
+    :param mmap: Binary files are memory mapped read only and the array is a view of the
+    file when True, nothing is copied until the vertices are used
+    """
+    if is_binary(filename):
+        return read_records(filename, mmap)['vertices']
+    return read_ascii(filename)
+
+
+def read_records(filename, mmap=True):
+    """ Returns the records of a binary STL file, with the normal, vertices and attribute fields """
+    count = _binary_count(filename)
+    if not count:
+        return numpy.zeros(0, dtype=RECORD_DTYPE)
+    if mmap:
+        return numpy.memmap(filename, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE + COUNT_SIZE, shape=(count,))
+    with open(filename, 'rb') as f:
+        f.seek(HEADER_SIZE + COUNT_SIZE)
+        return numpy.fromfile(f, dtype=RECORD_DTYPE, count=count)
+
+
+def read_ascii(filename, chunk_size=CHUNK_SIZE):
+    """ Returns the (N, 3, 3) float32 array of the triangle vertices of an ASCII STL file
+
+    The file is parsed a chunk of whole lines at a time, so only the vertices are held in
+    memory, never the text of the whole file.
+    """
+    chunks = []
+    rest = b''
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            data = rest + data
+            end = data.rfind(b'\n') + 1
+            rest = data[end:]
+            chunks.append(_parse_vertices(data[:end]))
+    chunks.append(_parse_vertices(rest))
+
+    values = numpy.concatenate(chunks)
+    if len(values) % 9:
+        raise ValueError('Truncated ASCII STL: {}'.format(filename))
+    return values.reshape(-1, 3, 3)
+
+
+def is_binary(filename):
+    """ Tells a binary STL from an ASCII one, binary headers may start with 'solid' too """
+    size = os.path.getsize(filename)
+    if size < HEADER_SIZE + COUNT_SIZE:
+        return False
+    with open(filename, 'rb') as f:
+        start = f.read(HEADER_SIZE)
+        count = int(numpy.frombuffer(f.read(COUNT_SIZE), dtype='<u4')[0])
+    return size == HEADER_SIZE + COUNT_SIZE + count * RECORD_DTYPE.itemsize or not start.lstrip().startswith(b'solid')
+
+
+def normals(triangles):
+    """ Returns the (N, 3) array of the unit normals of the triangles, following the right hand rule
+
+    Degenerate triangles get a zero normal.
+    """
+    triangles = numpy.asarray(triangles)
+    normal = numpy.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    length = numpy.linalg.norm(normal, axis=1, keepdims=True)
+    return normal / numpy.where(length > 0.0, length, 1.0)
+
+
+def bounds(triangles):
+    """ Returns the (2, 3) array of the minimum and maximum corner of the bounding box of the triangles """
+    triangles = numpy.asarray(triangles)
+    if not len(triangles):
+        return numpy.zeros((2, 3))
+    return numpy.array([triangles.min(axis=(0, 1)), triangles.max(axis=(0, 1))], dtype=numpy.float64)
+
+
+def write(filename, triangles, binary=True, name='mesh'):
+    """ Writes the triangles to an STL file with their computed normals
+
+    :param triangles: (N, 3, 3) array of the triangle vertices
+    :param binary: Writes a binary STL when True, an ASCII one otherwise
+    :param name: Name of the solid, stored in the header of binary files
+    """
+    triangles = numpy.asarray(triangles)
+    with open(filename, 'wb') as f:
+        if binary:
+            f.write('{} exported by stlio'.format(name).encode('ascii', 'replace')[:HEADER_SIZE].ljust(HEADER_SIZE))
+            f.write(numpy.array([len(triangles)], dtype='<u4').tobytes())
+        else:
+            f.write('solid {}\n'.format(name).encode('ascii', 'replace'))
+
+        for start in range(0, len(triangles), CHUNK_TRIANGLES):
+            chunk = triangles[start:start + CHUNK_TRIANGLES]
+            if binary:
+                records = numpy.zeros(len(chunk), dtype=RECORD_DTYPE)
+                records['vertices'] = chunk
+                records['normal'] = normals(records['vertices'])
+                f.write(records.tobytes())
+            else:
+                values = numpy.column_stack([normals(chunk), chunk.reshape(-1, 9)]).tolist()
+                f.write(''.join(FACET.format(*row) for row in values).encode('ascii'))
+
+        if not binary:
+            f.write('endsolid {}\n'.format(name).encode('ascii', 'replace'))
+
+
+def _binary_count(filename):
+    """ Returns the number of triangles of a binary STL file, from its size if the header count is wrong """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        f.seek(HEADER_SIZE)
+        count = int(numpy.frombuffer(f.read(COUNT_SIZE), dtype='<u4')[0])
+    available = (size - HEADER_SIZE - COUNT_SIZE) // RECORD_DTYPE.itemsize
+    return count if count <= available else available
+
+
+def _parse_vertices(data):
+    """ Returns the flat float32 array of the vertex coordinates in a chunk of ASCII STL text """
+    return numpy.array(b' '.join(VERTEX.findall(data)).split(), dtype=numpy.float32)
@@ -0,0 +1,235 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Slices an STL mesh into outline and fill toolpaths in process, in
+   place of the Slic3r subprocess.
+
+   Every layer is cut from the mesh at its middle height and the cut
+   segments are linked into closed contours through the mesh edges they
+   lie on. The contours are etched as outlines, then the inside is filled
+   with parallel lines, the fill angle turning by 90 degrees every layer
+   like Slic3r's rectilinear fill. Fill lines are etched in alternating
+   directions.
+"""
+import os
+
+import numpy
+
+from gcode import writer
+from geometry import parallel
+from geometry import slicing
+from geometry import stlio
+from geometry import transform
+
+DEFAULT_LAYER_HEIGHT = 1.0
+DEFAULT_FILL_SPACING = 1.0
+DEFAULT_FILL_ANGLE = 45.0
+
+# Feeds in mm/min, the perimeter_speed and infill_speed of the Slic3r config.ini
+DEFAULT_OUTLINE_FEED = 3600.0
+DEFAULT_FILL_FEED = 4800.0
+
+
+def new_stats():
+    """ Returns an empty statistics dict for slice_layers """
+    return {'layers': 0, 'contours': 0, 'open_contours': 0, 'fill_lines': 0, 'lines_out': 0}
+
+
+def layer_heights(bottom, top, layer_height=DEFAULT_LAYER_HEIGHT):
+    """ Returns the Z of the middle of every layer between the bottom and the top """
+    count = max(int(numpy.ceil((top - bottom) / layer_height - 1e-9)), 1)
+    return bottom + layer_height * (numpy.arange(count) + 0.5)
+
+
+def slice_layers(triangles, layer_height=DEFAULT_LAYER_HEIGHT, fill_spacing=DEFAULT_FILL_SPACING,
+                 fill_angle=DEFAULT_FILL_ANGLE, workers=1, stats=None):
+    """ Generator yielding the toolpaths of every layer of a mesh, from the bottom up
+
+    Yields (z, outlines, fill) where outlines is the list of the (M, 2) arrays of the
+    contours, closed ones ending at their first point, and fill the (L, 2, 2) array of
+    the fill lines in etching order.
+
+    :param triangles: (N, 3, 3) array of the triangle vertices of a closed mesh
+    :param fill_spacing: Distance in mm between fill lines, no fill when None or 0
+    :param fill_angle: Angle in degrees of the fill lines of the first layer
+    :param workers: Number of processes slicing layers, all the cores when None. The
+    output is the same for any number.
+    """
+    if stats is None:
+        stats = new_stats()
+
+    triangles = numpy.asarray(triangles, dtype=numpy.float64)
+    if not len(triangles):
+        return
+    low, high = stlio.bounds(triangles)
+    layers = slicing.Layers(triangles)
+    # Sorted like the workers index them, so they do not sort the mesh again
+    arrays = {'triangles': layers.triangles[layers.order], 'ids': slicing.weld(triangles)[layers.order]}
+    options = {'fill_spacing': fill_spacing, 'fill_angle': fill_angle}
+    heights = layer_heights(low[2], high[2], layer_height)
+    for z, outlines, fill, contours, chains in parallel.map_layers(_setup, _layer, arrays, heights, options, workers):
+        stats['layers'] += 1
+        stats['contours'] += contours
+        stats['open_contours'] += chains
+        stats['fill_lines'] += len(fill)
+        yield z, outlines, fill
+
+
+def fill_lines(loops, spacing, angle=0.0):
+    """ Returns the (L, 2, 2) array of the fill lines inside closed contours
+
+    Lines are at the given angle in degrees and spacing in mm, on the same grid in every
+    layer, ordered across the contours and in alternating directions.
+    """
+    if not loops:
+        return numpy.zeros((0, 2, 2))
+
+    cos, sin = numpy.cos(numpy.radians(angle)), numpy.sin(numpy.radians(angle))
+    # Rotates the contours so the fill lines run along X
+    to_fill = numpy.array([[cos, sin], [-sin, cos]])
+    segments = numpy.concatenate([numpy.stack([loop, numpy.roll(loop, -1, axis=0)], axis=1) for loop in loops])
+    segments = segments.dot(to_fill.T)
+
+    low, high = segments[:, :, 1].min(), segments[:, :, 1].max()
+    ys = spacing * numpy.arange(numpy.ceil(low / spacing), numpy.floor(high / spacing) + 1)
+    row, start, end = slicing.scanlines(segments, ys)
+    if not len(row):
+        return numpy.zeros((0, 2, 2))
+
+    backwards = numpy.searchsorted(numpy.unique(row), row) % 2 == 1
+    order = numpy.lexsort((numpy.where(backwards, -start, start), row))
+    row, start, end, backwards = row[order], start[order], end[order], backwards[order]
+    lines = numpy.empty((len(row), 2, 2))
+    lines[:, 0, 0] = numpy.where(backwards, end, start)
+    lines[:, 1, 0] = numpy.where(backwards, start, end)
+    lines[:, :, 1] = ys[row][:, None]
+    return lines.dot(to_fill)
+
+
+def _setup(arrays):
+    """ Returns the Layers of the shared mesh arrays """
+    return slicing.Layers(arrays['triangles'], arrays['ids'])
+
+
+def _layer(layers, index, z, fill_spacing, fill_angle):
+    """ Returns the outlines and fill lines of a layer, with the number of closed and open contours """
+    loops, chains = layers.contours(z)
+    outlines = [numpy.concatenate([loop, loop[:1]]) for loop in loops] + chains
+    fill = numpy.zeros((0, 2, 2))
+    if fill_spacing:
+        fill = fill_lines(loops, fill_spacing, fill_angle + 90.0 * (index % 2))
+    return z, outlines, fill, len(loops), len(chains)
+
+
+def extrusion_layers(polygons, depth, layer_height=DEFAULT_LAYER_HEIGHT, fill_spacing=DEFAULT_FILL_SPACING,
+                     fill_angle=DEFAULT_FILL_ANGLE, stats=None):
+    """ Generator yielding the toolpaths of every layer of closed polygons extruded from Z 0 to the depth
+
+    The section of an extrusion is the same at every height, the polygons are the contours
+    of every layer and the fill is only computed for the two fill angles. See slice_layers.
+
+    :param polygons: List of the (M, 2) arrays of the outer boundaries, counter clockwise,
+    and of the holes, clockwise, like the traced shapes of imaging.contours
+    """
+    if stats is None:
+        stats = new_stats()
+
+    loops = [numpy.asarray(polygon, dtype=numpy.float64) for polygon in polygons if len(polygon) > 2]
+    outlines = [numpy.concatenate([loop, loop[:1]]) for loop in loops]
+    fills = [numpy.zeros((0, 2, 2))] * 2
+    if fill_spacing:
+        fills = [fill_lines(loops, fill_spacing, fill_angle + 90.0 * parity) for parity in range(2)]
+    for index, z in enumerate(layer_heights(0.0, depth, layer_height)):
+        stats['layers'] += 1
+        stats['contours'] += len(loops)
+        stats['fill_lines'] += len(fills[index % 2])
+        yield float(z), outlines, fills[index % 2]
+
+
+def write_gcode(f, triangles, layer_height=DEFAULT_LAYER_HEIGHT, fill_spacing=DEFAULT_FILL_SPACING,
+                fill_angle=DEFAULT_FILL_ANGLE, outline_feed=DEFAULT_OUTLINE_FEED, fill_feed=DEFAULT_FILL_FEED,
+                start_gcode=None, workers=1, precision=writer.DEFAULT_PRECISION, stats=None):
+    """ Writes the g-code etching the toolpaths of a mesh to an open text file
+
+    Outlines and fill lines are G1 moves, the moves between them are G0.
+    """
+    if stats is None:
+        stats = new_stats()
+
+    out = writer.GcodeWriter(f, precision)
+    out.comment('generated by toolpaths, layer height {} mm, fill spacing {} mm'.format(layer_height, fill_spacing))
+    out.preamble(start_gcode)
+    write_layers(out, slice_layers(triangles, layer_height, fill_spacing, fill_angle, workers, stats), outline_feed,
+                 fill_feed)
+    stats['lines_out'] = out.lines
+    return stats
+
+
+def write_layers(out, layers, outline_feed=DEFAULT_OUTLINE_FEED, fill_feed=DEFAULT_FILL_FEED):
+    """ Writes the (z, outlines, fill) layers of slice_layers or extrusion_layers with a gcode.writer.GcodeWriter """
+    for z, outlines, fill in layers:
+        if not outlines and not len(fill):
+            continue
+        out.rapid(z=z)
+        for outline in outlines:
+            out.moves(['0'] + ['1'] * (len(outline) - 1), outline.tolist(), outline_feed)
+        out.moves(['0', '1'] * len(fill), fill.reshape(-1, 2).tolist(), fill_feed)
+
+
+def extrude_file(polygons, file_out, depth, center=None, layer_height=DEFAULT_LAYER_HEIGHT,
+                 fill_spacing=DEFAULT_FILL_SPACING, fill_angle=DEFAULT_FILL_ANGLE, outline_feed=DEFAULT_OUTLINE_FEED,
+                 fill_feed=DEFAULT_FILL_FEED, start_gcode=None, precision=writer.DEFAULT_PRECISION):
+    """ Writes the g-code of closed polygons extruded to the depth, without going through an STL mesh
+
+    :param center: (x, y) the polygons are centered on, they are left where they are when None
+    :returns The output file and the statistics dict
+    """
+    polygons = [numpy.asarray(polygon, dtype=numpy.float64) for polygon in polygons]
+    if center is not None and polygons:
+        points = numpy.concatenate(polygons)
+        offset = numpy.asarray(center, dtype=numpy.float64) - (points.min(axis=0) + points.max(axis=0)) / 2.0
+        polygons = [polygon + offset for polygon in polygons]
+
+    stats = new_stats()
+    with open(file_out, 'w') as f:
+        out = writer.GcodeWriter(f, precision)
+        out.comment('generated by toolpaths, extrusion depth {} mm, layer height {} mm, fill spacing {} mm'.format(
+            depth, layer_height, fill_spacing))
+        out.preamble(start_gcode)
+        write_layers(out, extrusion_layers(polygons, depth, layer_height, fill_spacing, fill_angle, stats),
+                     outline_feed, fill_feed)
+        stats['lines_out'] = out.lines
+    return file_out, stats
+
+
+def slice_file(filename, file_out=None, center=None, layer_height=DEFAULT_LAYER_HEIGHT,
+               fill_spacing=DEFAULT_FILL_SPACING, fill_angle=DEFAULT_FILL_ANGLE, outline_feed=DEFAULT_OUTLINE_FEED,
+               fill_feed=DEFAULT_FILL_FEED, start_gcode=None, workers=1):
+    """ Slices an STL file into g-code, see slice_layers
+
+    :param center: (x, y) the mesh is centered on, it is left where it is when None. The
+    bottom of the mesh is always moved to Z 0.
+    :returns The output file and the statistics dict
+    """
+    if file_out is None:
+        file_out = os.path.splitext(filename)[0] + '.gcode'
+
+    triangles = transform.place(stlio.read(filename), center)
+    stats = new_stats()
+    with open(file_out, 'w') as f:
+        write_gcode(f, triangles, layer_height, fill_spacing, fill_angle, outline_feed, fill_feed, start_gcode,
+                    workers, stats=stats)
+    return file_out, stats
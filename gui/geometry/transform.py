@@ -0,0 +1,172 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Fits a mesh into the etching volume of the glass in one pass.
+
+   The scale is computed from the bounding box, uniform so the object
+   keeps its proportions or per axis to fill the volume, and the mesh is
+   centered in the volume. An orientation can be chosen among the 24
+   rotations of the mesh onto the axes, the one giving the largest
+   object and, among those as large, the lowest one, which is etched in
+   the fewest layers. In a cube every rotation gives the same size, so
+   only the height decides there. A transform is a 3x3 matrix and an
+   offset, applied to every vertex with a single matrix product.
+"""
+import itertools
+import os
+
+import numpy
+
+from geometry import stlio
+
+SCALES = ('uniform', 'axis')
+
+
+def new_stats():
+    """ Returns an empty statistics dict for fit """
+    return {'scale': [1.0, 1.0, 1.0], 'rotation': numpy.eye(3).tolist(), 'size_before': [0.0, 0.0, 0.0],
+            'size_after': [0.0, 0.0, 0.0]}
+
+
+def scaling(sx, sy, sz):
+    """ Returns the matrix scaling the axes by the given factors """
+    return numpy.diag([float(sx), float(sy), float(sz)])
+
+
+def rotation(axis, degrees):
+    """ Returns the matrix rotating by the angle in degrees around the X, Y or Z axis (0, 1 or 2), right handed """
+    angle = numpy.radians(degrees)
+    cos, sin = numpy.cos(angle), numpy.sin(angle)
+    first, second = [a for a in range(3) if a != axis]
+    matrix = numpy.eye(3)
+    matrix[first, first] = matrix[second, second] = cos
+    matrix[first, second] = -sin
+    matrix[second, first] = sin
+    # Rotating around Y turns Z towards X
+    return matrix.T if axis == 1 else matrix
+
+
+def orientations():
+    """ Returns the 24 rotation matrices mapping the axes onto the axes, the identity first """
+    matrices = []
+    for permutation in itertools.permutations(range(3)):
+        for signs in itertools.product((1.0, -1.0), repeat=3):
+            matrix = numpy.zeros((3, 3))
+            matrix[range(3), permutation] = signs
+            if numpy.linalg.det(matrix) > 0.0:
+                matrices.append(matrix)
+    return matrices
+
+
+def apply(triangles, matrix, offset=(0.0, 0.0, 0.0)):
+    """ Returns the (N, 3, 3) float32 array of the vertices transformed by the matrix then moved by the offset """
+    triangles = numpy.asarray(triangles, dtype=numpy.float64)
+    out = numpy.matmul(triangles, numpy.asarray(matrix, dtype=numpy.float64).T)
+    out += numpy.asarray(offset, dtype=numpy.float64)
+    return out.astype(numpy.float32)
+
+
+def place(triangles, center=None):
+    """ Returns the float64 vertices moved so the bottom of the mesh is at Z 0
+
+    :param center: (x, y) the middle of the bounding box is moved to, None leaves X and Y as they are
+    """
+    triangles = numpy.array(triangles, dtype=numpy.float64)
+    if not len(triangles):
+        return triangles
+    low, high = stlio.bounds(triangles)
+    offset = numpy.array([0.0, 0.0, -low[2]])
+    if center is not None:
+        offset[:2] = numpy.asarray(center, dtype=numpy.float64) - (low[:2] + high[:2]) / 2.0
+    triangles += offset
+    return triangles
+
+
+def scale_factors(size, limits, scale='uniform', grow=True):
+    """ Returns the X, Y and Z factors scaling a bounding box of the size into the limits, see fit
+
+    Axes of size 0 are not scaled.
+    """
+    size = numpy.asarray(size, dtype=numpy.float64)
+    limits = numpy.asarray(limits, dtype=numpy.float64)
+    with numpy.errstate(divide='ignore'):
+        factors = numpy.where(size > 0.0, limits / numpy.where(size > 0.0, size, 1.0), numpy.inf)
+    if scale == 'uniform':
+        factors[:] = factors.min() if numpy.isfinite(factors).any() else 1.0
+    factors[~numpy.isfinite(factors)] = 1.0
+    if not grow:
+        factors = numpy.minimum(factors, 1.0)
+    return factors
+
+
+def fit(triangles, limits, scale='uniform', grow=True, orient=False):
+    """ Returns the matrix and offset fitting the mesh into the box from the origin to the limits
+
+    :param limits: (x, y, z) size in mm of the etching volume
+    :param scale: 'uniform' keeps the proportions of the mesh, 'axis' fills every axis
+    :param grow: Meshes smaller than the volume are enlarged when True, only shrunk otherwise
+    :param orient: Tries all the rotations onto the axes and keeps the largest fit, the lowest one
+    on ties, when True. Stretched per axis into a cube, every rotation fills it the same way.
+    :returns The matrix, the offset and the statistics dict
+    """
+    if scale not in SCALES:
+        raise ValueError('Unknown scale {}, expected one of {}'.format(scale, ', '.join(SCALES)))
+
+    stats = new_stats()
+    limits = numpy.asarray(limits, dtype=numpy.float64)
+    low, high = stlio.bounds(triangles)
+    size = high - low
+    stats['size_before'] = size.tolist()
+
+    best = None
+    for matrix in (orientations() if orient else [numpy.eye(3)]):
+        rotated = numpy.abs(matrix).dot(size)
+        factors = scale_factors(rotated, limits, scale, grow)
+        volume = numpy.prod(numpy.where(rotated > 0.0, rotated * factors, 1.0))
+        height = rotated[2] * factors[2]
+        # Larger first, then lower, the first orientation is kept on ties
+        if (best is None or volume > best[0] * (1.0 + 1e-9) or
+                (volume >= best[0] * (1.0 - 1e-9) and height < best[3] - 1e-9 * limits[2])):
+            best = volume, matrix, factors, height
+
+    volume, matrix, factors, height = best
+    matrix = scaling(*factors).dot(matrix)
+    center = matrix.dot((low + high) / 2.0)
+    offset = limits / 2.0 - center
+
+    stats['scale'] = factors.tolist()
+    stats['rotation'] = best[1].tolist()
+    stats['size_after'] = (numpy.abs(matrix).dot(size)).tolist()
+    return matrix, offset, stats
+
+
+def fit_file(filename, limits, file_out=None, scale='uniform', grow=True, orient=False):
+    """ Fits the mesh of an STL file into the etching volume, see fit
+
+    :param file_out: The STL file written, the input file is overwritten when None
+    :returns The output file and the statistics dict
+    """
+    if file_out is None:
+        file_out = filename
+
+    # Not memory mapped, the input file may be the one overwritten
+    triangles = stlio.read(filename, mmap=False)
+    matrix, offset, stats = fit(triangles, limits, scale, grow, orient)
+    triangles = apply(triangles, matrix, offset)
+
+    name = os.path.splitext(os.path.basename(filename))[0]
+    stlio.write(file_out, triangles, name=name)
+    return file_out, stats
@@ -0,0 +1,155 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Converts images to monochrome bitmaps in process, in place of
+   ImageMagick's convert -monochrome.
+
+   A bitmap is a 2D boolean array, True for the black pixels potrace
+   traces. Images are reduced to 8 bit gray, transparent pixels count as
+   white, then turned into black and white with a fixed or Otsu threshold,
+   Floyd-Steinberg error diffusion (Pillow's) or an ordered Bayer dither.
+"""
+import os
+
+import numpy
+from PIL import Image
+
+METHODS = ('threshold', 'otsu', 'floyd-steinberg', 'ordered')
+
+DEFAULT_THRESHOLD = 128
+
+
+def new_stats():
+    """ Returns an empty statistics dict for convert_file """
+    return {'method': None, 'threshold': None, 'width': 0, 'height': 0, 'black': 0}
+
+
+def gray(image):
+    """ Returns the 8 bit gray array of a Pillow image or an image file, transparent pixels white """
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    return numpy.asarray(image.convert('L'))
+
+
+def otsu(values):
+    """ Returns the Otsu threshold of an 8 bit gray array, the level best separating dark and light pixels """
+    histogram = numpy.bincount(numpy.asarray(values, dtype=numpy.uint8).ravel(), minlength=256).astype(numpy.float64)
+    levels = numpy.arange(256)
+    weight = numpy.cumsum(histogram)
+    total = weight[-1]
+    if not total:
+        return DEFAULT_THRESHOLD
+    mean = numpy.cumsum(histogram * levels)
+    dark = weight[:-1]
+    light = total - dark
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        between = (mean[-1] * dark - total * mean[:-1]) ** 2 / (dark * light)
+    between[(dark == 0) | (light == 0)] = -1.0
+    # Pixels up to the best level are dark, a threshold is the first light level
+    return int(numpy.argmax(between)) + 1
+
+
+def threshold(values, level=DEFAULT_THRESHOLD):
+    """ Returns the bitmap of the pixels darker than the level """
+    return numpy.asarray(values) < level
+
+
+def floyd_steinberg(values):
+    """ Returns the bitmap of Floyd-Steinberg error diffusion, done by Pillow """
+    image = Image.fromarray(numpy.ascontiguousarray(values, dtype=numpy.uint8), 'L')
+    return numpy.asarray(image.convert('1', dither=Image.FLOYDSTEINBERG)) == 0
+
+
+def ordered(values, size=8):
+    """ Returns the bitmap of an ordered dither with a size x size Bayer matrix, size a power of two """
+    matrix = numpy.zeros((1, 1))
+    while len(matrix) < size:
+        matrix = numpy.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    levels = (matrix + 0.5) * 256.0 / matrix.size
+    values = numpy.asarray(values)
+    rows = numpy.arange(values.shape[0]) % len(matrix)
+    columns = numpy.arange(values.shape[1]) % len(matrix)
+    return values < levels[rows[:, None], columns[None, :]]
+
+
+def convert(image, method='threshold', level=None, negate=False):
+    """ Converts an image to a bitmap
+
+    :param image: Pillow image, image file or 8 bit gray array
+    :param method: One of METHODS
+    :param level: Threshold of the 'threshold' method, DEFAULT_THRESHOLD when None
+    :param negate: Swaps black and white in the result, like convert -negate
+    :returns The bitmap and the threshold used, None for the dithers
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown method {}, expected one of {}'.format(method, ', '.join(METHODS)))
+    values = image if isinstance(image, numpy.ndarray) else gray(image)
+
+    if method == 'threshold':
+        level = DEFAULT_THRESHOLD if level is None else level
+        bitmap = threshold(values, level)
+    elif method == 'otsu':
+        level = otsu(values)
+        bitmap = threshold(values, level)
+    elif method == 'floyd-steinberg':
+        level = None
+        bitmap = floyd_steinberg(values)
+    else:
+        level = None
+        bitmap = ordered(values)
+
+    if negate:
+        bitmap = ~bitmap
+    return bitmap, level
+
+
+def pack(bitmap):
+    """ Returns the bitmap packed eight pixels a byte, rows padded to whole bytes, 1 for black like PBM """
+    return numpy.packbits(bitmap, axis=1)
+
+
+def to_image(bitmap):
+    """ Returns the bitmap as a Pillow mode '1' image """
+    height, width = bitmap.shape
+    return Image.frombytes('1', (width, height), pack(~bitmap).tobytes())
+
+
+def convert_file(filename, file_out, method='threshold', level=None, negate=False):
+    """ Converts an image file to a bitmap file
+
+    :param file_out: The file written, its extension picks the format like convert does:
+    '.bmp' and '.pbm' are 1 bit, '.pgm' 8 bit gray and '.ppm' RGB
+    :returns The output file and the statistics dict
+    """
+    bitmap, level = convert(filename, method, level, negate)
+    image = to_image(bitmap)
+    extension = os.path.splitext(file_out)[1].lower()
+    if extension == '.pgm':
+        image = image.convert('L')
+    elif extension == '.ppm':
+        image = image.convert('RGB')
+    image.save(file_out)
+
+    stats = new_stats()
+    stats['method'] = method
+    stats['threshold'] = level
+    stats['height'], stats['width'] = bitmap.shape
+    stats['black'] = int(numpy.count_nonzero(bitmap))
+    return file_out, stats
@@ -0,0 +1,275 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Traces the black regions of a bitmap into closed polygons, in place
+   of potrace.
+
+   The boundaries run along the pixel edges between black and white
+   pixels, black on their left, so outer boundaries are counter
+   clockwise and holes clockwise, Y pointing up. Where two black pixels
+   only touch by a corner the boundary turns around each of them, black
+   regions are 4-connected like potrace's default. Straight runs of pixel
+   edges are merged before the edges are linked with slicing.link, so
+   the loops only visit the corners.
+
+   Holes are matched with the outer boundary around them, the polygons
+   can be smoothed by corner cutting and simplified, and handed over as
+   arrays or written as an SVG path.
+"""
+import numpy
+
+from gcode import simplify
+from gcode import validation
+from geometry import slicing
+
+
+def new_stats():
+    """ Returns an empty statistics dict for trace_file """
+    return {'width': 0, 'height': 0, 'shapes': 0, 'holes': 0, 'vertices': 0}
+
+
+def boundaries(bitmap):
+    """ Returns the closed boundaries of the black pixels of a bitmap
+
+    :param bitmap: 2D boolean array, True for black, row 0 at the top
+    :returns The list of the (M, 2) arrays of the loop corners, in pixels from the bottom
+    left corner, the first corner not repeated at the end
+    """
+    bitmap = numpy.asarray(bitmap, dtype=bool)
+    height, width = bitmap.shape
+    padded = numpy.zeros((height + 2, width + 2), dtype=bool)
+    padded[1:-1, 1:-1] = bitmap
+
+    # Lattice vertices where only two diagonal pixels are black
+    north_west, north_east = padded[:-1, :-1], padded[:-1, 1:]
+    south_west, south_east = padded[1:, :-1], padded[1:, 1:]
+    saddle = (north_west == south_east) & (north_east == south_west) & (north_west != north_east)
+
+    black = padded[1:-1, 1:-1]
+    sides = [
+        # Bottom sides run towards +X, right sides towards +Y, top sides towards -X, left sides towards -Y
+        (black & ~padded[2:, 1:-1], False, False),
+        (black & ~padded[1:-1, 2:], True, False),
+        (black & ~padded[:-2, 1:-1], False, True),
+        (black & ~padded[1:-1, :-2], True, True),
+    ]
+    starts, ends, pixel_rows = [], [], []
+    for kind, (mask, vertical, backwards) in enumerate(sides):
+        if vertical:
+            columns, first, last = _runs(mask.T)
+            rows = numpy.stack([last + 1, first], axis=1) if not backwards else numpy.stack([first, last + 1], axis=1)
+            columns = columns + (1 if not backwards else 0)
+            start = numpy.stack([rows[:, 0], columns], axis=1)
+            end = numpy.stack([rows[:, 1], columns], axis=1)
+            pixel = numpy.stack([rows[:, 0] - 1 if not backwards else rows[:, 0],
+                                 rows[:, 1] if not backwards else rows[:, 1] - 1], axis=1)
+        else:
+            rows, first, last = _runs(mask)
+            row = rows + (1 if not backwards else 0)
+            columns = numpy.stack([first, last + 1], axis=1) if not backwards else \
+                numpy.stack([last + 1, first], axis=1)
+            start = numpy.stack([row, columns[:, 0]], axis=1)
+            end = numpy.stack([row, columns[:, 1]], axis=1)
+            pixel = numpy.stack([rows, rows], axis=1)
+        starts.append(start)
+        ends.append(end)
+        pixel_rows.append(pixel)
+
+    start, end, pixel = numpy.concatenate(starts), numpy.concatenate(ends), numpy.concatenate(pixel_rows)
+    if not len(start):
+        return []
+
+    # At a saddle the boundary turns around the black pixel it runs along
+    keys = []
+    for vertex, row in ((start, pixel[:, 0]), (end, pixel[:, 1])):
+        south = saddle[vertex[:, 0], vertex[:, 1]] & (row >= vertex[:, 0])
+        keys.append((vertex[:, 0] * (width + 1) + vertex[:, 1]) * 2 + south)
+    keys = numpy.stack(keys, axis=1)
+
+    segments = numpy.empty((len(start), 2, 2))
+    segments[:, 0, 0], segments[:, 0, 1] = start[:, 1], height - start[:, 0]
+    segments[:, 1, 0], segments[:, 1, 1] = end[:, 1], height - end[:, 0]
+    loops, chains = slicing.link(segments, keys)
+    return loops
+
+
+def area(polygon):
+    """ Returns the signed area of a polygon, positive when counter clockwise """
+    x, y = polygon[:, 0], polygon[:, 1]
+    return 0.5 * float(numpy.dot(x, numpy.roll(y, -1)) - numpy.dot(numpy.roll(x, -1), y))
+
+
+def nest(loops):
+    """ Groups the holes with the outer boundary around them
+
+    :returns The list of the (outer, holes) shapes, holes a list of polygons
+    """
+    areas = numpy.array([area(loop) for loop in loops])
+    outers = numpy.flatnonzero(areas > 0.0)
+    holes = numpy.flatnonzero(areas < 0.0)
+    shapes = [(loops[index], []) for index in outers]
+    if not len(outers) or not len(holes):
+        return shapes
+
+    # A point of the black side of every hole, inside its outer boundary only
+    first = numpy.array([loops[index][0] for index in holes], dtype=float)
+    edge = numpy.array([loops[index][1] for index in holes], dtype=float) - first
+    normal = numpy.stack([-edge[:, 1], edge[:, 0]], axis=1) / numpy.hypot(edge[:, 0], edge[:, 1])[:, None]
+    points = first + edge / 2.0 + 1e-3 * normal
+
+    # Smallest outers first, the first one around a hole is the right one
+    owner = numpy.full(len(holes), -1)
+    for position in numpy.argsort(areas[outers], kind='stable'):
+        outer = loops[outers[position]]
+        low, high = outer.min(axis=0), outer.max(axis=0)
+        candidates = numpy.flatnonzero((owner < 0) & (points >= low).all(axis=1) & (points <= high).all(axis=1))
+        if len(candidates):
+            owner[candidates[_inside(points[candidates], outer)]] = position
+
+    for index, position in zip(holes, owner):
+        if position >= 0:
+            shapes[position][1].append(loops[index])
+    return shapes
+
+
+def smooth(polygon, iterations=1):
+    """ Rounds the corners of a closed polygon by Chaikin's corner cutting
+
+    Every iteration replaces each edge by the points at a quarter and three quarters of it.
+    """
+    for _ in range(iterations):
+        following = numpy.roll(polygon, -1, axis=0)
+        polygon = numpy.stack([0.75 * polygon + 0.25 * following, 0.25 * polygon + 0.75 * following],
+                              axis=1).reshape(-1, 2)
+    return polygon
+
+
+def simplify_polygon(polygon, tolerance):
+    """ Drops the vertices of a closed polygon within the tolerance of the simplified polygon """
+    return simplify_polygons([polygon], tolerance)[0]
+
+
+def simplify_polygons(polygons, tolerance):
+    """ Simplifies closed polygons all at once, see simplify_polygon
+
+    Every polygon is split at its first vertex and the one furthest from it, both are kept,
+    and the halves of all the polygons go through one simplify.douglas_peucker_many.
+    """
+    if not polygons:
+        return []
+    sizes = numpy.array([len(polygon) for polygon in polygons])
+    closed = numpy.concatenate([numpy.concatenate([polygon, polygon[:1]]) for polygon in polygons])
+    starts = numpy.cumsum(sizes + 1) - (sizes + 1)
+
+    # The first vertex furthest from the first one of its polygon
+    owner = numpy.repeat(numpy.arange(len(polygons)), sizes + 1)
+    distances = numpy.linalg.norm(closed - closed[starts][owner], axis=1)
+    furthest = numpy.flatnonzero(distances == numpy.maximum.reduceat(distances, starts)[owner])
+    groups = owner[furthest]
+    far = furthest[numpy.concatenate([[True], groups[1:] != groups[:-1]])]
+
+    # Polygons of less than 4 vertices are kept as they are
+    large = sizes >= 4
+    spans = numpy.concatenate([numpy.stack([starts, far], axis=1)[large],
+                               numpy.stack([far, starts + sizes], axis=1)[large]])
+    keep = simplify.douglas_peucker_many(closed, spans, tolerance)
+    return [polygon if size < 4 else polygon[keep[start:start + size]]
+            for polygon, start, size in zip(polygons, starts, sizes)]
+
+
+def trace(bitmap, scale=1.0, smoothing=0, tolerance=None):
+    """ Traces the black regions of a bitmap into polygons
+
+    :param scale: Size of a pixel in the output units, for example 25.4 / dpi for mm
+    :param smoothing: Corner cutting iterations, 0 keeps the pixel corners
+    :param tolerance: Douglas-Peucker tolerance in output units after smoothing, None keeps
+    every vertex
+    :returns The list of the (outer, holes) shapes, see nest
+    """
+    shapes = nest(boundaries(bitmap))
+    flat = [smooth(polygon * scale, smoothing) for polygon in polygons(shapes)]
+    if tolerance:
+        flat = simplify_polygons(flat, tolerance)
+
+    # Back into shapes, every outer followed by its holes
+    out, position = [], 0
+    for outer, holes in shapes:
+        out.append((flat[position], flat[position + 1:position + 1 + len(holes)]))
+        position += 1 + len(holes)
+    return out
+
+
+def polygons(shapes):
+    """ Returns the flat list of the outer and hole polygons of the shapes """
+    return [polygon for outer, holes in shapes for polygon in [outer] + holes]
+
+
+def svg_path(shapes, height):
+    """ Returns the path data of the shapes in SVG coordinates, Y pointing down from the top
+
+    :param height: Height of the image in the units of the shapes
+    """
+    parts = []
+    for polygon in polygons(shapes):
+        points = ' '.join('{:.3f},{:.3f}'.format(x, height - y) for x, y in polygon.tolist())
+        parts.append('M{}z'.format(points))
+    return ' '.join(parts)
+
+
+def write_svg(file_out, shapes, width, height):
+    """ Writes the shapes as one black even-odd path, like potrace -s --flat """
+    with open(file_out, 'w') as f:
+        f.write('<?xml version="1.0" standalone="no"?>\n')
+        f.write('<svg xmlns="http://www.w3.org/2000/svg" version="1.0" width="{0:.3f}" height="{1:.3f}" '
+                'viewBox="0 0 {0:.3f} {1:.3f}">\n'.format(width, height))
+        f.write('<path fill="#000000" stroke="none" fill-rule="evenodd" d="{}"/>\n'.format(svg_path(shapes, height)))
+        f.write('</svg>\n')
+
+
+def trace_file(bitmap, file_out, scale=1.0, smoothing=0, tolerance=None):
+    """ Traces a bitmap into an SVG file
+
+    :param bitmap: 2D boolean array, True for black
+    :returns The output file, the shapes and the statistics dict
+    """
+    bitmap = numpy.asarray(bitmap, dtype=bool)
+    shapes = trace(bitmap, scale, smoothing, tolerance)
+    height, width = bitmap.shape
+    write_svg(file_out, shapes, width * scale, height * scale)
+
+    stats = new_stats()
+    stats['height'], stats['width'] = height, width
+    stats['shapes'] = len(shapes)
+    stats['holes'] = sum(len(holes) for outer, holes in shapes)
+    stats['vertices'] = sum(len(polygon) for polygon in polygons(shapes))
+    return file_out, shapes, stats
+
+
+def _inside(points, polygon, chunk=1 << 22):
+    """ Returns validation.inside_polygon of the points, a few at a time against large polygons """
+    rows = max(chunk // max(len(polygon), 1), 1)
+    return numpy.concatenate([validation.inside_polygon(points[index:index + rows], polygon)
+                              for index in range(0, len(points), rows)])
+
+
+def _runs(mask):
+    """ Returns the row, first and last column of the runs of True along the rows of a 2D array """
+    padded = numpy.zeros((mask.shape[0], mask.shape[1] + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = mask
+    change = numpy.diff(padded, axis=1)
+    rows, first = numpy.nonzero(change == 1)
+    last = numpy.nonzero(change == -1)[1] - 1
+    return rows, first, last
@@ -0,0 +1,210 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Etches a grayscale image as a 3D point cloud, keeping the tones the
+   monochrome conversion throws away.
+
+   The image is resampled on the XY grid of the etch points, optionally
+   blurred and quantized to fewer gray levels. In the surface mode the
+   intensity of a cell is its height, every cell is etched once at the
+   layer of its height and the points make a relief. In the density mode
+   the intensity is the number of layers a cell is etched in, the points
+   are stacked around the middle of the volume and brighter cells look
+   denser through the glass. Either way the Z of the points falls on the
+   layers of the Z pitch and the g-code is written layer by layer.
+"""
+import os
+
+import numpy
+from PIL import Image, ImageFilter
+
+from gcode import writer
+from geometry import pointcloud
+from imaging import bitmap
+
+MODES = ('surface', 'density')
+
+
+def new_stats():
+    """ Returns an empty statistics dict for write_gcode """
+    return {'width': 0, 'height': 0, 'layers': 0, 'points': 0, 'runs': 0, 'lines_out': 0}
+
+
+def resample(image, size, pitch=pointcloud.DEFAULT_PITCH, smoothing=0):
+    """ Returns the 8 bit gray array of an image with one value per etch point
+
+    :param image: Pillow image or image file
+    :param size: (width, height) in mm the image is scaled to fit, keeping its proportions
+    :param pitch: Distance in mm between the points along X and Y
+    :param smoothing: Radius in points of the gaussian blur, no blur when 0
+    """
+    image = Image.fromarray(bitmap.gray(image), 'L')
+    scale = min(size[0] / image.width, size[1] / image.height)
+    shape = (max(int(round(image.width * scale / pitch[0])), 1), max(int(round(image.height * scale / pitch[1])), 1))
+    if shape != image.size:
+        image = image.resize(shape, Image.LANCZOS)
+    if smoothing:
+        image = image.filter(ImageFilter.GaussianBlur(smoothing))
+    return numpy.asarray(image)
+
+
+def intensity(values, negate=False, levels=None):
+    """ Returns the intensities of an 8 bit gray array from 0 for black to 1 for white
+
+    :param negate: Black is 1 and white 0 when True
+    :param levels: Number of gray levels the intensities are rounded to, all 256 when None
+    """
+    result = numpy.asarray(values, dtype=numpy.float32) / 255.0
+    if negate:
+        result = 1.0 - result
+    if levels:
+        steps = max(int(levels), 2) - 1
+        result = numpy.rint(result * steps) / steps
+    return result
+
+
+def layer_count(relief, pitch=pointcloud.DEFAULT_PITCH):
+    """ Returns the number of layers of the Z pitch within the relief height in mm """
+    return max(int(numpy.floor(relief / pitch[2] + 1e-9)), 0) + 1
+
+
+def surface_runs(values, count):
+    """ Returns the runs of the cells of every layer of a relief, in etching order
+
+    :param values: 2D array of the intensities, row 0 at the bottom
+    :param count: Number of layers, intensity 0 is on the first and 1 on the last
+    :returns The layer, row, first column, last column and backwards arrays of the runs, sorted
+    by layer, the rows with runs of a layer visited in alternating directions
+    """
+    height, width = values.shape
+    index = numpy.rint(values * (count - 1)).astype(numpy.int32).ravel()
+    # Sorting the cells by layer keeps them row by row in every layer
+    order = numpy.argsort(index, kind='stable')
+    layers = index[order]
+    rows, columns = numpy.divmod(order, width)
+
+    start = numpy.ones(len(order), dtype=bool)
+    start[1:] = (layers[1:] != layers[:-1]) | (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1] + 1)
+    first = numpy.nonzero(start)[0]
+    last = numpy.append(first[1:], len(order)) - 1
+    layers, rows, starts, ends = layers[first], rows[first], columns[first], columns[last]
+
+    # Alternate the direction of the rows that have runs, counting from the first one of every layer
+    keys = layers.astype(numpy.int64) * height + rows
+    unique_keys, row_index = numpy.unique(keys, return_inverse=True)
+    unique_layers = unique_keys // height
+    rank = numpy.arange(len(unique_keys)) - numpy.searchsorted(unique_layers, unique_layers)
+    backwards = (rank % 2 == 1)[row_index.ravel()]
+    order = numpy.lexsort((numpy.where(backwards, -starts, starts), rows, layers))
+    return layers[order], rows[order], starts[order], ends[order], backwards[order]
+
+
+def density_layers(values, count):
+    """ Generator yielding (index, mask) for every layer with points, mask the boolean array of its cells
+
+    A cell of intensity v is etched in round(v * count) layers centered on the middle one.
+    """
+    # Whether the layer is one of the layers of a cell of n points, by n
+    points = numpy.rint(values * count).astype(numpy.int32)
+    sizes = numpy.arange(count + 1)
+    low = (count - sizes) // 2
+    for layer in range(count):
+        included = (low <= layer) & (layer < low + sizes)
+        if included.any():
+            yield layer, included[points]
+
+
+def write_gcode(f, values, relief, pitch=pointcloud.DEFAULT_PITCH, mode='surface', center=None, bottom=0.0,
+                etch_feed=pointcloud.DEFAULT_ETCH_FEED, start_gcode=None, precision=writer.DEFAULT_PRECISION,
+                stats=None):
+    """ Writes the g-code etching the points of a depth map to an open text file
+
+    Layers are etched from the bottom up, runs are G1 moves at the etch feed and the moves
+    between them G0.
+
+    :param values: 2D array of the intensities from 0 to 1, row 0 at the top
+    :param relief: Height in mm between the lowest and the highest layer
+    :param center: (x, y) in mm of the middle of the image, the bottom left corner is at the origin when None
+    :param bottom: Z in mm of the lowest layer
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown mode {}, expected one of {}'.format(mode, ', '.join(MODES)))
+    if stats is None:
+        stats = new_stats()
+
+    values = numpy.asarray(values)[::-1]
+    height, width = values.shape
+    xs = pitch[0] * (numpy.arange(width) + 0.5)
+    ys = pitch[1] * (numpy.arange(height) + 0.5)
+    if center is not None:
+        xs += center[0] - pitch[0] * width / 2.0
+        ys += center[1] - pitch[1] * height / 2.0
+    count = layer_count(relief, pitch)
+
+    out = writer.GcodeWriter(f, precision)
+    out.comment('generated by depthmap, pitch {} {} {} mm, {} mode'.format(pitch[0], pitch[1], pitch[2], mode))
+    out.preamble(start_gcode)
+
+    if mode == 'surface':
+        # Every cell is on a single layer, the runs of all the layers come from one sort
+        layers, rows, starts, ends, backwards = surface_runs(values, count)
+        left = xs[starts] - pitch[0] / 2.0
+        right = xs[ends] + pitch[0] / 2.0
+        all_runs = numpy.empty((len(rows), 2, 2))
+        all_runs[:, 0, 0] = numpy.where(backwards, right, left)
+        all_runs[:, 1, 0] = numpy.where(backwards, left, right)
+        all_runs[:, :, 1] = ys[rows][:, None]
+        bounds = numpy.searchsorted(layers, numpy.arange(count + 1))
+        layer_runs = ((layer, all_runs[bounds[layer]:bounds[layer + 1]]) for layer in range(count))
+        stats['points'] = values.size
+    else:
+        layer_runs = ((layer, pointcloud.runs(mask, xs, ys, pitch)) for layer, mask in density_layers(values, count))
+        stats['points'] = int(numpy.rint(values * count).sum())
+
+    for layer, runs in layer_runs:
+        if not len(runs):
+            continue
+        out.rapid(z=bottom + pitch[2] * layer)
+        out.moves(['0', '1'] * len(runs), runs.reshape(-1, 2).tolist(), etch_feed)
+        stats['layers'] += 1
+        stats['runs'] += len(runs)
+
+    stats['height'], stats['width'] = height, width
+    stats['lines_out'] = out.lines
+    return stats
+
+
+def depthmap_file(filename, file_out=None, size=(60.0, 60.0), height=60.0, relief=None, pitch=pointcloud.DEFAULT_PITCH,
+                  mode='surface', smoothing=0, levels=None, negate=False, center=None,
+                  etch_feed=pointcloud.DEFAULT_ETCH_FEED, start_gcode=None):
+    """ Etches an image file as a depth map, see resample, intensity and write_gcode
+
+    :param size: (width, height) in mm of the XY area the image is fitted in
+    :param height: Height in mm of the volume, from Z 0
+    :param relief: Height in mm of the depth map centered in the volume, all of it when None
+    :returns The output file and the statistics dict
+    """
+    if file_out is None:
+        file_out = os.path.splitext(filename)[0] + '.gcode'
+
+    relief = height if relief is None else min(relief, height)
+    values = intensity(resample(filename, size, pitch, smoothing), negate, levels)
+    bottom = (height - pitch[2] * (layer_count(relief, pitch) - 1)) / 2.0
+
+    stats = new_stats()
+    with open(file_out, 'w') as f:
+        write_gcode(f, values, relief, pitch, mode, center, bottom, etch_feed, start_gcode, stats=stats)
+    return file_out, stats
@@ -0,0 +1,107 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Etches flat 2D artwork straight from the image, row by row, without
+   tracing it, extruding it into an STL and slicing it.
+
+   The image is resampled to the etch resolution, turned into a bitmap
+   and every row of black pixels is run length encoded. Each run is one
+   G1 move at a single Z depth, rows without black pixels are skipped and
+   the rows are scanned in alternating directions.
+"""
+import numpy
+from PIL import Image
+
+from gcode import writer
+from geometry import pointcloud
+from imaging import bitmap
+
+DEFAULT_DPI = 254
+DEFAULT_FEED = 600.0
+
+
+def new_stats():
+    """ Returns an empty statistics dict for raster_gcode """
+    return {'width': 0, 'height': 0, 'black': 0, 'rows': 0, 'runs': 0, 'lines_out': 0}
+
+
+def resample(image, dpi=DEFAULT_DPI, size=None):
+    """ Returns the 8 bit gray array of an image at the etch resolution
+
+    :param image: Pillow image or image file
+    :param dpi: Etched pixels per inch
+    :param size: (width, height) in mm the image is scaled to fit, keeping its proportions.
+    The image is etched one pixel per dot when None.
+    """
+    values = bitmap.gray(image)
+    if size is None:
+        return values
+
+    pitch = 25.4 / dpi
+    height, width = values.shape
+    factor = min(size[0] / (width * pitch), size[1] / (height * pitch))
+    shape = (max(int(round(width * factor)), 1), max(int(round(height * factor)), 1))
+    if shape == (width, height):
+        return values
+    return numpy.asarray(Image.fromarray(values, 'L').resize(shape, Image.LANCZOS))
+
+
+def raster_gcode(f, black, dpi=DEFAULT_DPI, depth=0.0, center=None, feed=DEFAULT_FEED, start_gcode=None,
+                 precision=writer.DEFAULT_PRECISION, stats=None):
+    """ Writes the g-code etching a bitmap at one depth to an open text file
+
+    :param black: 2D boolean array, True for the pixels to etch, row 0 at the top
+    :param depth: Z in mm of the etched plane
+    :param center: (x, y) in mm of the middle of the image, the bottom left corner is at the origin when None
+    """
+    if stats is None:
+        stats = new_stats()
+
+    pitch = 25.4 / dpi
+    height, width = black.shape
+    # Rows from the bottom of the image up, Y pointing up
+    xs = pitch * (numpy.arange(width) + 0.5)
+    ys = pitch * (numpy.arange(height) + 0.5)
+    if center is not None:
+        xs += center[0] - pitch * width / 2.0
+        ys += center[1] - pitch * height / 2.0
+    runs = pointcloud.runs(black[::-1], xs, ys, (pitch, pitch))
+
+    out = writer.GcodeWriter(f, precision)
+    out.comment('generated by raster, {} dpi, depth {} mm'.format(dpi, depth))
+    out.preamble(start_gcode)
+    if len(runs):
+        out.rapid(z=depth)
+        out.moves(['0', '1'] * len(runs), runs.reshape(-1, 2).tolist(), feed)
+
+    stats['height'], stats['width'] = height, width
+    stats['black'] = int(numpy.count_nonzero(black))
+    stats['rows'] = len(numpy.unique(runs[:, 0, 1])) if len(runs) else 0
+    stats['runs'] = len(runs)
+    stats['lines_out'] = out.lines
+    return stats
+
+
+def raster_file(filename, file_out, dpi=DEFAULT_DPI, depth=0.0, size=None, center=None, method='threshold',
+                level=None, negate=False, feed=DEFAULT_FEED, start_gcode=None):
+    """ Etches an image file at one depth, see resample, bitmap.convert and raster_gcode
+
+    :returns The output file and the statistics dict
+    """
+    black, level = bitmap.convert(resample(filename, dpi, size), method, level, negate)
+    with open(file_out, 'w') as f:
+        stats = raster_gcode(f, black, dpi, depth, center, feed, start_gcode)
+    return file_out, stats
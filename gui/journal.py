@@ -0,0 +1,164 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Checkpoints of a running etch so a job stopped by an ALARM, a cancel
+   or a lost connection can continue where it stopped instead of from
+   the first line.
+
+   The streamer hands every acknowledged block to a Journal, which follows
+   grbl's modal state and writes a '<gcode file>.journal' JSON file next
+   to the g-code at a fixed interval. grbl acknowledges a block once it is
+   planned, not once it is executed, so the checkpoint stays a full planner
+   behind the last acknowledged block. Resuming repeats those few blocks
+   rather than skipping any that never ran.
+"""
+import collections
+import json
+import os
+import time
+
+import status
+from gcode import modal
+
+JOURNAL_EXTENSION = '.journal'
+
+# Seconds between journal writes while streaming
+SAVE_INTERVAL = 1.0
+
+
+class Journal:
+    """ Records the progress of one stream of a gcode file """
+
+    def __init__(self, gcode_file, precision=None, checkpoint=None):
+        """
+        :param precision: The compaction precision of the stream, blocks are counted after compaction
+        :param checkpoint: A dict returned by load to resume from, None starts at the first block
+        """
+        self.gcode_file = gcode_file
+        self.path = journal_path(gcode_file)
+        self.precision = precision
+        self.block = checkpoint['block'] if checkpoint is not None else 0
+        self.modal = modal.ModalState.from_dict(checkpoint['modal']) if checkpoint is not None else modal.ModalState()
+        self.start = self.block
+        self.preamble = self.modal.preamble(precision if precision is not None else 3) if self.start else []
+        self.skip = len(self.preamble) # Preamble blocks still to be acknowledged
+        self.stopped = False
+        self._history = collections.deque([(self.block, self.modal.to_dict())], maxlen=status.PLANNER_SIZE + 1)
+        self._saved = time.time()
+
+    def blocks(self, l_blocks):
+        """ Generator yielding the blocks to stream from the ones read from the gcode file
+
+        When resuming the preamble restoring the modal state comes first, followed by the
+        blocks after the checkpoint.
+        """
+        for line in self.preamble:
+            yield line
+
+        restored = False
+        for index, l_block in enumerate(l_blocks):
+            if index < self.start:
+                continue
+            if not restored:
+                l_block, restored = self.modal.restore_motion(l_block)
+            yield l_block
+
+    def laser_block(self, laser_start):
+        """ Returns the number of acknowledged blocks after which the laser is fired when
+        it is fired after laser_start blocks of the whole file """
+        return max(laser_start - self.start, 0) + len(self.preamble)
+
+    def ack(self, l_block):
+        """ Records the block grbl acknowledged last, in the order the blocks were yielded """
+        if self.stopped:
+            return
+        if self.skip:
+            self.skip -= 1
+            return
+
+        self.block += 1
+        self.modal.update(l_block)
+        self._history.append((self.block, self.modal.to_dict()))
+        if time.time() - self._saved > SAVE_INTERVAL:
+            self.save()
+
+    def stop(self):
+        """ Stops recording, blocks acknowledged after an ALARM were never executed """
+        if not self.stopped:
+            self.save()
+            self.stopped = True
+
+    def save(self):
+        """ Atomically writes the checkpoint to the journal file """
+        block, state = self._history[0]
+        checkpoint = dict()
+        checkpoint['file'] = os.path.realpath(self.gcode_file)
+        checkpoint['size'], checkpoint['mtime'] = _file_signature(self.gcode_file)
+        checkpoint['precision'] = self.precision
+        checkpoint['block'] = block
+        checkpoint['acked'] = self.block
+        checkpoint['modal'] = state
+        checkpoint['time'] = time.time()
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(checkpoint, f, indent=2)
+        os.replace(temp_path, self.path)
+        self._saved = time.time()
+
+    def clear(self):
+        """ Removes the journal file once the job completed """
+        self.stopped = True
+        remove(self.gcode_file)
+
+
+def journal_path(gcode_file):
+    """ Returns the path of the journal file of a gcode file """
+    return gcode_file + JOURNAL_EXTENSION
+
+
+def load(gcode_file, precision=None):
+    """ Returns the checkpoint of the gcode file
+
+    :param precision: Only return the checkpoint if it was recorded with this precision
+    :returns The checkpoint dict or None if there is no journal, it belongs to another
+    version of the file or the blocks were compacted differently
+    """
+    try:
+        with open(journal_path(gcode_file), 'r') as f:
+            checkpoint = json.load(f)
+        signature = list(_file_signature(gcode_file))
+    except (OSError, ValueError):
+        return None
+
+    if [checkpoint.get('size'), checkpoint.get('mtime')] != signature:
+        return None
+    if checkpoint.get('precision') != precision or not checkpoint.get('block'):
+        return None
+    return checkpoint
+
+
+def remove(gcode_file):
+    """ Removes the journal of the gcode file if there is one """
+    try:
+        os.remove(journal_path(gcode_file))
+    except FileNotFoundError:
+        pass
+
+
+def _file_signature(gcode_file):
+    info = os.stat(gcode_file)
+    return info.st_size, info.st_mtime
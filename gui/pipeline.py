@@ -0,0 +1,410 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Runs the image to g-code pipeline without the GUI, from the command
+   line or from other scripts, so jobs can be run and profiled on a
+   machine without a display.
+
+   A job is a dict, or a JSON file, of the input file and the options the
+   GUI would ask for. It runs a range of the stages of the route of its
+   image_mode, each stage through the same executor the GUI calls, and
+   reports the wall time, CPU time (with the tools and workers started by
+   the stage) and output size of every stage.
+
+       python pipeline.py job.json --to simplify --report report.json
+       python pipeline.py --input cube.stl --to estimate
+
+   Errors stop the job and are reported instead of shown in a messagebox.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+import executors
+from utils import calculators
+from utils import constants
+from utils import parsers
+
+# Stages of every image_mode, in order
+ROUTES = {
+    'trace': ('bitmap', 'trace', 'stl', 'fit', 'slice', 'reorder', 'arcs', 'simplify', 'validate', 'estimate',
+              'stream'),
+    'raster': ('bitmap', 'raster', 'validate', 'estimate', 'stream'),
+    'depthmap': ('depthmap', 'validate', 'estimate', 'stream'),
+}
+
+# Stages of the trace route with the native tracing_engine, the traced shapes are extruded straight into g-code
+NATIVE_TRACE_ROUTE = ('bitmap', 'extrude', 'reorder', 'arcs', 'simplify', 'validate', 'estimate', 'stream')
+
+# First stage of a job by the extension of its input, the first stage of the route for images
+FIRST_STAGES = {'.svg': 'stl', '.stl': 'fit', '.gcode': 'validate'}
+
+# Options of a job, None reads the key of the same name from config.json
+DEFAULT_JOB = {
+    'input': None,
+    'output': None,
+    'from': None,
+    'to': 'estimate',
+    'image_mode': None,
+    'bitmap_engine': None,
+    'tracing_engine': None,
+    'slicing_engine': None,
+    'volume': [constants.CUBE_SIZE] * 3,
+    'negate': True,
+    'filetype': '.bmp',
+    'imagemagick': '',
+    'potrace': '',
+    'extrusion': 2.0,
+    'resume': False,
+}
+
+
+class PipelineError(Exception):
+    """ A job that cannot run or a stage that failed """
+
+
+def load_job(filename):
+    """ Returns the job of a JSON file, a relative input is relative to the file """
+    with open(filename) as f:
+        job = json.load(f)
+    if job.get('input') and not os.path.isabs(job['input']):
+        job['input'] = os.path.join(os.path.dirname(os.path.abspath(filename)), job['input'])
+    return job
+
+
+def resolve(job, path=None):
+    """ Returns the complete job with the defaults and the config.json keys filled in
+
+    :param path: The directory of config.json, the one of this module when None
+    """
+    path = path or os.path.dirname(os.path.realpath(__file__))
+    unknown = set(job) - set(DEFAULT_JOB)
+    if unknown:
+        raise PipelineError('Unknown job keys: {}'.format(', '.join(sorted(unknown))))
+
+    job = dict(DEFAULT_JOB, **job)
+    if not job['input'] or not os.path.isfile(job['input']):
+        raise PipelineError('Input file not found: {}'.format(job['input']))
+    for key in ('image_mode', 'bitmap_engine', 'tracing_engine', 'slicing_engine'):
+        if job[key] is None:
+            job[key] = parsers.get_from_config(key, path)
+    if job['image_mode'] not in ROUTES:
+        raise PipelineError('Unknown image_mode {}, expected one of {}'.format(job['image_mode'],
+                                                                                ', '.join(sorted(ROUTES))))
+    if job['output'] is None:
+        job['output'] = os.path.join(path, 'objects')
+    return job
+
+
+def stages(job):
+    """ Returns the stages a resolved job runs, in order """
+    route = ROUTES[job['image_mode']]
+    if job['image_mode'] == 'trace' and job['tracing_engine'] == 'native':
+        route = NATIVE_TRACE_ROUTE
+    first = job['from']
+    if first is None:
+        first = FIRST_STAGES.get(os.path.splitext(job['input'])[1].lower(), route[0])
+    names = {first, job['to']}
+    if not names <= set(route) and names <= set(ROUTES['trace']):
+        # SVG and STL inputs and the SVG of the tracing only go through the stages of the trace route
+        route = ROUTES['trace']
+    for name in (first, job['to']):
+        if name not in route:
+            raise PipelineError('Stage {} is not in the {} route: {}'.format(name, job['image_mode'], ', '.join(route)))
+    start, end = route.index(first), route.index(job['to'])
+    if start > end:
+        raise PipelineError('Stage {} comes after stage {}'.format(first, job['to']))
+    return list(route[start:end + 1])
+
+
+def run_job(job, path=None, log=print, quiet=False):
+    """ Runs a job, stopping at the first stage that fails
+
+    :param job: Job dict or JSON file, see DEFAULT_JOB for its keys
+    :param log: Function printing the progress lines of the pipeline
+    :param quiet: Silences what the executors print
+    :returns The report dict: the result, the reason it failed, the final output file, the
+    total wall and CPU times and the record of every stage that ran
+    """
+    if not isinstance(job, dict):
+        job = load_job(job)
+    path = path or os.path.dirname(os.path.realpath(__file__))
+    report = {'result': False, 'reason': '', 'output': None, 'wall_time': 0.0, 'cpu_time': 0.0, 'stages': []}
+    try:
+        job = resolve(job, path)
+        names = stages(job)
+    except PipelineError as e:
+        report['reason'] = str(e)
+        return report
+    report['job'] = job
+    os.makedirs(job['output'], exist_ok=True)
+
+    filename = job['input']
+    for name in names:
+        record = {'stage': name, 'input': filename, 'output': None, 'result': False, 'wall_time': 0.0,
+                  'cpu_time': 0.0, 'output_size': None, 'details': None}
+        report['stages'].append(record)
+        wall, cpu = time.perf_counter(), _cpu_time()
+        try:
+            with _silenced(quiet):
+                filename, record['details'] = STAGES[name](job, filename, path, log)
+            record['result'] = True
+        except PipelineError as e:
+            report['reason'] = '{}: {}'.format(name, e)
+        except Exception as e:
+            report['reason'] = '{}: {}: {}'.format(name, type(e).__name__, e)
+        finally:
+            record['wall_time'] = time.perf_counter() - wall
+            record['cpu_time'] = _cpu_time() - cpu
+            report['wall_time'] += record['wall_time']
+            report['cpu_time'] += record['cpu_time']
+
+        if not record['result']:
+            log('{:<10} FAILED after {:.3f} s: {}'.format(name, record['wall_time'], report['reason']))
+            return report
+        record['output'] = filename
+        record['output_size'] = os.path.getsize(filename) if os.path.isfile(filename) else None
+        log('{:<10} {:>9.3f} s wall {:>9.3f} s cpu {:>12} bytes  {}'.format(
+            name, record['wall_time'], record['cpu_time'], record['output_size'], filename))
+
+    report['result'] = True
+    report['output'] = filename
+    return report
+
+
+def _bitmap(job, filename, path, log):
+    """ Converts the image to a monochrome bitmap with the bitmap_engine """
+    if job['bitmap_engine'] == 'native':
+        file_out, result = executors.execute_bitmap(job['output'], job['negate'], job['filetype'], filename)
+    else:
+        file_out, result = executors.exec_imagemagick(job['output'], job['negate'], job['imagemagick'],
+                                                      job['filetype'], filename)
+    return _checked(file_out, result, 'conversion'), None
+
+
+def _raster(job, filename, path, log):
+    """ Etches the bitmap row by row, fitted in the bed of the volume """
+    _set_bed(job, path)
+    file_out, result = executors.execute_raster(job['output'], filename)
+    return _checked(file_out, result, 'Raster'), None
+
+
+def _depthmap(job, filename, path, log):
+    """ Etches the grayscale image as a point cloud in the volume """
+    _set_bed(job, path)
+    file_out, result = executors.execute_depthmap(filename, job['output'], *_object_size(job))
+    return _checked(file_out, result, 'Depth map'), None
+
+
+def _trace(job, filename, path, log):
+    """ Traces the bitmap into an SVG file with the tracing_engine """
+    if job['tracing_engine'] == 'native':
+        file_out, result = executors.execute_trace(job['output'], filename)
+    else:
+        file_out, result = executors.exec_potrace(job['output'], job['potrace'], filename)
+    return _checked(file_out, result, 'tracing'), None
+
+
+def _extrude(job, filename, path, log):
+    """ Traces the bitmap and etches its shapes extruded in the volume, without the SVG, STL and slicing """
+    _set_bed(job, path)
+    x, y, z = _object_size(job)
+    file_out, result = executors.execute_extrusion(filename, job['output'], x, y, z, job['extrusion'])
+    return _checked(file_out, result, 'Extrusion'), None
+
+
+def _stl(job, filename, path, log):
+    """ Extrudes the SVG file into an STL object with the FreeCAD script """
+    file_out, result = executors.stl_conversion(None, filename, job['output'], job['extrusion'])
+    return _checked(file_out, result, 'STL conversion'), None
+
+
+def _fit(job, filename, path, log):
+    """ Fits the STL object in the volume """
+    file_out, result = executors.execute_scale_stl(filename, job['output'], *_object_size(job))
+    return _checked(file_out, result, 'Scaling'), None
+
+
+def _slice(job, filename, path, log):
+    """ Slices the STL object with the slicing_engine, centered on the bed of the volume """
+    _set_bed(job, path)
+    x, y, z = _object_size(job)
+    if job['slicing_engine'] == 'pointcloud':
+        file_out, result = executors.execute_pointcloud(filename, job['output'], x, y)
+    elif job['slicing_engine'] == 'native':
+        file_out, result = executors.execute_native_slicer(filename, job['output'], x, y)
+    else:
+        file_out, result = executors.execute_slic3r(filename, job['output'], x, y)
+    return _checked(file_out, result, 'Slicing'), None
+
+
+def _reorder(job, filename, path, log):
+    """ Shortens the travel moves of the g-code """
+    file_out, stats, result = executors.execute_reorder(filename)
+    return _checked(file_out, result, 'Reorder'), stats
+
+
+def _arcs(job, filename, path, log):
+    """ Fits arcs to the g-code """
+    file_out, stats, result = executors.execute_arc_fitting(filename)
+    return _checked(file_out, result, 'Arc fitting'), stats
+
+
+def _simplify(job, filename, path, log):
+    """ Simplifies the polylines of the g-code """
+    file_out, stats, result = executors.execute_simplify(filename)
+    return _checked(file_out, result, 'Simplify'), stats
+
+
+def _validate(job, filename, path, log):
+    """ Checks the g-code against the bed and the Z limits """
+    report, result = executors.execute_validation(filename)
+    if report is None:
+        raise PipelineError('Could not check the gcode file')
+    details = {key: report[key] for key in ('moves', 'outside_count', 'invalid_count', 'unsupported_count')}
+    if not result:
+        raise PipelineError('The gcode leaves the bed or the Z limits, {} moves out of range'.format(
+            report['outside_count']))
+    return filename, details
+
+
+def _estimate(job, filename, path, log):
+    """ Predicts the etching time of the g-code """
+    estimate, result = executors.execute_estimate(filename)
+    if not result:
+        raise PipelineError('Could not estimate the gcode file')
+    details = {key: estimate[key] for key in ('total_time', 'etch_time', 'travel_time')}
+    details['layers'] = len(estimate['layers'])
+    log('Estimated time: {}'.format(calculators.duration(estimate['total_time'])))
+    return filename, details
+
+
+def _stream(job, filename, path, log):
+    """ Homes the stage and etches the g-code, blocking until the stream finishes """
+    # Imported here so the other stages do not need pySerial
+    import serials
+    import stream
+
+    ready = serials.pre_test(alert=log)
+    if ready['result'] is False:
+        raise PipelineError(ready['reason'])
+
+    worker = serials.start_etching(filename, ready['device'], resume=job['resume'])
+    while True:
+        event = worker.events.get()
+        if event['type'] == 'laser' and not event['result']:
+            log(stream.laser_message(event))
+        elif event['type'] in ('alarm', 'error', 'started'):
+            stream.print_event(event)
+        elif event['type'] == 'finished':
+            break
+    worker.join()
+    if event['cancelled'] or event['result'] is False:
+        raise PipelineError(event['reason'] or 'The stream was cancelled')
+    return filename, {'reason': event['reason']}
+
+
+STAGES = {
+    'bitmap': _bitmap,
+    'raster': _raster,
+    'depthmap': _depthmap,
+    'trace': _trace,
+    'extrude': _extrude,
+    'stl': _stl,
+    'fit': _fit,
+    'slice': _slice,
+    'reorder': _reorder,
+    'arcs': _arcs,
+    'simplify': _simplify,
+    'validate': _validate,
+    'estimate': _estimate,
+    'stream': _stream,
+}
+
+
+def _checked(file_out, result, process):
+    """ Returns the output file of an executor, raises PipelineError if it failed """
+    if not result:
+        raise PipelineError('There was an error in the {} process'.format(process))
+    return file_out
+
+
+def _object_size(job):
+    """ Returns the size in inches the object is fitted in, the volume without its margin like in the GUI """
+    return tuple(size - constants.CUBE_MARGIN for size in job['volume'])
+
+
+def _set_bed(job, path):
+    """ Writes the bed of the object size to the bed_shape of the Slic3r config.ini like the GUI does """
+    x, y, z = _object_size(job)
+    parsers.set_in_ini('bed_shape', calculators.bed_shape(x, y), path)
+
+
+def _cpu_time():
+    """ Returns the CPU time of this process and of the child processes that ended """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+@contextlib.contextmanager
+def _silenced(quiet):
+    """ Sends what is printed to nowhere when quiet """
+    if not quiet:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def main(argv=None):
+    """ Runs a job from the command line, the exit status is 0 if it succeeded """
+    parser = argparse.ArgumentParser(description='Runs the etching pipeline without the GUI')
+    parser.add_argument('job', nargs='?', help='JSON job file, see DEFAULT_JOB in pipeline.py for its keys')
+    parser.add_argument('-i', '--input', help='The input file, overrides the one of the job')
+    parser.add_argument('-f', '--from', dest='first', choices=sorted(STAGES), help='The first stage to run')
+    parser.add_argument('-t', '--to', dest='last', choices=sorted(STAGES), help='The last stage to run')
+    parser.add_argument('-m', '--image-mode', choices=sorted(ROUTES), help='The route of the stages')
+    parser.add_argument('-r', '--report', help='Writes the report with the timings to this JSON file')
+    parser.add_argument('-q', '--quiet', action='store_true', default=False,
+                        help='Only prints the stage timings')
+    args = parser.parse_args(argv)
+    if args.job is None and args.input is None:
+        parser.error('a job file or an input file is required')
+
+    job = load_job(args.job) if args.job else {}
+    for key, value in (('input', args.input), ('from', args.first), ('to', args.last),
+                       ('image_mode', args.image_mode)):
+        if value is not None:
+            job[key] = value
+
+    report = run_job(job, quiet=args.quiet)
+    if report['result']:
+        print('Done in {:.3f} s wall, {:.3f} s cpu: {}'.format(report['wall_time'], report['cpu_time'],
+                                                              report['output']))
+    else:
+        print('Failed: {}'.format(report['reason']))
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+    return 0 if report['result'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,8 +18,9 @@ import os
 import imghdr
 import executors
 import serials
-import fileinput
-import sys
+import session
+import queue
+import stream
 # from copyrights import CopyrightText
 from conversion import ConversionOptions
 from conversion import StlOptions
@@ -59,11 +60,13 @@ class Main(ttk.Frame):
         self.x = tkinter.DoubleVar()
         self.y = tkinter.DoubleVar()
         self.z = tkinter.DoubleVar()
-        self.x.set(2.75)
-        self.y.set(2.75)
-        self.z.set(2.75)
+        self.x.set(constants.CUBE_SIZE)
+        self.y.set(constants.CUBE_SIZE)
+        self.z.set(constants.CUBE_SIZE)
 
         self.device_path = None
+        self.stream_worker = None
+        self.homing = False
 
         self.init_gui()
 
@@ -110,16 +113,18 @@ class Main(ttk.Frame):
         self.current_z_entry.config(state='disabled')
         self.test_connections_button.config(state='disabled')
         self.etching_start.config(state='disabled')
+        self.etching_estimate_var.set('')
 
         self.current_x_entry.config(state='disabled')
         self.current_y_entry.config(state='disabled')
         self.current_z_entry.config(state='disabled')
-        self.x.set(2.75)
-        self.y.set(2.75)
-        self.z.set(2.75)
+        self.x.set(constants.CUBE_SIZE)
+        self.y.set(constants.CUBE_SIZE)
+        self.z.set(constants.CUBE_SIZE)
 
     def _quit(self):
         """ Terminates the program """
+        session.close_session()
         quit()
 
     def _update_image(self):
@@ -196,13 +201,35 @@ class Main(ttk.Frame):
 
     def convert_to_bitmap(self):
         """ Converts the image to bitmap image """
+        # Grayscale images are etched as a relief from their tones, without the bitmap
+        if parsers.get_from_config('image_mode', os.path.dirname(os.path.realpath(__file__))) == 'depthmap':
+            margin = constants.CUBE_MARGIN
+            file_out, result = executors.execute_depthmap(self.file, self.objects_path, self.x.get() - margin,
+                                                          self.y.get() - margin, self.z.get() - margin)
+            if not result:
+                messagebox.showerror('Error', 'There was an error in the Depth map process!')
+                self.conversion_result_var.set('FAILED')
+                self.conversion_result_label.config(foreground='red2')
+                return
+
+            self.file = file_out
+            self.test_connections_button.config(state='normal')
+            self.conversion_start.config(state='disabled')
+            self.conversion_result_var.set('PASSED (depth map)')
+            self.conversion_result_label.config(foreground='green4')
+            return
+
         options = dict()
         options['line'] = self.custom_imagemagick
         options['filetype'] = self.conversion_map_type
         options['filename'] = self.file
         options['filepath'] = self.objects_path
         options['negate'] = self.negate
-        file_out, result = executors.exec_imagemagick(**options)
+        if parsers.get_from_config('bitmap_engine', os.path.dirname(os.path.realpath(__file__))) == 'native':
+            del options['line']
+            file_out, result = executors.execute_bitmap(**options)
+        else:
+            file_out, result = executors.exec_imagemagick(**options)
 
         if not result:
             messagebox.showerror('Error', 'There was an error in conversion process!')
@@ -211,17 +238,47 @@ class Main(ttk.Frame):
             return
 
         self.file = file_out
+        self._update_image()
+
+        # Flat artwork is etched from the bitmap directly, without tracing and slicing
+        if parsers.get_from_config('image_mode', os.path.dirname(os.path.realpath(__file__))) == 'raster':
+            file_out, result = executors.execute_raster(self.objects_path, filename=file_out)
+            if not result:
+                messagebox.showerror('Error', 'There was an error in the Raster process!')
+                self.conversion_result_var.set('FAILED')
+                self.conversion_result_label.config(foreground='red2')
+                return
+
+            self.file = file_out
+            self.test_connections_button.config(state='normal')
+            self.conversion_start.config(state='disabled')
+            self.conversion_result_var.set('PASSED (raster)')
+            self.conversion_result_label.config(foreground='green4')
+            return
+
         self.tracing_options_button.config(state='normal')
         self.tracing_start.config(state='normal')
+        if parsers.get_from_config('tracing_engine', os.path.dirname(os.path.realpath(__file__))) == 'native':
+            # The traced shapes are etched right away, the depth and the volume are set before tracing
+            self.stl_options_button.config(state='normal')
+            self.current_x_entry.config(state='normal')
+            self.current_y_entry.config(state='normal')
+            self.current_z_entry.config(state='normal')
 
         self.conversion_start.config(state='disabled')
         self.conversion_result_var.set('PASSED')
         self.conversion_result_label.config(foreground='green4')
 
-        self._update_image()
-
     def potrace_trace(self):
-        """ Uses potrace to trace the bitmap and output to SVG file """
+        """ Uses potrace to trace the bitmap and output to SVG file
+
+        The native tracing_engine etches the traced shapes right away instead, skipping the
+        STL conversion and the slicing.
+        """
+        if parsers.get_from_config('tracing_engine', os.path.dirname(os.path.realpath(__file__))) == 'native':
+            self._trace_extrusion()
+            return
+
         options = dict()
         options['line'] = self.custom_potrace
         options['filename'] = self.file
@@ -244,6 +301,35 @@ class Main(ttk.Frame):
 
         self._update_image()
 
+    def _trace_extrusion(self):
+        """ Traces the bitmap and etches its shapes extruded to the extrusion depth """
+        self.tracing_result_var.set('RUNNING')
+
+        mod_x = self.x.get() - constants.CUBE_MARGIN
+        mod_y = self.y.get() - constants.CUBE_MARGIN
+        mod_z = self.z.get() - constants.CUBE_MARGIN
+        parsers.set_in_ini('bed_shape', calculators.bed_shape(mod_x, mod_y),
+                           os.path.dirname(os.path.realpath(__file__)))
+
+        file_out, result = executors.execute_extrusion(self.file, self.objects_path, mod_x, mod_y, mod_z,
+                                                       self.extrusion_depth)
+        if not result:
+            messagebox.showerror('Error', 'There was an error in tracing process!')
+            self.tracing_result_var.set('FAILED')
+            self.tracing_result_label.config(foreground='red2')
+            return
+
+        finished = self._finish_gcode(file_out, self.tracing_result_var, self.tracing_result_label)
+        if finished is None:
+            return
+
+        self.file, notes = finished
+        self.stl_options_button.config(state='disabled')
+        self.test_connections_button.config(state='normal')
+        self.tracing_start.config(state='disabled')
+        self.tracing_result_var.set('PASSED ({})'.format(', '.join(['extruded'] + notes)))
+        self.tracing_result_label.config(foreground='green4')
+
     def stl_convert(self):
         """ Launches the SVG to STL conversion process """
         self.stl_result_var.set('RUNNING')
@@ -251,6 +337,7 @@ class Main(ttk.Frame):
         options['filename'] = self.file
         options['filepath'] = self.objects_path
         options['extrusion'] = self.extrusion_depth
+        messagebox.showinfo('Caution', 'This process may take a few minutes to run.\nPress OK to continue')
         file_out, result = executors.stl_conversion(self.root, **options)
 
         if not result:
@@ -279,31 +366,31 @@ class Main(ttk.Frame):
         """
         self.slicing_result_var.set('RUNNING')
 
-        mod_x = self.x.get() - .375
-        mod_y = self.y.get() - .375
-        mod_z = self.z.get() - .375
+        mod_x = self.x.get() - constants.CUBE_MARGIN
+        mod_y = self.y.get() - constants.CUBE_MARGIN
+        mod_z = self.z.get() - constants.CUBE_MARGIN
         # Run the scaler before slicing
-        executors.execute_scale_stl(self.file, self.objects_path, mod_x, mod_y, mod_z)
+        fitted, result = executors.execute_scale_stl(self.file, self.objects_path, mod_x, mod_y, mod_z)
+        if not result:
+            messagebox.showerror('Error', 'There was an error in the Scaling process!')
+            self.slicing_result_var.set('FAILED')
+            self.slicing_result_label.config(foreground='red2')
+            return
 
         # Edit the Ini to include bed frame dimensions
-        config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.ini')
-        mod_x = 25.4 * mod_x
-        mod_y = 25.4 * mod_y
-        mod_z = 25.4 * mod_z
-        shape = '0x0,{}x0,{}x{},0x{}'.format(mod_x, mod_x, mod_y, mod_y)
-
-        for line in fileinput.input(config_path, inplace=True):
-            if line.strip().startswith('bed_shape = '):
-                line = 'bed_shape = {}\n'.format(shape)
-            sys.stdout.write(line)
-
-        mod_x = self.x.get() - .375
-        mod_y = self.y.get() - .375
+        parsers.set_in_ini('bed_shape', calculators.bed_shape(mod_x, mod_y),
+                           os.path.dirname(os.path.realpath(__file__)))
 
         options = dict()
-        options['filename'] = self.file
+        options['filename'] = fitted
         options['filepath'] = self.objects_path
-        file_out, result = executors.execute_slic3r(x=mod_x, y=mod_y, **options)
+        engine = parsers.get_from_config('slicing_engine', os.path.dirname(os.path.realpath(__file__)))
+        if engine == 'pointcloud':
+            file_out, result = executors.execute_pointcloud(x=mod_x, y=mod_y, **options)
+        elif engine == 'native':
+            file_out, result = executors.execute_native_slicer(x=mod_x, y=mod_y, **options)
+        else:
+            file_out, result = executors.execute_slic3r(x=mod_x, y=mod_y, **options)
 
         if not result:
             messagebox.showerror('Error', 'There was an error in the Slicing process!')
@@ -311,16 +398,50 @@ class Main(ttk.Frame):
             self.slicing_result_label.config(foreground='red2')
             return
 
-        self.file = file_out
+        finished = self._finish_gcode(file_out, self.slicing_result_var, self.slicing_result_label)
+        if finished is None:
+            return
+
+        self.file, notes = finished
         self.current_x_entry.config(state='normal')
         self.current_y_entry.config(state='normal')
         self.current_z_entry.config(state='normal')
         self.test_connections_button.config(state='normal')
 
         self.slicing_start_button.config(state='disabled')
-        self.slicing_result_var.set('PASSED')
+        self.slicing_result_var.set('PASSED ({})'.format(', '.join(notes)) if notes else 'PASSED')
         self.slicing_result_label.config(foreground='green4')
 
+    def _finish_gcode(self, file_out, result_var, result_label):
+        """ Reorders, fits arcs to and simplifies the sliced gcode
+
+        :param result_var: The result of the step that made the gcode, set to FAILED on errors
+        :returns The final gcode file and the notes on what the stages saved, None if one failed
+        """
+        stages = (('Reorder', executors.execute_reorder), ('Arc fitting', executors.execute_arc_fitting),
+                  ('Simplify', executors.execute_simplify))
+        stats = {}
+        for name, executor in stages:
+            file_out, stats[name], result = executor(file_out)
+            if not result:
+                messagebox.showerror('Error', 'There was an error in the {} process!'.format(name))
+                result_var.set('FAILED')
+                result_label.config(foreground='red2')
+                return None
+
+        saved = 0
+        if stats['Arc fitting'] is not None:
+            saved += stats['Arc fitting']['lines_saved']
+        if stats['Simplify'] is not None:
+            saved += stats['Simplify']['lines_in'] - stats['Simplify']['lines_out']
+        notes = []
+        if saved:
+            notes.append('{} fewer lines'.format(saved))
+        if stats['Reorder'] is not None:
+            notes.append('travel {:.0f} to {:.0f} mm'.format(stats['Reorder']['travel_before'],
+                                                            stats['Reorder']['travel_after']))
+        return file_out, notes
+
     def bit_conversion_options(self):
         """ Brings up the conversion options menu for bitmap tracing
 
@@ -373,34 +494,199 @@ class Main(ttk.Frame):
     def etching_ready(self):
         """ Calls the etching ready module to prepare for etching
 
-        The module tries to establish connections to both the laser and the MCU. Switches
-        the ready state to READY if the connections are correctly established,
-        otherwise changes the state to not ready and provides error.
+        The module tries to establish connections to both the laser and the MCU and homes the stage
+        on a background worker polled by _poll_stream. The etching can be started once the stage
+        is homed, otherwise an error is shown.
         """
-        result = serials.pre_test()
+        device_path = serials.find_mcu()
+        if device_path is None:
+            messagebox.showerror(title='Error', message='Could not find correct serial port')
+            return
+
+        try:
+            self.stream_worker = serials.start_homing(device_path)
+        except Exception:
+            messagebox.showerror(title='Error', message='There was a critical error')
+            return
 
-        if result['result'] is False:
-            messagebox.showerror(title='Error', message=result['reason'])
+        self.device_path = device_path
+        self.homing = True
+        self.etching_start.config(state='disabled')
+        self.test_connections_button.config(state='disabled')
+        self.etching_cancel.config(state='normal')
+        self.etching_progress.config(value=0)
+        self.etching_status_var.set('HOMING')
+        self.after(constants.STREAM_POLL_MS, self._poll_stream)
+
+    def _show_estimate(self):
+        """ Shows the predicted etching time of the gcode file before the etching is started """
+        estimate, result = executors.execute_estimate(self.file)
+        if not result:
+            self.etching_estimate_var.set('Estimated time: unknown')
             return
 
-        self.device_path = result['device']
-        self.etching_start.configure(state='normal')
+        self.etching_estimate_var.set('Estimated time: {} (etching {}, travel {}, {} layers)'.format(
+            calculators.duration(estimate['total_time']), calculators.duration(estimate['etch_time']),
+            calculators.duration(estimate['travel_time']), len(estimate['layers'])))
 
     def etching_start(self):
-        """ Begins the etching process """
+        """ Begins the etching process
+
+        The gcode is checked against the bed first and is not etched if a move is out of range.
+        It is streamed by a background worker, its progress is polled by _poll_stream.
+        If an earlier etch of the file stopped, it can be resumed from its last checkpoint.
+        """
+        report, result = executors.execute_validation(self.file)
+        if report is None:
+            messagebox.showerror(title='Error', message='Could not check the gcode file before etching')
+            return
+        if not result:
+            messagebox.showerror(title='Error', message='The gcode leaves the bed or the Z limits!\n\n' +
+                                                        self._validation_message(report))
+            return
+        if report['invalid_count'] or report['unsupported_count']:
+            if not messagebox.askokcancel(title='Warning', message='grbl will reject some lines of the gcode.\n\n' +
+                                                                   self._validation_message(report)):
+                return
+
+        resume = False
+        checkpoint = serials.get_checkpoint(self.file)
+        if checkpoint is not None:
+            resume = messagebox.askyesno(
+                title='Resume', message='The last etch of this file stopped after block {}. Resume from there?\n\n'
+                                        'Only resume after the stage was homed again.'.format(checkpoint['block']))
+
         try:
-            result, reason = serials.full_test(self.file, self.device_path)
-        except:
-            serials.stop_laser()
+            self.stream_worker = serials.start_etching(self.file, self.device_path, resume=resume)
+        except Exception:
+            if not serials.stop_laser():
+                messagebox.showerror(title='Error', message=stream.laser_message({'on': False}))
             messagebox.showerror(title='Error', message='There was a critical error')
             return
 
-        if result is False:
-            messagebox.showerror(title='Error', message=reason)
+        self.etching_start.config(state='disabled')
+        self.test_connections_button.config(state='disabled')
+        self.etching_pause.config(state='normal', text='Pause')
+        self.etching_cancel.config(state='normal')
+        self.etching_progress.config(value=0)
+        self.etching_status_var.set('STARTING')
+        self.after(constants.STREAM_POLL_MS, self._poll_stream)
+
+    def _validation_message(self, report):
+        """ Returns the operator message describing a validation report """
+        lines = []
+        if report['bounds'] is not None:
+            lines.append('Job size: X {:.2f} to {:.2f}, Y {:.2f} to {:.2f}, Z {:.2f} to {:.2f} mm'.format(
+                report['bounds']['min'][0], report['bounds']['max'][0], report['bounds']['min'][1],
+                report['bounds']['max'][1], report['bounds']['min'][2], report['bounds']['max'][2]))
+        for kind, text in (('outside', 'Moves out of range'), ('invalid', 'Malformed lines'),
+                           ('unsupported', 'Unsupported lines')):
+            if report[kind + '_count']:
+                lines.append('{}: {} (lines {})'.format(text, report[kind + '_count'],
+                                                        ', '.join(str(line) for line in report[kind])))
+        return '\n'.join(lines)
+
+    def etching_pause(self):
+        """ Toggles a feed hold on the running etch """
+        if self.stream_worker is None:
             return
 
+        if self.stream_worker.control.paused:
+            self.stream_worker.resume()
+            self.etching_pause.config(text='Pause')
+        else:
+            self.stream_worker.pause()
+            self.etching_pause.config(text='Resume')
+
+    def etching_cancel(self):
+        """ Cancels the running etch or homing """
+        if self.stream_worker is None:
+            return
+
+        message = 'Stop homing the stage?' if self.homing else 'Stop the etching process?'
+        if messagebox.askyesno(title='Cancel', message=message):
+            self.stream_worker.cancel()
+            self.etching_pause.config(state='disabled')
+            self.etching_cancel.config(state='disabled')
+
+    def _poll_stream(self):
+        """ Drains the stream worker events and updates the etching widgets, see _finish_homing """
+        finished = None
+        for _ in range(constants.STREAM_EVENTS_PER_POLL):
+            try:
+                event = self.stream_worker.events.get_nowait()
+            except queue.Empty:
+                break
+
+            if event['type'] == 'started':
+                self.etching_progress.config(maximum=max(event['total'], 1))
+                self.etching_status_var.set('HOMING' if self.homing else 'RUNNING')
+            elif event['type'] == 'progress':
+                self.etching_progress.config(value=event['acked'])
+                self.etching_status_var.set('{}/{} BUF: {}'.format(event['acked'], event['total'], event['buffer']))
+            elif event['type'] == 'status':
+                self._show_machine_status(event)
+            elif event['type'] == 'paused':
+                self.etching_status_var.set('PAUSED')
+            elif event['type'] == 'alarm':
+                self.etching_status_var.set('ALARM')
+                messagebox.showerror(title='Alarm', message='grbl stopped with {} at line {}. Home the stage '
+                                     'and start the etch again to resume it.'.format(event['response'], event['line']))
+            elif event['type'] == 'laser' and not event['result']:
+                messagebox.showerror(title='Error', message=stream.laser_message(event))
+            elif event['type'] == 'finished':
+                finished = event
+                break
+
+        if finished is None:
+            self.after(constants.STREAM_POLL_MS, self._poll_stream)
+            return
+
+        self.stream_worker = None
+        self.etching_pause.config(state='disabled', text='Pause')
+        self.etching_cancel.config(state='disabled')
+        self.test_connections_button.config(state='normal')
+        if self.homing:
+            self._finish_homing(finished)
+            return
+        self.etching_start.config(state='normal')
+
+        if finished['cancelled']:
+            self.etching_status_var.set('CANCELLED')
+            return
+
+        if finished['result'] is False:
+            self.etching_status_var.set('FAILED')
+            messagebox.showerror(title='Error', message=finished['reason'])
+            return
+
+        self.etching_status_var.set('DONE')
         messagebox.showinfo(title='Success', message='Etching process complete!')
 
+    def _finish_homing(self, finished):
+        """ Allows the etching to start once the homing worker homed the stage """
+        self.homing = False
+        if finished['cancelled']:
+            self.etching_status_var.set('CANCELLED')
+            return
+
+        if finished['result'] is False:
+            self.etching_status_var.set('FAILED')
+            messagebox.showerror(title='Error', message=finished['reason'])
+            return
+
+        self.etching_status_var.set('READY')
+        self.etching_start.config(state='normal')
+        self._show_estimate()
+
+    def _show_machine_status(self, event):
+        """ Shows the latest status report and throughput metrics of grbl """
+        position = event['wpos'] or event['mpos'] or ()
+        axes = ' '.join('{}:{:.2f}'.format(axis, value) for axis, value in zip('XYZ', position))
+        metrics = event['metrics']
+        self.etching_machine_var.set('{} {}\n{:.1f} blocks/s  underruns: {}  starved: {:.1f}s'.format(
+            event['state'], axes, metrics['blocks_per_second'], metrics['underruns'], metrics['starved_time']))
+
     def open_file(self):
         """ Opens the file using default for operating system """
         os.startfile(self.file)
@@ -603,6 +889,34 @@ class Main(ttk.Frame):
                                         state=tkinter.DISABLED)
         self.etching_start.grid(row=4, column=1, padx=5, pady=10, columnspan=5)
 
+        self.etching_pause = ttk.Button(self.etching_frame, text='Pause', width=20, command=self.etching_pause,
+                                        state=tkinter.DISABLED)
+        self.etching_pause.grid(row=5, padx=5, pady=5)
+
+        self.etching_cancel = ttk.Button(self.etching_frame, text='Cancel', width=20, command=self.etching_cancel,
+                                         state=tkinter.DISABLED)
+        self.etching_cancel.grid(row=5, column=1, padx=5, pady=5, columnspan=5)
+
+        self.etching_progress = ttk.Progressbar(self.etching_frame, orient=tkinter.HORIZONTAL, length=150,
+                                                mode='determinate')
+        self.etching_progress.grid(row=6, padx=5, pady=5)
+
+        self.etching_status_var = tkinter.StringVar()
+        self.etching_status_label = ttk.Label(self.etching_frame, textvariable=self.etching_status_var,
+                                              anchor=tkinter.CENTER, background='gray60', width=20)
+        self.etching_status_var.set('NOT RUN')
+        self.etching_status_label.grid(row=6, column=1, padx=5, pady=5, columnspan=5)
+
+        self.etching_machine_var = tkinter.StringVar()
+        self.etching_machine_label = ttk.Label(self.etching_frame, textvariable=self.etching_machine_var,
+                                               anchor=tkinter.W, justify='left')
+        self.etching_machine_label.grid(row=7, padx=5, pady=5, sticky='W', columnspan=6)
+
+        self.etching_estimate_var = tkinter.StringVar()
+        self.etching_estimate_label = ttk.Label(self.etching_frame, textvariable=self.etching_estimate_var,
+                                                anchor=tkinter.W, justify='left')
+        self.etching_estimate_label.grid(row=8, padx=5, pady=5, sticky='W', columnspan=6)
+
         # --- Image preview ---
         self.image_frame = ttk.Frame(self.root, width=200, height=15)
         self.image_frame.grid(row=0, column=1, sticky='W', rowspan=2)
@@ -625,3 +939,4 @@ if __name__ == '__main__':
     root = tkinter.Tk()
     Main(root)
     root.mainloop()
+    session.close_session()
@@ -20,31 +20,35 @@
 """
 
 import serial
-import serial.tools.list_ports
 import os
-import subprocess
 import time
+import session
+import journal
 import stream
+import async_stream
 from utils import parsers
-from tkinter import messagebox
 
 
-def pre_test():
+def pre_test(alert=None):
     """ Runs the pre-test to check if what is required for etching is ready
 
     This pre-test runs the homing.gcode file, which attemps to home the stage
-    first, then home the stage to the origin point of the 3D glass cube
+    first, then home the stage to the origin point of the 3D glass cube.
+    It blocks until the stage is homed, use find_mcu and start_homing to home it
+    without blocking the calling thread.
+
+    :param alert: Function showing an error message to the operator, see stream.start_stream
     """
-    mcu_serial = parsers.get_from_config('serial_number', os.path.dirname(os.path.realpath(__file__)))
-    device_path = _get_device_path(mcu_serial)
+    device_path = find_mcu()
     reason = ''
 
     # Some spaghetti logic up in here
-    if device_path is False:
+    if device_path is None:
+        device_path = False
         reason = 'Could not find correct serial port'
         result = False
     else:
-        result = _home_stage(device_path)
+        result = stream.start_stream(_homing_gcode(), device_path, port=_mcu_port(), alert=alert)
         if result is False:
             reason = 'Error in streaming'
 
@@ -55,75 +59,84 @@ def pre_test():
     return ret_dict
 
 
-def _get_device_path(target_serial=None):
-    """ Returns the device path for first match of given serial """
-    if target_serial is None:
-        return False
+def find_mcu():
+    """ Looks the devices up, their ports stay open for the homing and the etching
+
+    :returns The device path of the MCU, None if it was not found
+    """
+    return session.get_session().discover()['mcu']
 
-    ports = list(serial.tools.list_ports.comports())
-    for p in ports:
-        if p.serial_number == target_serial:
-            return p.device
 
-    return False
+def start_homing(device_path):
+    """ Starts homing the stage on a background worker, see pre_test and start_etching
 
+    Returns the started StreamWorker, its finished event tells whether the stage was homed.
+    """
+    worker = stream.StreamWorker(_homing_gcode(), device_path, port=_mcu_port())
+    worker.start()
+    return worker
 
-def _home_stage(device_path):
-    """ Homes the stage to begin etching process """
-    homing_gcode = os.path.dirname(os.path.realpath(__file__)) + '\\homing.gcode'
-#     streaming_file = os.path.dirname(os.path.realpath(__file__)) + '\\stream.py'
-    return stream.start_stream(homing_gcode, device_path)
 
+def _homing_gcode():
+    """ Returns the path of the gcode file homing the stage """
+    return os.path.dirname(os.path.realpath(__file__)) + '\\homing.gcode'
 
-def full_test(filename, device_path):
-    """ Initiates the stream for the given gcode file
 
-    Requires the gcode file to be passed in and the device path
+def start_etching(filename, device_path, resume=False):
+    """ Starts streaming the given gcode file on a background worker
+
+    Returns the started StreamWorker, progress is read from its events queue.
+    The stream_engine key of the config selects the 'async' or blocking 'sync' streamer
+    and gcode_precision the decimals kept when compacting blocks (null sends them as is).
+    status_interval is the time in seconds between status reports (null disables polling).
+    The progress is journaled, resume continues from the checkpoint of the last etch of the file.
     """
-    result = stream.start_stream(filename, device_path)
-    if result is False:
-        reason = 'CRITICAL ERROR STREAMING GCODE'
-    else:
-        reason =''
+    path = os.path.dirname(os.path.realpath(__file__))
+    engine = parsers.get_from_config('stream_engine', path)
+    options = dict()
+    options['precision'] = parsers.get_from_config('gcode_precision', path)
+    options['status_interval'] = parsers.get_from_config('status_interval', path)
+    options['journaled'] = True
+    options['resume'] = resume
+    streamer = async_stream.run_stream if engine == 'async' else stream.stream_gcode
+    worker = stream.StreamWorker(filename, device_path, streamer=streamer, port=_mcu_port(), **options)
+    worker.start()
+    return worker
 
-    return result, reason
 
+def get_checkpoint(filename):
+    """ Returns the checkpoint an etch of the file can be resumed from, None if there is none """
+    precision = parsers.get_from_config('gcode_precision', os.path.dirname(os.path.realpath(__file__)))
+    return journal.load(filename, precision)
 
-def start_laser():
-    """ Establishes a connection and fires the laser """
-    laser_serial = parsers.get_from_config('laser_number', os.path.dirname(os.path.realpath(__file__)))
-    device_path = _get_device_path(laser_serial)
 
-    if device_path is False:
-        message = 'Could not find laser to turn on! Turn it on manually!\n' \
-                  'Etching process will continue after this is closed'
-        messagebox.showerror(title='Error', message=message)
-        return
+def _mcu_port():
+    """ Returns the open MCU port of the session, raises SerialException if it is not connected """
+    s = session.get_session().mcu_port()
+    if s is None:
+        raise serial.SerialException('Could not find correct serial port')
+    return s
 
-    s = serial.Serial(device_path, 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS)
-    s.write('$FIRE 01\r'.encode())
-    s.close()
 
+def start_laser():
+    """ Fires the laser over the open laser port of the session
 
-def stop_laser():
-    """ Stops the laser """
-    laser_serial = parsers.get_from_config('laser_number', os.path.dirname(os.path.realpath(__file__)))
-    device_path = _get_device_path(laser_serial)
+    :returns True if the command was sent, False if the laser was not found
+    """
+    return session.get_session().laser_on()
 
-    if device_path is False:
-        message = 'Could not find laser to turn off! Turn it off manually!\n'
-        messagebox.showerror(title='Error', message=message)
-        return
 
-    s = serial.Serial(device_path, 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS)
-    s.write('$STOP 00\r'.encode())
-    s.close()
+def stop_laser():
+    """ Stops the laser
+
+    :returns True if the command was sent, False if the laser was not found
+    """
+    return session.get_session().laser_off()
 
 
 if __name__ == "__main__":
-    print('starting')
-    start_laser()
+    print('starting', start_laser())
     print('stopping')
     time.sleep(2)
-    stop_laser()
+    print(stop_laser())
 
@@ -0,0 +1,183 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Keeps the serial connections of the MCU and the laser open for the
+   whole session. Both devices are found by the serial numbers in the
+   config with a single port scan, the ports then stay open across
+   homing, the etching job and the laser commands. A port that stopped
+   answering (the device got unplugged) is dropped and looked up again
+   the next time it is used.
+"""
+import os
+import threading
+
+import serial
+import serial.tools.list_ports
+
+from utils import parsers
+
+MCU_BAUDRATE = 115200
+LASER_BAUDRATE = 9600
+
+LASER_ON = b'$FIRE 01\r'
+LASER_OFF = b'$STOP 00\r'
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class SerialDevice:
+    """ A serial device found by its serial number, opened once and reused """
+
+    def __init__(self, serial_number, baudrate, **settings):
+        """
+        :param serial_number: The USB serial number of the device
+        :param settings: Keyword arguments passed on to serial.Serial
+        """
+        self.serial_number = serial_number
+        self.baudrate = baudrate
+        self.settings = settings
+        self.path = None
+        self.s = None
+        self.lock = threading.RLock()
+
+    @property
+    def connected(self):
+        return self.s is not None
+
+    def open(self):
+        """ Returns the open serial port, reconnecting if it was lost
+
+        :returns The serial.Serial of the device or None if the device was not found
+        """
+        with self.lock:
+            if self.s is not None:
+                try:
+                    self.s.in_waiting # Fails once the device is gone
+                    return self.s
+                except (serial.SerialException, OSError):
+                    self.close()
+                    self.path = None
+
+            if self.path is None:
+                self.path = find_ports([self.serial_number]).get(self.serial_number)
+                if self.path is None:
+                    return None
+
+            try:
+                self.s = serial.Serial(self.path, self.baudrate, **self.settings)
+            except (serial.SerialException, OSError):
+                # The port may have been renumbered after a reconnect, look it up next time
+                self.path = None
+                return None
+            return self.s
+
+    def write(self, data):
+        """ Writes to the device, reconnecting once if the port was lost
+
+        :returns True if the data was written, False if the device is not available
+        """
+        with self.lock:
+            for _ in range(2):
+                s = self.open()
+                if s is None:
+                    return False
+                try:
+                    s.write(data)
+                    return True
+                except (serial.SerialException, OSError):
+                    self.close()
+                    self.path = None
+            return False
+
+    def close(self):
+        """ Closes the port, the device path is kept for the next open """
+        with self.lock:
+            if self.s is not None:
+                try:
+                    self.s.close()
+                except (serial.SerialException, OSError):
+                    pass
+                self.s = None
+
+
+class DeviceSession:
+    """ The open connections to the MCU running grbl and to the laser """
+
+    def __init__(self, mcu_number, laser_number):
+        self.mcu = SerialDevice(mcu_number, MCU_BAUDRATE)
+        self.laser = SerialDevice(laser_number, LASER_BAUDRATE, parity=serial.PARITY_NONE,
+                                  stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS)
+
+    def discover(self):
+        """ Finds both devices with a single port scan
+
+        :returns dict with the mcu and laser device paths, None for a device that was not found
+        """
+        found = find_ports([self.mcu.serial_number, self.laser.serial_number])
+        for device in (self.mcu, self.laser):
+            with device.lock:
+                if found.get(device.serial_number) != device.path:
+                    device.close()
+                device.path = found.get(device.serial_number)
+
+        ret_dict = dict()
+        ret_dict['mcu'] = self.mcu.path
+        ret_dict['laser'] = self.laser.path
+        return ret_dict
+
+    def mcu_port(self):
+        """ Returns the open port of the MCU or None if it was not found """
+        return self.mcu.open()
+
+    def laser_on(self):
+        """ Fires the laser, returns False if the laser was not found """
+        return self.laser.write(LASER_ON)
+
+    def laser_off(self):
+        """ Stops the laser, returns False if the laser was not found """
+        return self.laser.write(LASER_OFF)
+
+    def close(self):
+        self.mcu.close()
+        self.laser.close()
+
+
+def find_ports(serial_numbers):
+    """ Returns a dict of serial number to device path for the given numbers that are connected """
+    found = dict()
+    for p in serial.tools.list_ports.comports():
+        if p.serial_number is not None and p.serial_number in serial_numbers and p.serial_number not in found:
+            found[p.serial_number] = p.device
+    return found
+
+
+def get_session():
+    """ Returns the session of the program, created from the serial numbers in the config """
+    global _session
+    with _session_lock:
+        if _session is None:
+            path = os.path.dirname(os.path.realpath(__file__))
+            _session = DeviceSession(parsers.get_from_config('serial_number', path),
+                                     parsers.get_from_config('laser_number', path))
+        return _session
+
+
+def close_session():
+    """ Closes the ports of the session if one was created """
+    with _session_lock:
+        if _session is not None:
+            _session.close()
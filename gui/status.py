@@ -0,0 +1,202 @@
+"""
+   Copyright 2017 Nicolas Ramirez
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   ----------------------------------------------------------------------
+   Realtime status reports of grbl. A poller thread sends the '?' byte at
+   a fixed rate, the streamer hands the '<...>' reports it reads to a
+   StatusMonitor which keeps a ring buffer of samples and derives the
+   live throughput metrics from them.
+
+   '?' is a realtime command that grbl picks out of the serial stream
+   before it reaches the RX buffer, and status reports are neither 'ok'
+   nor 'error', so polling never touches the character counting.
+"""
+import collections
+import re
+import threading
+import time
+
+# grbl 1.1 planner blocks, used until the reports show a larger free count
+PLANNER_SIZE = 15
+RX_BUFFER_SIZE = 128
+
+SAMPLES = 1000
+
+# Seconds of samples used for the live blocks per second
+METRICS_WINDOW = 5.0
+
+StatusSample = collections.namedtuple('StatusSample', 'time state mpos wpos planner_free rx_free feed acked')
+
+GRBL09_FIELD = re.compile(r'(MPos|WPos|Buf|RX):([-\d.,]+?)(?=,[A-Za-z]|$)')
+
+
+def is_status(line):
+    """ Returns True if the response line is a status report """
+    return line.startswith('<') and line.endswith('>')
+
+
+def parse_status(line, planner_size=PLANNER_SIZE):
+    """ Parses a grbl 1.1 or 0.9 status report
+
+    :returns dict with state, mpos, wpos, wco, planner_free, rx_free and feed, fields that
+    are not part of the report are None. Returns None if the line is not a status report
+    """
+    if not is_status(line):
+        return None
+
+    status = dict(state=None, mpos=None, wpos=None, wco=None, planner_free=None, rx_free=None, feed=None)
+    body = line[1:-1]
+
+    if '|' in body:
+        fields = body.split('|')
+        status['state'] = fields[0].split(':')[0]
+        for field in fields[1:]:
+            name, _, value = field.partition(':')
+            values = _floats(value)
+            if name == 'MPos':
+                status['mpos'] = values
+            elif name == 'WPos':
+                status['wpos'] = values
+            elif name == 'WCO':
+                status['wco'] = values
+            elif name == 'Bf' and len(values) == 2:
+                status['planner_free'], status['rx_free'] = int(values[0]), int(values[1])
+            elif name in ('FS', 'F') and values:
+                status['feed'] = values[0]
+        return status
+
+    # grbl 0.9 reports the used planner blocks and RX characters instead
+    state, _, rest = body.partition(',')
+    status['state'] = state
+    for name, value in GRBL09_FIELD.findall(rest):
+        values = _floats(value)
+        if name == 'MPos':
+            status['mpos'] = values
+        elif name == 'WPos':
+            status['wpos'] = values
+        elif name == 'Buf' and values:
+            status['planner_free'] = planner_size - int(values[0])
+        elif name == 'RX' and values:
+            status['rx_free'] = RX_BUFFER_SIZE - int(values[0])
+    return status
+
+
+def _floats(value):
+    try:
+        return tuple(float(v) for v in value.split(','))
+    except ValueError:
+        return None
+
+
+class StatusMonitor:
+    """ Ring buffer of status samples and the metrics derived from them """
+
+    def __init__(self, size=SAMPLES, planner_size=PLANNER_SIZE):
+        self.samples = collections.deque(maxlen=size)
+        self.planner_size = planner_size
+        self.wco = None
+        self.streaming = False
+        self.underruns = 0
+        self.starved_time = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, line, acked, now=None):
+        """ Adds a status report read by the streamer
+
+        :param line: The '<...>' report line
+        :param acked: Number of blocks grbl acknowledged so far
+        :returns The new StatusSample, None if the line is not a status report
+        """
+        status = parse_status(line, self.planner_size)
+        if status is None:
+            return None
+
+        now = time.time() if now is None else now
+        if status['wco'] is not None:
+            self.wco = status['wco']
+        if status['planner_free'] is not None and status['planner_free'] > self.planner_size:
+            self.planner_size = status['planner_free']
+
+        # grbl 1.1 only reports one of the positions, the other follows from the last work offset
+        mpos, wpos = status['mpos'], status['wpos']
+        if self.wco is not None:
+            if mpos is None and wpos is not None:
+                mpos = tuple(w + o for w, o in zip(wpos, self.wco))
+            elif wpos is None and mpos is not None:
+                wpos = tuple(m - o for m, o in zip(mpos, self.wco))
+
+        sample = StatusSample(now, status['state'], mpos, wpos, status['planner_free'],
+                              status['rx_free'], status['feed'], acked)
+
+        with self._lock:
+            last = self.samples[-1] if self.samples else None
+            if self.streaming and last is not None and acked > 0:
+                if self._starved(last):
+                    self.starved_time += now - last.time
+                elif self._starved(sample):
+                    self.underruns += 1
+            self.samples.append(sample)
+        return sample
+
+    def _starved(self, sample):
+        """ True if the machine had nothing left to execute in this sample """
+        if sample.state == 'Idle':
+            return True
+        return sample.planner_free is not None and sample.planner_free >= self.planner_size
+
+    def latest(self):
+        """ Returns the most recent sample or None """
+        with self._lock:
+            return self.samples[-1] if self.samples else None
+
+    def metrics(self, window=None):
+        """ Returns the throughput metrics
+
+        :param window: Only use the samples of the last window seconds for blocks_per_second
+        :returns dict with blocks_per_second, underruns and starved_time (seconds the machine
+        sat idle waiting for data while streaming)
+        """
+        with self._lock:
+            samples = list(self.samples)
+        if window is not None and samples:
+            samples = [sample for sample in samples if sample.time >= samples[-1].time - window]
+
+        blocks_per_second = 0.0
+        if len(samples) > 1 and samples[-1].time > samples[0].time:
+            blocks_per_second = (samples[-1].acked - samples[0].acked) / (samples[-1].time - samples[0].time)
+
+        return {'blocks_per_second': blocks_per_second, 'underruns': self.underruns,
+                'starved_time': self.starved_time}
+
+
+class StatusPoller(threading.Thread):
+    """ Sends grbl's realtime status request at a fixed interval """
+
+    def __init__(self, s, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.s = s
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.s.write(b'?')
+            except Exception:
+                return
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
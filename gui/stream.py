@@ -11,6 +11,8 @@ response from the computer. This effectively adds another
 buffer layer to prevent buffer starvation.
 
 CHANGELOG:
+- 201710: Moved streaming onto a worker thread that reports progress events
+  through a queue so the GUI stays responsive - Nicolas R.
 - 201748: Converted to Python3 and tkinter for laser etching - Nicolas R.
 - 20161212: Added push message feedback for simple streaming
 - 20140714: Updated baud rate to 115200. Added a settings
@@ -52,12 +54,26 @@ Modifications to work with Python3 and laser etching software by Nicolas R.
 
 import serial
 import serials
-import re
+import queue
 import time
-import sys
-import argparse
-from tkinter import messagebox
-# import threading
+import threading
+import status
+import journal
+import os
+from gcode import compaction
+
+RX_BUFFER_SIZE = 128
+
+# Number of acknowledged blocks before the laser gets fired
+LASER_START_BLOCK = 100
+
+# Start of grbl's welcome banner, seconds to wait for it and to wait before a soft reset
+BANNER = 'Grbl '
+WAKE_TIMEOUT = 10.0
+RESET_AFTER = 2.5
+
+# Serial read timeout and status poll interval of the startup and shutdown handshakes
+POLL_INTERVAL = 0.05
 
 # Define command line argument interface
 # parser = argparse.ArgumentParser(description='Stream g-code file to grbl. (pySerial and argparse libraries required)')
@@ -71,106 +87,482 @@ from tkinter import messagebox
 #         help='settings write mode')
 # args = parser.parse_args()
 
-# Periodic timer to query for status reports
-# TODO: Need to track down why this doesn't restart consistently before a release.
-# def periodic():
-#     s.write('?')
-#     t = threading.Timer(0.1, periodic) # In seconds
-#     t.start()
+class StreamControl:
+    """ Cancel and pause handle shared between the GUI and the streaming thread """
+
+    def __init__(self):
+        self._cancel = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+
+    def cancel(self):
+        """ Requests the stream to stop as soon as possible """
+        self._cancel.set()
+        self._running.set()
+
+    def pause(self):
+        """ Requests a feed hold and stops sending new blocks """
+        self._running.clear()
+
+    def resume(self):
+        """ Resumes a paused stream """
+        self._running.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def wait(self, timeout=None):
+        """ Blocks while paused, returns True once running again """
+        return self._running.wait(timeout)
 
 
-def start_stream(gcode_file, device_file, quiet=False, settings=False):
+class StreamWorker(threading.Thread):
+    """ Streams a gcode file on its own thread
+
+    The worker opens and owns the serial port for the duration of the stream unless an
+    already open port is given, which is left open for the next stream. Progress is
+    reported as event dicts on the events queue, the GUI is expected to drain it with
+    after() polling and must never be touched from this thread.
+    """
+
+    def __init__(self, gcode_file, device_file, streamer=None, port=None, **options):
+        """
+        :param streamer: The streaming function, stream_gcode by default
+        :param port: Open serial port to stream over instead of opening device_file
+        :param options: Keyword arguments passed on to the streaming function
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.gcode_file = gcode_file
+        self.device_file = device_file
+        self.options = options
+        self.streamer = streamer if streamer is not None else stream_gcode
+        self.port = port
+        self.control = StreamControl()
+        self.events = queue.Queue()
+
+    def cancel(self):
+        self.control.cancel()
+
+    def pause(self):
+        self.control.pause()
+
+    def resume(self):
+        self.control.resume()
+
+    def run(self):
+        s = None
+        try:
+            s = self.port if self.port is not None else serial.Serial(self.device_file, 115200)
+            self.streamer(s, self.gcode_file, self.events.put, self.control, **self.options)
+        except Exception as e:
+            laser_off = serials.stop_laser()
+            self.events.put({'type': 'laser', 'on': False, 'result': laser_off})
+            self.events.put({'type': 'finished', 'result': False, 'cancelled': False,
+                             'reason': 'There was a critical error: {}'.format(e)})
+        finally:
+            if s is not None and s is not self.port:
+                s.close()
+
+
+def start_stream(gcode_file, device_file, quiet=False, settings=False, port=None, alert=None):
     """
     Starts the streaming to the microcontroller
 
+    This blocks until the stream is completed. Use StreamWorker to stream
+    without blocking the calling thread.
+
     :param gcode_file: The Gcode File
     :param device_file: The Device Path
     :param quiet: Boolean to indicate whether or not to print to output (Default is false)
     :param settings: Boolean to indicate whether or not to go to settings mode (Default is false)
+    :param port: Open serial port to use instead of opening device_file, it is left open
+    :param alert: Function showing an error message to the operator, a messagebox by default
 
     :return: True or False depending on the outcome
     """
-    RX_BUFFER_SIZE = 128
+    s = port if port is not None else serial.Serial(device_file, 115200)
+    events = []
+
+    def emit(event):
+        events.append(event)
+        if not quiet:
+            print_event(event)
+
+    try:
+        flag = stream_gcode(s, gcode_file, emit, settings=settings)
+    finally:
+        if s is not port:
+            s.close()
+
+    if alert is None:
+        alert = show_error
+    for event in events:
+        if event['type'] == 'laser' and not event['result']:
+            alert(laser_message(event))
+    return flag
+
+
+def stream_gcode(s, gcode_file, emit, control=None, settings=False, precision=None, laser=True,
+                 status_interval=None, journaled=False, resume=False):
+    """
+    Streams the gcode file over an already opened serial port
+
+    :param s: The open serial port of grbl
+    :param gcode_file: The Gcode File
+    :param emit: Callable receiving the progress event dicts
+    :param control: Optional StreamControl to cancel or pause the stream
+    :param settings: Boolean to indicate whether or not to go to settings mode (Default is false)
+    :param precision: Compacts the blocks to this many decimals when given, see read_blocks
+    :param laser: Boolean to indicate whether or not to switch the laser (Default is true)
+    :param status_interval: Seconds between '?' status reports while streaming, None to not poll
+    :param journaled: Records the progress in the journal of the gcode file, see journal.Journal
+    :param resume: Continues from the checkpoint in the journal of the gcode file
+
+    :return: True or False depending on the outcome
+    """
+    if control is None:
+        control = StreamControl()
+    if settings:
+        precision = None
+        journaled = resume = False
+
+    record = start_journal(gcode_file, precision, journaled, resume)
+    if record is False:
+        emit(no_journal_event(gcode_file))
+        return False
 
     # Initialize
     flag = True
-    s = serial.Serial(device_file,115200)
     f = open(gcode_file, 'r')
-    verbose = True
-    if quiet : verbose = False
-    settings_mode = False
-    if settings : settings_mode = True
-
-    # Wake up grbl
-    print("Initializing grbl...")
-    s.write("\r\n\r\n".encode())
-
-    # Wait for grbl to initialize and flush startup text in serial input
-    time.sleep(2)
-    s.flushInput()
-
-    laser_started = False
-    # Stream g-code to grbl
-    l_count = 0
-    if settings_mode:
-        # Send settings file via simple call-response streaming method. Settings must be streamed
-        # in this manner since the EEPROM accessing cycles shut-off the serial interrupt.
-        print("SETTINGS MODE: Streaming", gcode_file, " to ", device_file)
-        for line in f:
-            l_count += 1 # Iterate line counter
-            # l_block = re.sub('\s|\(.*?\)','',line).upper() # Strip comments/spaces/new line and capitalize
-            l_block = line.strip() # Strip all EOL characters for consistency
-            if verbose: print ('SND: ' + str(l_count) + ':' + l_block,
-            s.write((l_block + '\n').encode()))# Send g-code block to grbl
-            while 1:
-                grbl_out = s.readline().strip() # Wait for grbl response with carriage return
-                if grbl_out.find('ok') < 0 and grbl_out.find('error') < 0 :
-                    print("\n  Debug: ",grbl_out,)
-                else :
-                    if verbose: print('REC:',grbl_out)
-                    break
-    else:
-        # Send g-code program via a more agressive streaming protocol that forces characters into
-        # Grbl's serial read buffer to ensure Grbl has immediate access to the next g-code command
-        # rather than wait for the call-response serial protocol to finish. This is done by careful
-        # counting of the number of characters sent by the streamer to Grbl and tracking Grbl's
-        # responses, such that we never overflow Grbl's serial read buffer.
+    stats = compaction.new_stats()
+    total = sum(1 for _ in read_blocks(f, precision, stats))
+    f.seek(0)
+    if record is not None:
+        total += len(record.preamble) - record.start
+
+    # Wake up grbl and wait for it to answer
+    emit({'type': 'message', 'text': 'Initializing grbl...'})
+    if not wake_grbl(s):
+        f.close()
+        emit({'type': 'finished', 'result': False, 'cancelled': False, 'metrics': None,
+              'reason': 'grbl did not respond'})
+        return False
+    emit({'type': 'started', 'file': gcode_file, 'total': total, 'settings': settings,
+          'compaction': stats if precision is not None else None,
+          'resumed': record.start if record is not None else 0})
+
+    cancelled = False
+    finished = False
+    try:
+        laser_started = not laser
+        laser_block = record.laser_block(LASER_START_BLOCK) if record is not None else LASER_START_BLOCK
+        # Stream g-code to grbl
+        l_count = 0
         g_count = 0
-        c_line = []
-        # periodic() # Start status report periodic timer
-        for line in f:
-            if g_count > 100 and laser_started is False:
-                serials.start_laser() # Start laser after 80 lines of gcode
-                laser_started = True
-            l_count += 1 # Iterate line counter
-            # l_block = re.sub('\s|\(.*?\)','',line).upper() # Strip comments/spaces/new line and capitalize
-            l_block = line.strip()
-            c_line.append(len(l_block)+1) # Track number of characters in grbl serial read buffer
-            grbl_out = ''
-            while sum(c_line) >= RX_BUFFER_SIZE-1 | s.inWaiting() :
-                out_temp = s.readline().strip() # Wait for grbl response
-                if out_temp.decode().find('ok') < 0 and out_temp.decode().find('error') < 0 :
-                    print("  Debug: ",out_temp) # Debug response
-                elif out_temp.decode().find('ALARM') > -1:
-                    flag = False
-                else :
-                    grbl_out += out_temp.decode();
-                    g_count += 1 # Iterate g-code counter
-                    grbl_out += str(g_count); # Add line finished indicator
-                    del c_line[0] # Delete the block character count corresponding to the last 'ok'
-            if verbose: print ("SND: " + str(l_count) + " : " + l_block,
-            s.write((l_block + '\n').encode()) )# Send g-code block to grbl
-            if verbose : print ("BUF:",str(sum(c_line)),"REC:",grbl_out)
-
-    # Wait for user input after streaming is completed
-    print ("G-code streaming finished!\n")
-    print ("WARNING: Wait until grbl completes buffered g-code blocks before exiting.")
-    # input("  Press <Enter> to exit and disable grbl.")
-    time.sleep(5)
-    serials.stop_laser()
-    messagebox.showwarning(title='WARNING:', message='Wait until motors stop moving before hitting OK.')
-
-    # Close file and serial port
-    f.close()
-    s.close()
+        metrics = None
+        if settings:
+            # Send settings file via simple call-response streaming method. Settings must be streamed
+            # in this manner since the EEPROM accessing cycles shut-off the serial interrupt.
+            for line in f:
+                if control.cancelled:
+                    cancelled = True
+                    break
+                l_count += 1 # Iterate line counter
+                # l_block = re.sub('\s|\(.*?\)','',line).upper() # Strip comments/spaces/new line and capitalize
+                l_block = line.strip() # Strip all EOL characters for consistency
+                s.write((l_block + '\n').encode()) # Send g-code block to grbl
+                while 1:
+                    grbl_out = s.readline().strip().decode() # Wait for grbl response with carriage return
+                    if grbl_out.find('ok') < 0 and grbl_out.find('error') < 0 :
+                        emit({'type': 'message', 'text': grbl_out})
+                    else :
+                        g_count += 1
+                        if grbl_out.find('error') > -1:
+                            emit({'type': 'error', 'line': l_count, 'block': l_block, 'response': grbl_out})
+                        break
+                emit({'type': 'progress', 'sent': l_count, 'acked': g_count, 'total': total,
+                      'buffer': 0, 'block': l_block, 'response': grbl_out})
+        else:
+            # Send g-code program via a more agressive streaming protocol that forces characters into
+            # Grbl's serial read buffer to ensure Grbl has immediate access to the next g-code command
+            # rather than wait for the call-response serial protocol to finish. This is done by careful
+            # counting of the number of characters sent by the streamer to Grbl and tracking Grbl's
+            # responses, such that we never overflow Grbl's serial read buffer.
+            c_line = []
+            c_block = []
+            monitor, poller = start_status(s, status_interval) # Start status report periodic timer
+            try:
+
+                def read_response():
+                    """ Reads one response, returns the ok/error text or an empty string """
+                    nonlocal flag, g_count
+                    out_temp = s.readline().strip().decode() # Wait for grbl response
+                    if out_temp.find('ALARM') > -1:
+                        flag = False
+                        if record is not None:
+                            record.stop()
+                        emit({'type': 'alarm', 'line': c_block[0][0] if c_block else l_count,
+                              'response': out_temp})
+                    elif monitor is not None and status.is_status(out_temp):
+                        emit(status_event(monitor, out_temp, g_count))
+                    elif out_temp.find('ok') < 0 and out_temp.find('error') < 0 :
+                        emit({'type': 'message', 'text': out_temp}) # Debug response
+                    elif c_line:
+                        if out_temp.find('error') > -1:
+                            emit({'type': 'error', 'line': c_block[0][0], 'response': out_temp})
+                        g_count += 1 # Iterate g-code counter
+                        if record is not None:
+                            record.ack(c_block[0][1])
+                        del c_line[0] # Delete the block character count corresponding to the last 'ok'
+                        del c_block[0]
+                        return out_temp + str(g_count) # Add line finished indicator
+                    return ''
+
+                l_blocks = read_blocks(f, precision)
+                if record is not None:
+                    l_blocks = record.blocks(l_blocks)
+                for l_block in l_blocks:
+                    if not flag:
+                        break # grbl is in alarm and rejects every block from here on
+                    if control.paused and not control.cancelled:
+                        s.write(b'!') # Feed hold
+                        emit({'type': 'paused'})
+                        control.wait()
+                        if not control.cancelled:
+                            s.write(b'~') # Cycle start
+                            emit({'type': 'resumed'})
+                    if control.cancelled:
+                        cancelled = True
+                        break
+                    if g_count > laser_block and laser_started is False:
+                        laser_started = True
+                        emit({'type': 'laser', 'on': True, 'result': serials.start_laser()})
+                    l_count += 1 # Iterate line counter
+                    c_line.append(len(l_block)+1) # Track number of characters in grbl serial read buffer
+                    c_block.append((l_count, l_block))
+                    grbl_out = ''
+                    while sum(c_line) >= RX_BUFFER_SIZE-1 or s.inWaiting() :
+                        grbl_out += read_response()
+                    s.write((l_block + '\n').encode()) # Send g-code block to grbl
+                    emit({'type': 'progress', 'sent': l_count, 'acked': g_count, 'total': total,
+                          'buffer': sum(c_line), 'block': l_block, 'response': grbl_out})
+
+                # Wait for grbl to acknowledge every block still in its buffer
+                while c_line and flag and not cancelled:
+                    grbl_out = read_response()
+                    if grbl_out:
+                        emit({'type': 'progress', 'sent': l_count, 'acked': g_count, 'total': total,
+                              'buffer': sum(c_line), 'block': '', 'response': grbl_out})
+            finally:
+                metrics = stop_status(monitor, poller)
+
+        if flag and not cancelled:
+            emit({'type': 'message', 'text': 'G-code streaming finished, waiting for grbl to go idle'})
+            if not wait_until_idle(s, control):
+                cancelled = control.cancelled
+                flag = False
+        finished = True
+    except Exception:
+        # Stop motion and flush grbl's planner, the caller reports the error
+        try:
+            s.write(b'!')
+            s.write(b'\x18')
+        except Exception as e:
+            print(e)
+        raise
+    finally:
+        if record is not None:
+            if finished and flag and not cancelled:
+                record.clear()
+            else:
+                record.save()
+        f.close()
+
+    if cancelled:
+        # Stop motion and flush grbl's planner
+        s.write(b'!')
+        s.write(b'\x18')
+        flag = False
+
+    if laser:
+        emit({'type': 'laser', 'on': False, 'result': serials.stop_laser()})
+
+    emit({'type': 'finished', 'result': flag, 'cancelled': cancelled, 'metrics': metrics,
+          'reason': 'Cancelled' if cancelled else '' if flag else 'CRITICAL ERROR STREAMING GCODE'})
     return flag
+
+
+def wake_grbl(s, timeout=WAKE_TIMEOUT):
+    """ Wakes up grbl and waits for it to answer instead of sleeping a fixed time
+
+    Returns as soon as grbl acknowledges both wake up lines or prints its welcome banner
+    after the reset caused by opening the port. When neither shows up grbl gets a soft
+    reset, which prints the banner as well.
+
+    :return: True once grbl answered, False on timeout
+    """
+    previous = s.timeout
+    s.timeout = POLL_INTERVAL
+    try:
+        s.flushInput() # Discard any stale startup text
+        s.write("\r\n\r\n".encode())
+        start = time.time()
+        oks = 0
+        reset = False
+        while time.time() - start < timeout:
+            grbl_out = s.readline().strip().decode(errors='replace')
+            if grbl_out.startswith(BANNER):
+                # Wake up lines that arrived after the reset are answered right after the banner
+                while s.readline():
+                    pass
+                return True
+            if grbl_out == 'ok':
+                oks += 1
+                if oks == 2:
+                    return True
+            if not reset and time.time() - start > RESET_AFTER:
+                s.write(b'\x18')
+                reset = True
+        return False
+    finally:
+        s.timeout = previous
+
+
+def wait_until_idle(s, control=None, timeout=None):
+    """ Polls grbl's status until it reports Idle with an empty planner
+
+    Only call this once every block was acknowledged, any other response is discarded.
+
+    :param control: Optional StreamControl, a cancel stops the waiting
+    :param timeout: Seconds to wait at most, None waits for as long as the job runs
+    :return: True once idle, False on alarm, cancel or timeout
+    """
+    previous = s.timeout
+    s.timeout = POLL_INTERVAL
+    try:
+        start = time.time()
+        idle = 0
+        planner_size = status.PLANNER_SIZE
+        while timeout is None or time.time() - start < timeout:
+            if control is not None and control.cancelled:
+                return False
+            s.write(b'?')
+            report = status.parse_status(s.readline().strip().decode(errors='replace'))
+            if report is None:
+                continue
+            if report['state'].startswith('Alarm'):
+                return False
+            if report['planner_free'] is not None:
+                planner_size = max(planner_size, report['planner_free'])
+            empty = report['planner_free'] is None or report['planner_free'] >= planner_size
+            # Two reports in a row so a block that was just parsed gets the chance to start
+            idle = idle + 1 if report['state'] == 'Idle' and empty else 0
+            if idle == 2:
+                return True
+            time.sleep(POLL_INTERVAL)
+        return False
+    finally:
+        s.timeout = previous
+
+
+def start_journal(gcode_file, precision, journaled, resume):
+    """ Returns the Journal recording the stream
+
+    :return: The Journal, None if the stream is not journaled or False if there is no
+    journal to resume from
+    """
+    if not journaled and not resume:
+        return None
+    checkpoint = journal.load(gcode_file, precision) if resume else None
+    if resume and checkpoint is None:
+        return False
+    return journal.Journal(gcode_file, precision, checkpoint)
+
+
+def no_journal_event(gcode_file):
+    """ Returns the finished event of a resume without a journal """
+    return {'type': 'finished', 'result': False, 'cancelled': False, 'metrics': None,
+            'reason': 'There is no journal to resume {} from'.format(os.path.basename(gcode_file))}
+
+
+def start_status(s, interval):
+    """ Starts polling grbl's status reports every interval seconds
+
+    :returns The StatusMonitor fed by the streamer and the StatusPoller, both None without interval
+    """
+    if not interval:
+        return None, None
+
+    monitor = status.StatusMonitor()
+    monitor.streaming = True
+    poller = status.StatusPoller(s, interval)
+    poller.start()
+    return monitor, poller
+
+
+def stop_status(monitor, poller):
+    """ Stops the status poller
+
+    :returns The final metrics of the monitor, None if no status was polled
+    """
+    if poller is None:
+        return None
+
+    poller.stop()
+    monitor.streaming = False
+    return monitor.metrics()
+
+
+def status_event(monitor, line, acked):
+    """ Records a status report and returns the matching status event """
+    sample = monitor.record(line, acked)
+    return {'type': 'status', 'state': sample.state, 'mpos': sample.mpos, 'wpos': sample.wpos,
+            'feed': sample.feed, 'planner_free': sample.planner_free, 'rx_free': sample.rx_free,
+            'metrics': monitor.metrics(status.METRICS_WINDOW)}
+
+
+def read_blocks(f, precision=None, stats=None):
+    """ Returns an iterator over the blocks of an open gcode file
+
+    With a precision the blocks are compacted by gcode.compaction, which strips comments,
+    whitespace and modal words still in effect. Otherwise only EOL characters are stripped.
+    """
+    if precision is None:
+        return (line.strip() for line in f)
+    return compaction.compact(f, precision, stats)
+
+
+def show_error(message):
+    """ Shows an error messagebox, tkinter is only needed once there is an error to show """
+    from tkinter import messagebox
+    messagebox.showerror(title='Error', message=message)
+
+
+def laser_message(event):
+    """ Returns the operator message for a failed laser event """
+    if event['on']:
+        return 'Could not find laser to turn on! Turn it on manually!\n' \
+               'Etching process will continue after this is closed'
+    return 'Could not find laser to turn off! Turn it off manually!\n'
+
+
+def print_event(event):
+    """ Prints a streaming event the way the original script did """
+    if event['type'] == 'progress':
+        print("SND: " + str(event['sent']) + " : " + event['block'])
+        print("BUF:", str(event['buffer']), "REC:", event['response'])
+    elif event['type'] == 'started':
+        print("Streaming", event['file'], "(SETTINGS MODE)" if event['settings'] else "")
+        if event['compaction']:
+            print("Compaction saved", event['compaction']['bytes_saved'], "bytes")
+    elif event['type'] == 'message':
+        print("  Debug: ", event['text'])
+    elif event['type'] in ('alarm', 'error'):
+        print("  {}: line {} : {}".format(event['type'].upper(), event['line'], event['response']))
+    elif event['type'] == 'finished':
+        print("Finished:", event['result'], event['reason'])
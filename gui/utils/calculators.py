@@ -11,3 +11,17 @@ def center(parent, width=None, height=None):
     x = (parent.winfo_screenwidth() // 2) - (width // 2)
     y = (parent.winfo_screenheight() // 2) - (height // 2)
     return '{}x{}+{}+{}'.format(width, height, x, y)
+
+
+def duration(seconds):
+    """ Formats a number of seconds as H:MM:SS """
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+def bed_shape(x, y):
+    """ Returns the Slic3r bed_shape of an x by y inches bed with its corner at the origin """
+    x = 25.4 * x
+    y = 25.4 * y
+    return '0x0,{}x0,{}x{},0x{}'.format(x, x, y, y)
@@ -21,3 +21,11 @@ CONVERSION_MODES = [
     ('PGM', '.pgm'),
     ('PBM', '.pbm')
 ]
+
+# Milliseconds between polls of the stream worker events and max events handled per poll
+STREAM_POLL_MS = 100
+STREAM_EVENTS_PER_POLL = 200
+
+# Size in inches of the glass cube and the margin left around the object on every axis
+CUBE_SIZE = 2.75
+CUBE_MARGIN = .375
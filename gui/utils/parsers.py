@@ -23,3 +23,36 @@ def get_from_config(key, file_path):
     with open(os.path.join(file_path, 'config.json')) as file:
         data = json.load(file)
         return data[key]
+
+
+def get_from_ini(key, file_path):
+    """
+    :param key: The key from the Slic3r config.ini file
+    :param file_path: the main filepath where config.ini is located
+
+    :return: The value associated to the key as a string, None if the key is not in the file
+    """
+    with open(os.path.join(file_path, 'config.ini')) as file:
+        for line in file:
+            name, separator, value = line.partition('=')
+            if separator and name.strip() == key:
+                return value.strip()
+    return None
+
+
+def set_in_ini(key, value, file_path):
+    """ Replaces the value of a key in the Slic3r config.ini file
+
+    :param key: The key from the Slic3r config.ini file, lines of other keys are kept as they are
+    :param value: The new value, written as a string
+    :param file_path: the main filepath where config.ini is located
+    """
+    filename = os.path.join(file_path, 'config.ini')
+    with open(filename) as file:
+        lines = file.readlines()
+    with open(filename, 'w') as file:
+        for line in lines:
+            name, separator, old = line.partition('=')
+            if separator and name.strip() == key:
+                line = '{} = {}\n'.format(key, value)
+            file.write(line)
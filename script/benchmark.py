@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""\
+Streaming throughput benchmark against the fake grbl device
+
+Streams every g-code file through every streamer, each run against a fresh
+fake_grbl.FakeGrbl on a pseudo-terminal, and reports per run:
+
+- lines/s     blocks executed per second of job time
+- starved     time the planner sat empty between the first and last block
+- underruns   number of times the planner ran dry mid-job
+- job         time from the first planned block to the last executed one
+- wall        total time of the streamer, including its startup and shutdown
+
+Streamers:
+    sync, async                    gui/stream.py and gui/async_stream.py
+    sync-compact, async-compact    the same with the compaction stage enabled
+    script, simple                 script/stream.py and script/simple_stream.py,
+                                   run with the python 2 interpreter given by --python2
+
+With --arc-tolerance the files are arc fitted first (see gui/gcode/arcs.py),
+the fitted copies are written to a temporary directory.
+
+Usage:
+    python3 benchmark.py [-s async sync] [-f file.gcode ...] [--time-scale 0.1] [--arc-tolerance 0.01]
+                         [--json out.json]
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import serial
+
+import fake_grbl
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(SCRIPT_PATH), 'gui'))
+
+import async_stream
+import stream
+from gcode import arcs
+
+STREAMERS = ('sync', 'async', 'sync-compact', 'async-compact', 'script', 'simple')
+DEFAULT_FILES = sorted(glob.glob(os.path.join(SCRIPT_PATH, 'gcode_examples', '*.gcode')))
+COMPACT_PRECISION = 3
+
+
+def run_gui_streamer(name, gcode_file, grbl):
+    """ Streams through the gui streamers, laser switching is disabled """
+    streamer = async_stream.run_stream if name.startswith('async') else stream.stream_gcode
+    precision = COMPACT_PRECISION if name.endswith('compact') else None
+    events = []
+    s = serial.Serial(grbl.device, 115200)
+    try:
+        streamer(s, gcode_file, events.append, precision=precision, laser=False)
+    finally:
+        s.close()
+    return events
+
+
+def run_script_streamer(name, gcode_file, grbl, python2):
+    """ Streams through the original python 2 scripts """
+    script = os.path.join(SCRIPT_PATH, 'stream.py' if name == 'script' else 'simple_stream.py')
+    if name == 'script':
+        command = [python2, script, '-q', gcode_file, grbl.device]
+    else:
+        command = [python2, script, grbl.device, gcode_file]
+    # Both scripts wait for <Enter> once streaming is done
+    subprocess.run(command, input='\n', universal_newlines=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.STDOUT, check=True)
+    return []
+
+
+def benchmark(name, gcode_file, time_scale, python2):
+    """ Runs one streamer on one file against a fresh fake grbl
+
+    :returns The result dict of the run
+    """
+    grbl = fake_grbl.FakeGrbl(time_scale=time_scale)
+    grbl.start()
+    start = time.time()
+    try:
+        if name in ('script', 'simple'):
+            run_script_streamer(name, gcode_file, grbl, python2)
+        else:
+            run_gui_streamer(name, gcode_file, grbl)
+        grbl.wait_idle()
+        wall = time.time() - start
+    finally:
+        grbl.stop()
+
+    stats = grbl.stats
+    job = 0.0
+    if stats['first_block'] is not None and stats['last_block'] is not None:
+        job = max(stats['last_block'] - stats['first_block'], 0.0)
+
+    return {
+        'streamer': name,
+        'file': os.path.basename(gcode_file),
+        'lines_per_second': stats['blocks_executed'] / job if job else 0.0,
+        'starvation_time': stats['starvation_time'],
+        'underruns': stats['underruns'],
+        'job_time': job,
+        'wall_time': wall,
+        'bytes': stats['bytes_received'],
+        'errors': stats['errors'],
+        'overflow': stats['rx_overflow'],
+    }
+
+
+def print_results(results):
+    """ Prints the results as a table """
+    header = '{:<14} {:<16} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8} {:>6} {:>8}'
+    row = '{:<14} {:<16} {:>9.1f} {:>9.2f} {:>9d} {:>9.2f} {:>9.2f} {:>8d} {:>6d} {:>8d}'
+    print(header.format('streamer', 'file', 'lines/s', 'starved', 'underruns', 'job', 'wall',
+                        'bytes', 'errors', 'overflow'))
+    for r in results:
+        print(row.format(r['streamer'], r['file'], r['lines_per_second'], r['starvation_time'],
+                         r['underruns'], r['job_time'], r['wall_time'], r['bytes'], r['errors'], r['overflow']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the g-code streamers against a fake grbl')
+    parser.add_argument('-s', '--streamers', nargs='+', choices=STREAMERS, default=list(STREAMERS),
+                        help='streamers to benchmark')
+    parser.add_argument('-f', '--files', nargs='+', default=DEFAULT_FILES, help='g-code files to stream')
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                        help='multiplier for the fake serial and motion time')
+    parser.add_argument('--python2', default='python2', help='python 2 interpreter for the original scripts')
+    parser.add_argument('--arc-tolerance', type=float, help='arc fit the files with this tolerance in mm')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    files = args.files
+    if args.arc_tolerance is not None:
+        arc_dir = tempfile.mkdtemp(prefix='benchmark_arcs_')
+        files = []
+        for gcode_file in args.files:
+            file_out, stats = arcs.fit_file(gcode_file, os.path.join(arc_dir, os.path.basename(gcode_file)),
+                                            args.arc_tolerance)
+            print('{}: {} arcs, {} of {} lines saved'.format(os.path.basename(gcode_file), stats['arcs'],
+                                                             stats['lines_saved'], stats['lines_in']))
+            files.append(file_out)
+
+    streamers = args.streamers
+    if shutil.which(args.python2) is None:
+        skipped = [name for name in streamers if name in ('script', 'simple')]
+        if skipped:
+            print('Skipping', ', '.join(skipped), ':', args.python2, 'not found')
+        streamers = [name for name in streamers if name not in skipped]
+
+    results = []
+    for gcode_file in files:
+        for name in streamers:
+            results.append(benchmark(name, gcode_file, args.time_scale, args.python2))
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
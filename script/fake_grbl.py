@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""\
+Software stand-in for a grbl controller on a pseudo-terminal
+
+The fake device opens a pty and behaves like grbl 1.1 towards a streamer
+connected to the slave end:
+
+- a 128 byte serial RX buffer that drops characters on overflow
+- a planner queue of 15 blocks, 'ok' is only sent once a block fits
+- per-block execution time from the feed rate (or rapid rate for G0)
+- 'ok', 'error:N' and 'ALARM:N' responses, soft limits and $X unlock
+- realtime '?' status reports, '!' feed hold, '~' cycle start and
+  ctrl-x soft reset with the welcome banner
+
+All timing is multiplied by time_scale so benchmarks can run faster than
+the real machine while keeping the serial and motion time in proportion.
+POSIX only, since it relies on the pty module.
+
+Usage:
+    python3 fake_grbl.py [--time-scale 1.0]
+
+prints the device path to stream to and runs until interrupted.
+"""
+import argparse
+import math
+import os
+import pty
+import re
+import threading
+import time
+import tty
+
+BANNER = "Grbl 1.1f ['$' for help]"
+WORD = re.compile(r'([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))')
+SUPPORTED_M = ('0', '1', '2', '30', '3', '4', '5', '7', '8', '9')
+SUPPORTED_G = ('0', '1', '2', '3', '4', '10', '17', '18', '19', '20', '21', '28', '28.1', '30', '30.1',
+               '38.2', '38.3', '38.4', '38.5', '40', '43.1', '49', '53', '54', '55', '56', '57', '58',
+               '59', '61', '80', '90', '91', '91.1', '92', '92.1', '93', '94')
+
+# grbl 1.1 error and alarm codes used by the fake
+ERROR_LETTER = 1
+ERROR_BAD_NUMBER = 2
+ERROR_LOCKED = 9
+ERROR_UNSUPPORTED = 20
+ERROR_UNDEFINED_FEED = 22
+ALARM_SOFT_LIMIT = 2
+ALARM_ABORT_CYCLE = 3
+
+
+class FakeGrbl:
+    """ Emulated grbl controller served on a pseudo-terminal """
+
+    def __init__(self, rx_buffer_size=128, planner_size=15, baud=115200, time_scale=1.0,
+                 rapid_rate=5000.0, soft_limits=None, homing_time=1.0):
+        """
+        :param rx_buffer_size: Size of grbl's serial receive buffer in bytes
+        :param planner_size: Number of blocks the planner holds
+        :param baud: Baud rate used to pace the incoming characters
+        :param time_scale: Multiplier for all serial and motion time
+        :param rapid_rate: Feed used for G0 and homing moves in mm/min
+        :param soft_limits: Optional ((xmin, xmax), (ymin, ymax), (zmin, zmax)) machine limits
+        :param homing_time: Duration of a $H homing cycle in seconds
+        """
+        self.rx_buffer_size = rx_buffer_size
+        self.planner_size = planner_size
+        self.baud = baud
+        self.time_scale = time_scale
+        self.rapid_rate = rapid_rate
+        self.soft_limits = soft_limits
+        self.homing_time = homing_time
+
+        self.device = None
+        self._master = None
+        self._slave = None
+        self._running = False
+        self._lock = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._threads = []
+        self._last_rx = 0.0
+        self._reset_state()
+        self.stats = new_stats()
+
+    def _reset_state(self):
+        """ Machine state lost on a soft reset """
+        self.rx = bytearray()
+        self.planner = []
+        self.state = 'Idle'
+        self.hold = False
+        self.alarm = False
+        self.position = [0.0, 0.0, 0.0] # Machine position of the executing block
+        self.target = [0.0, 0.0, 0.0] # Position after the last planned block
+        self.offset = [0.0, 0.0, 0.0] # G92 offset
+        self.feed = None
+        self.current_feed = 0.0
+        self.motion = '0'
+        self.absolute = True
+        self.inches = False
+
+    def start(self):
+        """ Opens the pty, prints the welcome banner and starts serving """
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.device = os.ttyname(self._slave)
+        self._running = True
+        for target in (self._rx_loop, self._parser_loop, self._executor_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._send(BANNER)
+        return self.device
+
+    def stop(self):
+        """ Stops serving and closes the pty """
+        self._running = False
+        with self._lock:
+            self._lock.notify_all()
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def reset_stats(self):
+        """ Clears the statistics, for example between two benchmark runs """
+        with self._lock:
+            self.stats = new_stats()
+
+    def wait_idle(self, timeout=None, settle=0.2):
+        """ Blocks until the planner is empty, no block is executing and no
+        character arrived for settle seconds
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while (self.planner or self.state in ('Run', 'Home') or b'\n' in self.rx or
+                   time.time() - self._last_rx < settle):
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining if remaining is not None else 0.1)
+        return True
+
+    def _send(self, line):
+        """ Writes a response line to the streamer """
+        with self._write_lock:
+            if self._master is not None:
+                os.write(self._master, (line + '\r\n').encode())
+
+    def _sleep(self, seconds):
+        time.sleep(seconds * self.time_scale)
+
+    # ----- serial receive ----- #
+
+    def _rx_loop(self):
+        """ Moves incoming characters into the RX buffer at the emulated baud rate """
+        while self._running:
+            try:
+                data = os.read(self._master, 256)
+            except OSError:
+                return
+            self._last_rx = time.time()
+            self._sleep(len(data) * 10.0 / self.baud)
+
+            with self._lock:
+                for byte in data:
+                    char = bytes((byte,))
+                    if char in (b'?', b'!', b'~', b'\x18'):
+                        self._realtime(char)
+                    elif len(self.rx) < self.rx_buffer_size:
+                        self.rx += char
+                        self.stats['max_rx_fill'] = max(self.stats['max_rx_fill'], len(self.rx))
+                    else:
+                        self.stats['rx_overflow'] += 1
+                self.stats['bytes_received'] += len(data)
+                self._lock.notify_all()
+
+    def _realtime(self, char):
+        """ Handles a realtime command, called with the lock held """
+        if char == b'?':
+            self.stats['status_reports'] += 1
+            self._send(self._status())
+        elif char == b'!':
+            if self.state in ('Run', 'Idle') and not self.alarm:
+                self.hold = True
+                self.state = 'Hold'
+        elif char == b'~':
+            if self.hold:
+                self.hold = False
+                self.state = 'Run' if self.planner else 'Idle'
+        elif char == b'\x18':
+            moving = self.state in ('Run', 'Hold') and bool(self.planner)
+            self._reset_state()
+            self.alarm = moving
+            self.state = 'Alarm' if moving else 'Idle'
+            if moving:
+                self._send('ALARM:{}'.format(ALARM_ABORT_CYCLE))
+            self._send('')
+            self._send(BANNER)
+
+    def _status(self):
+        """ Builds a grbl 1.1 status report """
+        mpos = ','.join('{:.3f}'.format(v) for v in self.position)
+        return '<{}|MPos:{}|Bf:{},{}|FS:{:.0f},0>'.format(
+            self.state, mpos, self.planner_size - len(self.planner),
+            self.rx_buffer_size - len(self.rx), self.current_feed if self.state == 'Run' else 0)
+
+    # ----- block parsing ----- #
+
+    def _parser_loop(self):
+        """ Parses complete lines of the RX buffer into the planner """
+        while self._running:
+            with self._lock:
+                while self._running and (b'\n' not in self.rx or len(self.planner) >= self.planner_size):
+                    self._lock.wait(0.1)
+                if not self._running:
+                    return
+                end = self.rx.index(b'\n')
+                line = self.rx[:end].decode(errors='replace').strip()
+                del self.rx[:end + 1]
+                self.stats['lines_received'] += 1
+                response = self._execute_line(line)
+                self._lock.notify_all()
+
+            if response is not None:
+                self._send(response)
+                if response.startswith('error'):
+                    self.stats['errors'] += 1
+                elif response == 'ok':
+                    self.stats['oks'] += 1
+
+    def _execute_line(self, line):
+        """ Runs one line, called with the lock held
+
+        :returns The response line, or None when the line sends its own responses
+        """
+        if not line:
+            return 'ok'
+
+        if line.startswith('$'):
+            return self._system_command(line)
+
+        if self.alarm:
+            return 'error:{}'.format(ERROR_LOCKED)
+
+        block = re.sub(r'\s|\(.*?\)|;.*', '', line).upper()
+        words = []
+        position = 0
+        while position < len(block):
+            match = WORD.match(block, position)
+            if match is None:
+                return 'error:{}'.format(ERROR_LETTER if not block[position].isalpha() else ERROR_BAD_NUMBER)
+            words.append((match.group(1), match.group(2)))
+            position = match.end()
+
+        axes = {}
+        center = [0.0, 0.0]
+        non_modal = None
+        dwell = 0.0
+        for letter, value in words:
+            if letter == 'G':
+                code = value.lstrip('0') or '0'
+                code = code.rstrip('0').rstrip('.') if '.' in code else code
+                if code not in SUPPORTED_G:
+                    return 'error:{}'.format(ERROR_UNSUPPORTED)
+                if code in ('0', '1', '2', '3'):
+                    self.motion = code
+                elif code in ('20', '21'):
+                    self.inches = code == '20'
+                elif code in ('90', '91'):
+                    self.absolute = code == '90'
+                elif code in ('4', '28', '92'):
+                    non_modal = code
+            elif letter == 'M':
+                if (value.lstrip('0') or '0') not in SUPPORTED_M:
+                    return 'error:{}'.format(ERROR_UNSUPPORTED)
+            elif letter == 'F':
+                self.feed = float(value) * (25.4 if self.inches else 1.0)
+            elif letter in 'XYZ':
+                axes['XYZ'.index(letter)] = float(value) * (25.4 if self.inches else 1.0)
+            elif letter in 'IJ':
+                center['IJ'.index(letter)] = float(value) * (25.4 if self.inches else 1.0)
+            elif letter == 'P':
+                dwell = float(value)
+
+        if non_modal == '4':
+            self._plan(list(self.target), 0.0, dwell)
+            return 'ok'
+        if non_modal == '92':
+            for axis, value in axes.items():
+                self.offset[axis] = self.target[axis] - value
+            return 'ok'
+        if non_modal == '28':
+            return self._plan_move([0.0, 0.0, 0.0], self.rapid_rate)
+
+        if not axes:
+            return 'ok'
+
+        target = list(self.target)
+        for axis, value in axes.items():
+            target[axis] = value + self.offset[axis] if self.absolute else target[axis] + value
+
+        if self.motion == '0':
+            return self._plan_move(target, self.rapid_rate)
+        if not self.feed:
+            return 'error:{}'.format(ERROR_UNDEFINED_FEED)
+        if self.motion in ('2', '3'):
+            return self._plan_move(target, self.feed, center)
+        return self._plan_move(target, self.feed)
+
+    def _plan_move(self, target, feed, center=None):
+        """ Checks the soft limits and queues a linear move, or an XY arc around the start plus center """
+        if self.soft_limits is not None:
+            for value, (low, high) in zip(target, self.soft_limits):
+                if not low <= value <= high:
+                    self.alarm = True
+                    self.state = 'Alarm'
+                    self.planner = []
+                    self.stats['alarms'] += 1
+                    self._send('ALARM:{}'.format(ALARM_SOFT_LIMIT))
+                    # The offending block is rejected so the streamer's character count stays consistent
+                    return 'error:{}'.format(ERROR_LOCKED)
+
+        length = math.sqrt(sum((a - b) ** 2 for a, b in zip(target, self.target)))
+        if center is not None:
+            length = self._arc_length(target, center)
+        self._plan(target, feed, length / feed * 60.0)
+        return 'ok'
+
+    def _arc_length(self, target, center):
+        """ Length of the arc from the last planned position to the target """
+        cx, cy = self.target[0] + center[0], self.target[1] + center[1]
+        start = math.atan2(self.target[1] - cy, self.target[0] - cx)
+        end = math.atan2(target[1] - cy, target[0] - cx)
+        sweep = end - start if self.motion == '3' else start - end
+        if sweep <= 0.0:
+            sweep += 2 * math.pi
+        radius = math.hypot(center[0], center[1])
+        return math.hypot(radius * sweep, target[2] - self.target[2])
+
+    def _plan(self, target, feed, duration):
+        """ Adds a block to the planner queue """
+        if self.stats['first_block'] is None:
+            self.stats['first_block'] = time.time()
+        self.planner.append((target, feed, duration))
+        self.target = list(target)
+        self.stats['blocks_planned'] += 1
+
+    def _system_command(self, line):
+        """ Handles the '$' commands """
+        command = line.upper()
+        if command == '$X':
+            self.alarm = False
+            self.state = 'Idle'
+            self._send('[MSG:Caution: Unlocked]')
+        elif command == '$H':
+            self._lock.release()
+            try:
+                self.state = 'Home'
+                self._sleep(self.homing_time)
+            finally:
+                self._lock.acquire()
+            self.alarm = False
+            self.state = 'Idle'
+            self.position = [0.0, 0.0, 0.0]
+            self.target = [0.0, 0.0, 0.0]
+        elif command == '$$':
+            for setting in ('$110=5000.000', '$111=5000.000', '$112=500.000', '$120=10.000'):
+                self._send(setting)
+        return 'ok'
+
+    # ----- block execution ----- #
+
+    def _executor_loop(self):
+        """ Executes planner blocks in real time scaled by time_scale """
+        starving_since = None
+        while self._running:
+            with self._lock:
+                while self._running and (not self.planner or self.hold):
+                    if self.state == 'Run' and not self.planner:
+                        self.state = 'Idle'
+                        self.current_feed = 0.0
+                        self.stats['last_block'] = time.time()
+                        starving_since = time.time()
+                        self._lock.notify_all()
+                    self._lock.wait(0.1)
+                if not self._running:
+                    return
+                if starving_since is not None:
+                    # The planner ran dry in the middle of the job
+                    self.stats['starvation_time'] += time.time() - starving_since
+                    self.stats['underruns'] += 1
+                    starving_since = None
+                target, feed, duration = self.planner[0]
+                self.state = 'Run'
+                self.current_feed = feed
+                start = list(self.position)
+
+            elapsed = 0.0
+            step = 0.005
+            while elapsed < duration and self._running:
+                if self.hold:
+                    time.sleep(step)
+                    continue
+                self._sleep(min(step, duration - elapsed))
+                elapsed += step
+                ratio = min(elapsed / duration, 1.0)
+                self.position = [a + (b - a) * ratio for a, b in zip(start, target)]
+
+            with self._lock:
+                if self.planner and self.planner[0][0] is target:
+                    self.planner.pop(0)
+                    self.position = list(target)
+                    self.stats['blocks_executed'] += 1
+                    self.stats['busy_time'] += duration * self.time_scale
+                self._lock.notify_all()
+
+
+def new_stats():
+    """ Returns an empty statistics dict for FakeGrbl """
+    return {'bytes_received': 0, 'lines_received': 0, 'oks': 0, 'errors': 0, 'alarms': 0,
+            'rx_overflow': 0, 'max_rx_fill': 0, 'status_reports': 0, 'blocks_planned': 0,
+            'blocks_executed': 0, 'busy_time': 0.0, 'starvation_time': 0.0, 'underruns': 0,
+            'first_block': None, 'last_block': None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a fake grbl controller on a pseudo-terminal')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='multiplier for serial and motion time')
+    parser.add_argument('--planner', type=int, default=15, help='planner blocks')
+    args = parser.parse_args()
+
+    grbl = FakeGrbl(time_scale=args.time_scale, planner_size=args.planner)
+    print(grbl.start())
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        grbl.stop()
+        print(grbl.stats)
@@ -37,13 +37,14 @@ THE SOFTWARE.
 """
 
 import serial
+import sys
 import time
 
-# Open grbl serial port
-s = serial.Serial('/dev/tty.usbmodem1811',115200)
+# Open grbl serial port, optionally given as first argument
+s = serial.Serial(sys.argv[1] if len(sys.argv) > 1 else '/dev/tty.usbmodem1811',115200)
 
-# Open g-code file
-f = open('grbl.gcode','r');
+# Open g-code file, optionally given as second argument
+f = open(sys.argv[2] if len(sys.argv) > 2 else 'grbl.gcode','r');
 
 # Wake up grbl
 s.write("\r\n\r\n")